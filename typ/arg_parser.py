@@ -15,6 +15,8 @@
 import argparse
 import optparse
 
+from typ import json_results
+from typ import result_sink
 from typ.host import Host
 
 
@@ -24,6 +26,7 @@ class _Bailout(Exception):
 
 DEFAULT_COVERAGE_OMIT = ['*/typ/*']
 DEFAULT_STATUS_FORMAT = '[%f/%t] '
+DEFAULT_STATUS_REFRESH_RATE = 20
 DEFAULT_SUFFIXES = ['*_test.py', '*_unittest.py']
 
 
@@ -154,6 +157,14 @@ class ArgumentParser(argparse.ArgumentParser):
                               action='store',
                               help=('If specified, writes the full results to '
                                     'that path.'))
+            self.add_argument('--write-results-sidecar-to',
+                              metavar='FILENAME', action='store',
+                              help=('If specified, appends each result to '
+                                    'that JSON lines file as soon as it is '
+                                    'available, so that the results survive '
+                                    'the runner being killed. Use "python '
+                                    '-m typ.recover_full_results" to turn '
+                                    'the file into full results.'))
             self.add_argument('--isolated-script-test-perf-output',
                               type=str,
                               metavar='FILENAME',
@@ -163,6 +174,22 @@ class ArgumentParser(argparse.ArgumentParser):
                               action='store',
                               help=('If specified, writes the trace to '
                                     'that path.'))
+            self.add_argument('--compress-outputs', metavar='FORMAT',
+                              choices=json_results.COMPRESSION_FORMATS,
+                              help=('Compresses the files written by '
+                                    '--write-full-results-to and '
+                                    '--write-trace-to, which are then '
+                                    'written as compact JSON, as well as '
+                                    'text artifacts and uploaded results. '
+                                    'FORMAT is "gzip" or "zstd"; zstd falls '
+                                    'back to gzip if the zstandard module is '
+                                    'not available. Text artifacts get an '
+                                    'extra ".gz" or ".zst" extension.'))
+            self.add_argument('--trace-test-phases', action='store_true',
+                              help=('Adds an event to the trace for each '
+                                    'phase of running each test, such as '
+                                    'loading it, running it and reporting '
+                                    'the result.'))
             self.add_argument('--disable-resultsink',
                               action='store_true',
                               default=False,
@@ -180,6 +207,50 @@ class ArgumentParser(argparse.ArgumentParser):
                                     'This is only intended as a workaround for '
                                     'Skylab where native ResultSink '
                                     'integration is not currently possible.'))
+            self.add_argument('--result-sink-batch-size', type=int,
+                              default=0, metavar='N',
+                              help=('Uploads results to ResultSink from a '
+                                    'background thread in each worker, in '
+                                    'batches of up to N results, instead of '
+                                    'uploading each result before the next '
+                                    'test starts. 0 (the default) disables '
+                                    'batching.'))
+            self.add_argument('--result-sink-flush-interval', type=float,
+                              default=None, metavar='SECS',
+                              help=('Maximum number of seconds a result is '
+                                    'held before its batch is uploaded when '
+                                    'using --result-sink-batch-size. '
+                                    'Defaults to %s.' %
+                                    result_sink.DEFAULT_FLUSH_INTERVAL))
+            self.add_argument('--result-sink-flush-timeout', type=float,
+                              default=None, metavar='SECS',
+                              help=('Maximum number of seconds spent '
+                                    'retrying failed uploads to ResultSink '
+                                    'once the tests are done, when '
+                                    'uploading in the background. Defaults '
+                                    'to %s.' %
+                                    result_sink.DEFAULT_FLUSH_TIMEOUT))
+            self.add_argument('--result-sink-spool-dir', metavar='DIR',
+                              action='store',
+                              help=('Writes results to DIR before uploading '
+                                    'them to ResultSink, and keeps the ones '
+                                    'that could not be uploaded there, to '
+                                    'be uploaded by a later run using the '
+                                    'same DIR. Implies uploading in the '
+                                    'background.'))
+            self.add_argument('--result-sink-in-parent', action='store_true',
+                              default=False,
+                              help=('Uploads results to ResultSink from the '
+                                    'main process instead of from each '
+                                    'worker. Workers send the converted '
+                                    'results back along with the test '
+                                    'results, and they are uploaded in '
+                                    'batches (of --result-sink-batch-size, '
+                                    'or %d) over a few concurrent '
+                                    'connections. This also keeps the '
+                                    'results in --rdb-content-output-file '
+                                    'in the order the tests finished in.' %
+                                    result_sink.DEFAULT_BATCH_SIZE))
             self.add_argument('tests', nargs='*', default=[],
                               help=argparse.SUPPRESS)
 
@@ -228,6 +299,13 @@ class ArgumentParser(argparse.ArgumentParser):
                               help=argparse.SUPPRESS)
             self.add_argument('-t', '--timing', action='store_true',
                               help='Prints timing info.')
+            self.add_argument('--test-times-file', metavar='FILENAME',
+                              action='store',
+                              help=('A full results file from an earlier '
+                                    'run, used to estimate how long the '
+                                    'remaining tests will take for the %%E '
+                                    '(ETA) and %%W (remaining test seconds) '
+                                    'status format fields.'))
             self.add_argument('-v', '--verbose', action='count', default=0,
                               help=('Prints more stuff (can specify multiple '
                                     'times for more output).'))
@@ -254,6 +332,58 @@ class ArgumentParser(argparse.ArgumentParser):
             self.add_argument('--passthrough', action='store_true',
                               default=False,
                               help='Prints all output while running.')
+            self.add_argument('--capture-fds', action='store_true',
+                              default=False,
+                              help=('Captures output at the file descriptor '
+                                    'level, so that output from native code '
+                                    'and subprocesses is included. The '
+                                    'output is stored in temporary files '
+                                    'rather than in memory. Has no effect '
+                                    'with --passthrough or --debugger.'))
+            self.add_argument('--max-output-head-kb', type=int,
+                              default=None, metavar='N',
+                              help=('Keeps only the first N KB of the '
+                                    'output of each test (and the amount '
+                                    'from --max-output-tail-kb), replacing '
+                                    'the rest with a marker. By default, '
+                                    'all output is kept.'))
+            self.add_argument('--max-output-tail-kb', type=int,
+                              default=None, metavar='N',
+                              help=('Keeps only the last N KB of the '
+                                    'output of each test (and the amount '
+                                    'from --max-output-head-kb), replacing '
+                                    'the rest with a marker. By default, '
+                                    'all output is kept.'))
+            self.add_argument('--save-full-output', action='store_true',
+                              default=False,
+                              help=('Saves the full output of tests whose '
+                                    'output was truncated as artifacts. '
+                                    'Requires --write-full-results-to.'))
+            self.add_argument('--dedupe-artifacts', action='store_true',
+                              default=False,
+                              help=('Writes the contents of each artifact '
+                                    'file only once, named by its hash, '
+                                    'under the blobs directory of the '
+                                    'artifact directory, so that identical '
+                                    'artifacts from retries or different '
+                                    'tests share one file.'))
+            self.add_argument('--archive-artifacts', action='store_true',
+                              default=False,
+                              help=('Appends artifact files to one tar '
+                                    'archive per worker, under the archives '
+                                    'directory of the artifact directory, '
+                                    'instead of writing a file for each. '
+                                    'The full results then refer to '
+                                    'artifacts as "ARCHIVE!/MEMBER".'))
+            self.add_argument('--artifact-writer-threads', type=int,
+                              default=0, metavar='N',
+                              help=('Writes artifact files from N threads '
+                                    'in each worker, so that tests do not '
+                                    'wait on the disk while creating them. '
+                                    'The writes finish before the result of '
+                                    'the test is reported, and a failed '
+                                    'write fails the test. 0 (the default) '
+                                    'writes them synchronously.'))
             self.add_argument('--total-shards', default=1, type=int,
                               help=('Total number of shards being used for '
                                     'this test run. (The user of '
@@ -286,6 +416,14 @@ class ArgumentParser(argparse.ArgumentParser):
             self.add_argument('--no-overwrite', action='store_false',
                               dest='overwrite', default=None,
                               help=argparse.SUPPRESS)
+            self.add_argument('--status-refresh-rate', type=float,
+                              default=None, metavar='HZ',
+                              help=('Maximum number of times per second the '
+                                    'status line is updated when it is '
+                                    'overwritten in place. 0 means no limit. '
+                                    'Defaults to %d when printing to a '
+                                    'terminal, and 0 otherwise.' %
+                                    DEFAULT_STATUS_REFRESH_RATE))
             self.add_argument('--test-name-prefix', default='', action='store',
                               help=('Specifies the prefix that will be removed'
                                     ' from test names'))
@@ -357,6 +495,42 @@ class ArgumentParser(argparse.ArgumentParser):
                                     'along with --test-result-server')
                 self.exit_status = 2
 
+        if rargs.result_sink_batch_size < 0:
+            self._print_message('Error: --result-sink-batch-size must be at '
+                                'least 0')
+            self.exit_status = 2
+
+        if (rargs.result_sink_flush_interval is not None and
+                rargs.result_sink_flush_interval <= 0):
+            self._print_message('Error: --result-sink-flush-interval must be '
+                                'greater than 0')
+            self.exit_status = 2
+
+        if (rargs.result_sink_flush_timeout or 0) < 0:
+            self._print_message('Error: --result-sink-flush-timeout must be '
+                                'at least 0')
+            self.exit_status = 2
+
+        if rargs.archive_artifacts and rargs.dedupe_artifacts:
+            self._print_message('Error: --archive-artifacts and '
+                                '--dedupe-artifacts cannot be used together')
+            self.exit_status = 2
+
+        if rargs.artifact_writer_threads < 0:
+            self._print_message('Error: --artifact-writer-threads must be at '
+                                'least 0')
+            self.exit_status = 2
+
+        if (rargs.max_output_head_kb or 0) < 0:
+            self._print_message('Error: --max-output-head-kb must be at '
+                                'least 0')
+            self.exit_status = 2
+
+        if (rargs.max_output_tail_kb or 0) < 0:
+            self._print_message('Error: --max-output-tail-kb must be at '
+                                'least 0')
+            self.exit_status = 2
+
         if rargs.total_shards < 1:
             self._print_message('Error: --total-shards must be at least 1')
             self.exit_status = 2
@@ -12,13 +12,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import concurrent.futures
+import contextlib
 import hashlib
 import logging
+import io
+import json
 import os
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+from typing import Dict, Tuple
 from urllib import parse
 
 
+from typ import json_results
 from typ.host import Host
 
 WINDOWS_FORBIDDEN_PATH_CHARACTERS = [
@@ -36,10 +47,399 @@ WINDOWS_FORBIDDEN_PATH_CHARACTERS = [
 WINDOWS_MAX_PATH = 260
 LINUX_MAX_FILE_NAME = 255
 MAC_MAX_FILE_NAME = 255
+# The directory under the output directory that a BlobStore writes to.
+BLOBS_DIRECTORY = 'blobs'
+# The size of the chunks files are read in when hashing or archiving them.
+_FILE_CHUNK_SIZE = 1024 * 1024
+
+
+class BlobStore(object):
+  def __init__(self, output_dir, host):
+    """Creates a content-addressed store for artifact contents.
+
+    Each distinct content is written once, to a file under the BLOBS_DIRECTORY
+    subdirectory of the output directory that is named by the SHA-256 hash of
+    the content. Artifacts with the same content, e.g. from retries of a test
+    or from tests sharing a golden file, then all refer to the same file.
+
+    args:
+      output_dir: Output directory where artifacts will be saved.
+      host: The Host used to write the files.
+    """
+    self._output_dir = host.realpath(output_dir)
+    self._host = host
+    # The relative paths of the blobs known to be on disk already.
+    self._stored_paths = set()
+
+  def Store(self, data, extension=''):
+    """Stores |data| unless it is already stored.
+
+    Args:
+      data: The bytes to store.
+      extension: An extension to give the file, e.g. ".png", so that it is
+          still recognized by viewers.
+
+    Returns:
+      The path of the blob relative to the output directory.
+    """
+    relative_path, abs_path = self._GetPaths(
+        hashlib.sha256(data).hexdigest(), extension)
+    if abs_path:
+      # Write to a temporary file first, so that the blob never appears
+      # half-written to anyone reading it.
+      temp_path = '%s.%s.tmp' % (abs_path, uuid.uuid4().hex)
+      try:
+        self._host.write_binary_file(temp_path, data)
+        self._host.replace(temp_path, abs_path)
+      finally:
+        if self._host.exists(temp_path):
+          self._host.remove(temp_path)
+    self._stored_paths.add(relative_path)
+    return relative_path
+
+  def StoreFile(self, path, extension=''):
+    """Moves the file at |path| into the store.
+
+    The file is removed instead if its content is already stored. It is read
+    in chunks, so it never has to be held in memory.
+
+    Args:
+      path: The absolute path of the file, which must be on the same file
+          system as the output directory.
+      extension: As in Store().
+
+    Returns:
+      The path of the blob relative to the output directory.
+    """
+    digest = hashlib.sha256()
+    with self._host.open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(_FILE_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    relative_path, abs_path = self._GetPaths(digest.hexdigest(), extension)
+    if abs_path:
+      self._host.replace(path, abs_path)
+    else:
+      self._host.remove(path)
+    self._stored_paths.add(relative_path)
+    return relative_path
+
+  def _GetPaths(self, digest, extension):
+    """Returns the relative path of a blob, and where to write it if needed.
+
+    The absolute path returned is None if the blob is already stored, and its
+    directory exists otherwise. The blob is only known to be stored once it
+    has been written.
+    """
+    relative_path = self._host.join(
+        BLOBS_DIRECTORY, digest[:2], digest + extension)
+    if relative_path in self._stored_paths:
+      return relative_path, None
+    abs_path = self._host.join(self._output_dir, relative_path)
+    # Another process may have stored the same content already.
+    if self._host.exists(abs_path):
+      self._stored_paths.add(relative_path)
+      return relative_path, None
+    self._host.maybe_make_directory(self._host.dirname(abs_path))
+    return relative_path, abs_path
+
+
+# The default number of bytes an AsyncWriter may have waiting to be written.
+DEFAULT_MAX_PENDING_BYTES = 64 * 1024 * 1024
+
+
+class AsyncWriter(object):
+  def __init__(self, host, max_workers,
+               max_pending_bytes=DEFAULT_MAX_PENDING_BYTES):
+    """Creates a writer that writes artifact files from a thread pool.
+
+    Writes are meant to be queued from a single thread, which only blocks if
+    more than |max_pending_bytes| are waiting to be written.
+
+    args:
+      host: The Host used to write the files.
+      max_workers: The number of threads to write with.
+      max_pending_bytes: The number of bytes that may be waiting to be written
+          before Write() blocks. A larger write is let through once nothing
+          else is pending.
+    """
+    self._host = host
+    self._executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_workers)
+    self._max_pending_bytes = max_pending_bytes
+    self._pending_bytes = 0
+    self._condition = threading.Condition()
+    # The futures of the writes that haven't been waited for yet, and a map of
+    # paths to the future of the latest of those writes to each path.
+    self._futures = []
+    self._latest_futures = {}
+
+  def Write(self, path, data, write_as_text=False, check_exists=False):
+    """Queues writing |data| to |path|.
+
+    Errors are not raised from here but returned by Wait().
+
+    args:
+      path: The absolute path of the file to write.
+      data: The bytes, or string if |write_as_text|, to write.
+      write_as_text: Whether to write |data| as text.
+      check_exists: Whether it is an error for the file to exist already.
+    """
+    previous = self._latest_futures.get(path)
+    if previous:
+      # Writes to the same path must happen in order.
+      concurrent.futures.wait([previous])
+    size = len(data)
+    with self._condition:
+      while (self._pending_bytes and
+             self._pending_bytes + size > self._max_pending_bytes):
+        self._condition.wait()
+      self._pending_bytes += size
+    future = self._executor.submit(
+        self._Write, path, data, write_as_text, check_exists, size)
+    self._futures.append(future)
+    self._latest_futures[path] = future
+
+  def Wait(self):
+    """Waits for all the queued writes to finish.
+
+    Returns:
+      A list of the exceptions raised by the writes that failed.
+    """
+    futures = self._futures
+    self._futures = []
+    self._latest_futures = {}
+    return [f.exception() for f in futures if f.exception() is not None]
+
+  def Shutdown(self):
+    self._executor.shutdown(wait=True)
+
+  def _Write(self, path, data, write_as_text, check_exists, size):
+    try:
+      if check_exists and self._host.exists(path):
+        raise ValueError('%s already exists.' % path)
+      self._host.maybe_make_directory(self._host.dirname(path))
+      if write_as_text:
+        self._host.write_text_file(path, data)
+      else:
+        self._host.write_binary_file(path, data)
+    finally:
+      with self._condition:
+        self._pending_bytes -= size
+        self._condition.notify_all()
+
+
+# The directory under the output directory that ArtifactArchives are written
+# to.
+ARCHIVES_DIRECTORY = 'archives'
+# Separates the path of an archive from the name of the member in references
+# to archived artifacts, e.g. "archives/worker_1_123.tar!/a.b.c/log.txt".
+ARCHIVE_MEMBER_SEPARATOR = '!/'
+# Appended to the path of an archive to get the path of its index, which has
+# a JSON [name, offset, size] line for each member, in the order they were
+# added.
+ARCHIVE_INDEX_SUFFIX = '.index'
+
+
+class ArtifactArchive(object):
+  def __init__(self, output_dir, host, worker_num):
+    """Creates an archive to store the artifact files of a worker in.
+
+    Rather than being written to individual files, artifacts are appended to
+    an uncompressed tar file under the ARCHIVES_DIRECTORY subdirectory of the
+    output directory, and referred to by the path of the archive and the name
+    of the member, separated by ARCHIVE_MEMBER_SEPARATOR. Each member is
+    flushed as soon as it is added, so the archive stays readable if the
+    worker dies. The offsets of the members are written to an index next to
+    the archive, so ReadArtifact() can read a member without scanning the
+    archive. Use ReadArtifact() or ExtractArchives() to get the artifacts
+    back.
+
+    args:
+      output_dir: Output directory where artifacts will be saved.
+      host: The Host used to find the paths.
+      worker_num: The number of the worker, used to name the archive.
+    """
+    self._host = host
+    self.relative_path = host.join(
+        ARCHIVES_DIRECTORY, 'worker_%d_%d.tar' % (worker_num, host.getpid()))
+    abs_path = host.join(host.realpath(output_dir), self.relative_path)
+    host.maybe_make_directory(host.dirname(abs_path))
+    # Appending also works for an archive left by an earlier pool that ran in
+    # this process.
+    self._tar = tarfile.open(abs_path, 'a', format=tarfile.PAX_FORMAT)
+    members = self._tar.getmembers()
+    self._member_names = set(member.name for member in members)
+    # The index is rebuilt from the archive, in case the earlier pool died
+    # before finishing a line of it.
+    self._index = open(abs_path + ARCHIVE_INDEX_SUFFIX, 'wb')
+    for member in members:
+      self._WriteIndexEntry(member.name, member.offset_data, member.size)
+
+  def Add(self, subdir_relative_path, data, overwrite=False):
+    """Appends an artifact to the archive.
+
+    args:
+      subdir_relative_path: The path the artifact would have relative to the
+          output directory if it weren't archived.
+      data: The bytes to store.
+      overwrite: Whether replacing an artifact with the same path is allowed.
+
+    Returns:
+      The reference to the artifact, to use as its path.
+    """
+    return self._AddMember(subdir_relative_path, len(data), io.BytesIO(data),
+                           overwrite)
+
+  def AddFile(self, subdir_relative_path, path, overwrite=False):
+    """Appends the contents of a file to the archive.
+
+    The file is copied in chunks, so it never has to be held in memory.
+
+    args:
+      subdir_relative_path: As in Add().
+      path: The absolute path of the file.
+      overwrite: As in Add().
+
+    Returns:
+      The reference to the artifact, to use as its path.
+    """
+    with open(path, 'rb') as f:
+      return self._AddMember(subdir_relative_path, os.fstat(f.fileno()).st_size,
+                             f, overwrite)
+
+  def _AddMember(self, subdir_relative_path, size, fileobj, overwrite):
+    name = subdir_relative_path.replace(self._host.sep, '/')
+    if name in self._member_names and not overwrite:
+      raise ValueError('%s already exists in %s.' % (name, self.relative_path))
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = time.time()
+    # A later member with the same name takes precedence when reading.
+    self._tar.addfile(info, fileobj)
+    self._tar.fileobj.flush()
+    # The data is followed by padding up to the next block.
+    blocks = (size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE
+    self._WriteIndexEntry(
+        name, self._tar.offset - blocks * tarfile.BLOCKSIZE, size)
+    self._member_names.add(name)
+    return self.relative_path + ARCHIVE_MEMBER_SEPARATOR + name
+
+  def _WriteIndexEntry(self, name, offset, size):
+    # The entry is only written once the member is flushed, so the index
+    # never refers to data that isn't in the archive.
+    line = json.dumps([name, offset, size]) + '\n'
+    self._index.write(line.encode('utf-8'))
+    self._index.flush()
+
+  def Close(self):
+    self._tar.close()
+    self._index.close()
+
+
+def IsArchivedArtifact(path):
+  """Returns whether an artifact path refers to an archived artifact."""
+  return ARCHIVE_MEMBER_SEPARATOR in path
+
+
+def ReadArtifact(output_dir, path):
+  """Reads the contents of an artifact file.
+
+  args:
+    output_dir: The output directory the artifacts were saved to.
+    path: The path of the artifact, as found in the full results, which may
+        refer to an archived artifact.
+
+  Returns:
+    The contents of the artifact, as bytes.
+  """
+  if not IsArchivedArtifact(path):
+    with open(os.path.join(output_dir, path), 'rb') as f:
+      return f.read()
+  archive_path, name = path.split(ARCHIVE_MEMBER_SEPARATOR, 1)
+  archive_path = os.path.join(output_dir, archive_path)
+  index = _ReadArchiveIndex(archive_path + ARCHIVE_INDEX_SUFFIX)
+  if index is None:
+    # The archive was written without an index.
+    with tarfile.open(archive_path) as tar:
+      return tar.extractfile(tar.getmember(name)).read()
+  offset, size = index[name]
+  with open(archive_path, 'rb') as f:
+    f.seek(offset)
+    return f.read(size)
+
+
+# Maps the path of each archive index that was read to the number of bytes of
+# it that were consumed and the {name: (offset, size)} dict they describe, so
+# reading every member of an archive doesn't read its index every time.
+_archive_indexes: Dict[str, Tuple[int, Dict[str, Tuple[int, int]]]] = {}
+
+
+def _ReadArchiveIndex(index_path):
+  """Returns the {name: (offset, size)} dict of the live archive members.
+
+  Only the lines added to the index since it was last read are parsed.
+  Returns None if the index doesn't exist.
+  """
+  try:
+    with open(index_path, 'rb') as f:
+      consumed, index = _archive_indexes.get(index_path, (0, {}))
+      if os.fstat(f.fileno()).st_size < consumed:
+        # The index was rewritten since it was last read.
+        consumed, index = 0, {}
+      f.seek(consumed)
+      data = f.read()
+  except FileNotFoundError:
+    return None
+  # A trailing partial line is still being written, so it is left for later.
+  complete = data[:data.rfind(b'\n') + 1]
+  for line in complete.splitlines():
+    name, offset, size = json.loads(line.decode('utf-8'))
+    # Later entries are for members that replace earlier ones.
+    index[name] = (offset, size)
+  _archive_indexes[index_path] = (consumed + len(complete), index)
+  return index
+
+
+def ExtractArchives(output_dir, dest_dir=None):
+  """Extracts all archived artifacts into the usual directory layout.
+
+  args:
+    output_dir: The output directory the artifacts were saved to.
+    dest_dir: The directory to extract to. Defaults to |output_dir|, which
+        puts every artifact where it would have been without archiving.
+
+  Returns:
+    A list of the relative paths of the extracted files.
+  """
+  dest_dir = dest_dir or output_dir
+  archives_dir = os.path.join(output_dir, ARCHIVES_DIRECTORY)
+  if not os.path.isdir(archives_dir):
+    return []
+  extracted = []
+  for archive in sorted(os.listdir(archives_dir)):
+    if archive.endswith(ARCHIVE_INDEX_SUFFIX):
+      continue
+    with tarfile.open(os.path.join(archives_dir, archive)) as tar:
+      for member in tar:
+        if not member.isfile():
+          continue
+        dest_path = os.path.join(dest_dir, *member.name.split('/'))
+        # Don't let a crafted member name escape the destination.
+        if not os.path.abspath(dest_path).startswith(
+            os.path.join(os.path.abspath(dest_dir), '')):
+          raise ValueError('Unsafe artifact path %s in %s' % (
+              member.name, archive))
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        with open(dest_path, 'wb') as f:
+          f.write(tar.extractfile(member).read())
+        extracted.append(member.name)
+  return extracted
+
 
 class Artifacts(object):
   def __init__(self, output_dir, host, iteration=0, artifacts_base_dir='',
-               intial_results_base_dir=False, repeat_tests=False):
+               intial_results_base_dir=False, repeat_tests=False,
+               blob_store=None, writer=None, archive=None, compression=None):
     """Creates an artifact results object.
 
     This provides a way for tests to write arbitrary files to disk, either to
@@ -74,6 +474,21 @@ class Artifacts(object):
       intial_results_base_dir: Flag to create a sub directory for initial results
       repeat_tests: Flag to signal that tests are repeated and therefore the verification to prevent
           overwriting of artifacts should be skipped
+      blob_store: Optional BlobStore. If given, the contents of artifacts
+          created with CreateArtifact() are stored in it, and the artifacts
+          refer to the blob files instead of being written to the hierarchy
+          above.
+      writer: Optional AsyncWriter. If given, CreateArtifact() queues the
+          files to be written by it rather than writing them itself, and
+          errors such as an artifact already existing are only reported by
+          WaitForWrites().
+      archive: Optional ArtifactArchive. If given, the contents of artifacts
+          created with CreateArtifact() are appended to it, and the artifacts
+          refer to their archive members.
+      compression: Optional format returned by
+          json_results.resolve_compression(). If given, text artifacts
+          created with CreateArtifact() are compressed with it, and their
+          file names get the extension of the format appended.
       file_manager: File manager object which is supplied by the test runner. The object needs to support
           the exists, open, maybe_make_directory, dirname and join member functions.
     """
@@ -102,6 +517,13 @@ class Artifacts(object):
     # Artifacts that are held entirely in memory. A map of artifact name to text
     # content.
     self.in_memory_text_artifacts = {}
+    self._blob_store = blob_store
+    self._writer = writer
+    self._archive = archive
+    self._compression = compression
+    # A map of the subdir-relative paths of artifacts stored in the blob store
+    # to the paths of their blobs.
+    self._blob_paths = {}
 
   def ArtifactsSubDirectory(self):
     sub_dir = self._artifacts_base_dir
@@ -130,6 +552,19 @@ class Artifacts(object):
           "reftest_mismatch_actual" or "screenshot".
     """
     self._AssertOutputDir()
+    if write_as_text and self._compression:
+      data = json_results.compress(data.encode('utf-8'), self._compression)
+      file_relative_path += json_results.compression_extension(
+          self._compression)
+      write_as_text = False
+    if self._archive:
+      self._CreateArchivedArtifact(artifact_name, file_relative_path, data,
+                                   force_overwrite, write_as_text)
+      return
+    if self._blob_store:
+      self._CreateBlobArtifact(artifact_name, file_relative_path, data,
+                               force_overwrite, write_as_text)
+      return
     try:
       subdir_relative_path, abs_artifact_path = (
           self._GetSubDirRelativeAndAbsolutePaths(file_relative_path))
@@ -137,6 +572,14 @@ class Artifacts(object):
       logging.error(str(e))
       return
 
+    if self._writer:
+      if subdir_relative_path not in self.artifacts.get(artifact_name, []):
+        self.AddArtifact(artifact_name, subdir_relative_path)
+      self._writer.Write(
+          abs_artifact_path, data, write_as_text,
+          check_exists=not self._repeat_tests and not force_overwrite)
+      return
+
     if (not self._repeat_tests and
             not force_overwrite and self._host.exists(abs_artifact_path)):
         raise ValueError('%s already exists.' % abs_artifact_path)
@@ -150,6 +593,127 @@ class Artifacts(object):
     else:
         self._host.write_binary_file(abs_artifact_path, data)
 
+  @contextlib.contextmanager
+  def OpenArtifact(self, artifact_name, file_relative_path,
+                   force_overwrite=False, write_as_text=False):
+    """Creates an artifact and yields a File object to write it with.
+
+    Unlike CreateArtifact(), this does not need the whole contents in memory,
+    so large artifacts such as traces or videos can be streamed to disk. The
+    artifact gets the same path as it would from CreateArtifact(), and is
+    only added once the block exits without raising an exception.
+
+    With a blob store or an archive, the contents are streamed to a temporary
+    file in the output directory and moved into place once it is closed. An
+    AsyncWriter is not used; the file is written from the calling thread.
+
+    Args:
+      artifact_name: A string specifying the name for the artifact, such as
+          "trace" or "video".
+      file_relative_path: The path of the artifact file, as in
+          CreateArtifact().
+      force_overwrite: Whether replacing an existing artifact is allowed.
+      write_as_text: Whether to open the file in text mode.
+    """
+    self._AssertOutputDir()
+    mode = 'w' if write_as_text else 'wb'
+    if self._archive or self._blob_store:
+      self._host.maybe_make_directory(self._output_dir)
+      fd, temp_path = tempfile.mkstemp(prefix='.artifact-',
+                                       dir=self._output_dir)
+      try:
+        with open(fd, mode, encoding='utf-8' if write_as_text else None) as f:
+          yield f
+        if self._archive:
+          self._CreateArchivedArtifact(artifact_name, file_relative_path, None,
+                                       force_overwrite, write_as_text,
+                                       temp_path=temp_path)
+        else:
+          self._CreateBlobArtifact(artifact_name, file_relative_path, None,
+                                   force_overwrite, write_as_text,
+                                   temp_path=temp_path)
+      finally:
+        if os.path.exists(temp_path):
+          os.remove(temp_path)
+      return
+    try:
+      subdir_relative_path, abs_artifact_path = (
+          self._GetSubDirRelativeAndAbsolutePaths(file_relative_path))
+    except PathTooLongException as e:
+      logging.error(str(e))
+      # Like CreateArtifact(), drop the contents rather than fail the test.
+      with open(os.devnull, mode,
+                encoding='utf-8' if write_as_text else None) as f:
+        yield f
+      return
+
+    if (not self._repeat_tests and
+            not force_overwrite and self._host.exists(abs_artifact_path)):
+        raise ValueError('%s already exists.' % abs_artifact_path)
+
+    self._host.maybe_make_directory(self._host.dirname(abs_artifact_path))
+    with self._host.open(abs_artifact_path, mode) as f:
+      yield f
+    if subdir_relative_path not in self.artifacts.get(artifact_name, []):
+        self.AddArtifact(artifact_name, subdir_relative_path)
+
+  def _CreateArchivedArtifact(self, artifact_name, file_relative_path, data,
+                              force_overwrite, write_as_text, temp_path=None):
+    # Member names have no length limits, so this only needs the path the
+    # artifact would otherwise have had.
+    subdir_relative_path = self._host.join(
+        self.ArtifactsSubDirectory(), file_relative_path)
+    overwrite = self._repeat_tests or force_overwrite
+    if temp_path:
+      reference = self._archive.AddFile(subdir_relative_path, temp_path,
+                                        overwrite=overwrite)
+    else:
+      if write_as_text:
+        data = data.encode('utf-8')
+      reference = self._archive.Add(subdir_relative_path, data,
+                                    overwrite=overwrite)
+    if reference not in self.artifacts.get(artifact_name, []):
+      self.AddArtifact(artifact_name, reference)
+
+  def _CreateBlobArtifact(self, artifact_name, file_relative_path, data,
+                          force_overwrite, write_as_text, temp_path=None):
+    # Blob paths are short, so unlike in CreateArtifact() there is no need to
+    # restrict the length of the path, which is only used to identify the
+    # artifact.
+    subdir_relative_path = self._host.join(
+        self.ArtifactsSubDirectory(), file_relative_path)
+    previous_path = self._blob_paths.pop(subdir_relative_path, None)
+    if (previous_path is not None and not self._repeat_tests and
+        not force_overwrite):
+      self._blob_paths[subdir_relative_path] = previous_path
+      raise ValueError('%s already exists.' % subdir_relative_path)
+
+    extension = os.path.splitext(file_relative_path)[1]
+    if temp_path:
+      blob_path = self._blob_store.StoreFile(temp_path, extension)
+    else:
+      if write_as_text:
+        data = data.encode('utf-8')
+      blob_path = self._blob_store.Store(data, extension)
+    paths = self.artifacts.setdefault(artifact_name, [])
+    if (previous_path in paths and
+        previous_path not in self._blob_paths.values()):
+      paths.remove(previous_path)
+    if blob_path not in paths:
+      paths.append(blob_path)
+    self._blob_paths[subdir_relative_path] = blob_path
+
+  def WaitForWrites(self):
+    """Waits for the artifact files still being written to be written.
+
+    Returns:
+      A list of the exceptions raised while writing the files, which is always
+      empty if no AsyncWriter is used.
+    """
+    if not self._writer:
+      return []
+    return self._writer.Wait()
+
   def CreateLink(self, artifact_name, path):
     """Creates a special link/URL artifact.
 
@@ -8,13 +8,16 @@
 # to talk about them that doesn't have quite so much legacy baggage), but
 # that might not be possible.
 
+import collections
 import dataclasses
 import itertools
 import re
 import logging
+import sys
 
 from collections import Counter, OrderedDict
 from collections import defaultdict
+from typing import FrozenSet
 
 from typ import reduced_glob
 from typ.json_results import ResultType
@@ -44,6 +47,7 @@ VALID_RESULT_TAGS = set(
 
 ESCAPED_WILDCARD = '\\*'
 UNESCAPED_WILDCARD = '*'
+_NO_TAGS: FrozenSet[str] = frozenset()
 
 
 class ConflictResolutionTypes(object):
@@ -250,8 +254,8 @@ class TaggedTestListParser(object):
     This parser covers the 'tagged' test lists format in:
         bit.ly/chromium-test-list-format
 
-    Takes raw expectations data as a string read from the expectation file
-    in the format:
+    Takes raw expectations data as a string read from the expectation file,
+    or as an iterable of lines such as an open file object, in the format:
 
       # This is an example expectation file.
       #
@@ -287,39 +291,48 @@ class TaggedTestListParser(object):
         self.expectations = []
         self._allowed_results = set()
         self._tag_to_tag_set = {}
+        # Maps each declared tag, lowercased, to how the header spells it.
+        self._tag_spellings = {}
         self.conflict_resolution = conflict_resolution
         self._encode_func = encode_func
         self._decode_func = decode_func
+        # Expectation files repeat the same handful of tag and result
+        # combinations on most lines, so each distinct raw string is only
+        # split, validated and interned once.
+        self._parsed_raw_tags = {}
+        self._parsed_raw_results = {}
         self._parse_raw_expectation_data(raw_data)
 
     def _parse_raw_expectation_data(self, raw_data):
-        all_lines = raw_data.splitlines()
-        lineno = 1
+        if isinstance(raw_data, str):
+            raw_data = raw_data.splitlines()
+        # Lines consumed while parsing a multi-line header are pushed back
+        # onto |pending| so that they are also visited as regular lines.
+        pending = collections.deque()
+        lines = _numbered_lines(raw_data, pending)
         tag_sets_intersection = set()
         first_tag_line = None
-        while lineno <= len(all_lines):
-            line = all_lines[lineno - 1].strip()
-            if (line.startswith((self.TAG_TOKEN, self.RESULT_TOKEN))):
+        for lineno, line in lines:
+            if not line:
+                continue
+            if line[0] != '#':
+                if tag_sets_intersection:
+                    break
+                self.expectations.append(
+                    self._parse_expectation_line(lineno, line))
+            elif line.startswith((self.TAG_TOKEN, self.RESULT_TOKEN)):
                 if not first_tag_line:
                     first_tag_line = lineno
                 tag_sets_intersection.update(
-                    self._parse_header_token_line(lineno, line, all_lines))
+                    self._parse_header_token_line(lineno, line, lines,
+                                                  pending))
             elif line.startswith(self.CONFLICT_RESOLUTION):
                 self._parse_conflict_resolution_line(lineno, line)
             elif line.startswith(self.CONFLICTS_ALLOWED):
                 self._parse_conflicts_allowed_line(lineno, line)
             elif line.startswith(self.FULL_WILDCARD_SUPPORT):
                 self._parse_full_wildcard_support_line(lineno, line)
-            elif line.startswith('#') or not line:
-                # Ignore, it is just a comment or empty.
-                lineno += 1
-                continue
-            elif not tag_sets_intersection:
-                self.expectations.append(
-                    self._parse_expectation_line(lineno, line))
-            else:
-                break
-            lineno += 1
+            # Otherwise, ignore it, it is just a comment.
         if tag_sets_intersection:
             is_multiple_tags = len(tag_sets_intersection) > 1
             tag_tags = 'tags' if is_multiple_tags else 'tag'
@@ -329,7 +342,7 @@ class TaggedTestListParser(object):
                     sorted(list(tag_sets_intersection))), was_were)
             raise ParseError(first_tag_line, error_msg)
 
-    def _parse_header_token_line(self, lineno, line, all_lines):
+    def _parse_header_token_line(self, lineno, line, lines, pending):
         """Helper function for parsing lines that start with header tokens.
 
         Returns:
@@ -345,7 +358,7 @@ class TaggedTestListParser(object):
             token = self.RESULT_TOKEN
 
         tag_counts = self._get_tag_counts_from_header_line(
-            lineno, line, all_lines, token)
+            lineno, line, lines, pending, token)
         tag_set = set(tag_counts.keys())
         duplicate_tags = {tag for tag, count in tag_counts.items() if count > 1}
 
@@ -356,12 +369,13 @@ class TaggedTestListParser(object):
 
         tag_sets_intersection = set()
         if token == self.TAG_TOKEN:
-            tag_set = frozenset([t.lower() for t in tag_set])
+            tag_set = frozenset([sys.intern(t.lower()) for t in tag_set])
             tag_sets_intersection.update(
                 (t for t in tag_set if t in self._tag_to_tag_set))
             self.tag_sets.add(tag_set)
             self._tag_to_tag_set.update(
                 {tg: id(tag_set) for tg in tag_set})
+            self._tag_spellings.update((t.lower(), t) for t in tag_counts)
         else:
             for t in tag_set:
                 if t not in VALID_RESULT_TAGS:
@@ -374,7 +388,8 @@ class TaggedTestListParser(object):
             self._allowed_results.update(tag_set)
         return tag_sets_intersection
 
-    def _get_tag_counts_from_header_line(self, lineno, line, all_lines, token):
+    def _get_tag_counts_from_header_line(self, lineno, line, lines, pending,
+                                         token):
         """Helper function for parsing tags from a header line.
 
         Returns:
@@ -383,14 +398,19 @@ class TaggedTestListParser(object):
         right_bracket = line.find(']')
         prefix_size = len(token)
         tag_counts = Counter()
+        consumed = []
         # Loop through every line until we find the closing ], adding any tags
         # we fine. The line with the closing ] is handled after the loop.
-        while lineno <= len(all_lines) and right_bracket == -1:
+        while right_bracket == -1:
             tag_counts.update(line[prefix_size:].split())
-            lineno += 1
-            line = all_lines[lineno - 1].strip()
+            lineno, line = next(lines, (lineno + 1, None))
+            if line is None:
+                raise ParseError(
+                    lineno,
+                    'Multi-line tag set missing closing "]"')
+            consumed.append((lineno, line))
             prefix_size = 1
-            if line[0] != '#':
+            if not line or line[0] != '#':
                 raise ParseError(
                     lineno,
                     'Multi-line tag set missing leading "#"')
@@ -403,6 +423,7 @@ class TaggedTestListParser(object):
                 'bracket')
 
         tag_counts.update(line[prefix_size:right_bracket].split())
+        pending.extend(consumed)
         return tag_counts
 
     def _parse_conflict_resolution_line(self, lineno, line):
@@ -441,31 +462,40 @@ class TaggedTestListParser(object):
         self.full_wildcard_support = bool_value == 'true'
 
     def _parse_expectation_line(self, lineno, line):
-        reason, raw_tags, test, raw_results, trailing_comments =\
-            self._parse_expectation_line_into_components(lineno, line)
-        tags = [raw_tag.lower()
-                for raw_tag in raw_tags.split()] if raw_tags else []
-        self._validate_expectation_structure(lineno, test, tags)
-        results, retry_on_failure, is_slow_test =\
-            self._parse_and_validate_raw_results(lineno, raw_results)
+        components = _split_canonical_expectation_line(line)
+        if components is None:
+            components = self._parse_expectation_line_into_components(
+                lineno, line)
+        reason, raw_tags, test, raw_results, trailing_comments = components
+        if UNESCAPED_WILDCARD in test:
+            self._validate_wildcards(lineno, test)
+        if raw_tags:
+            tags, raw_tags = (
+                self._parsed_raw_tags.get(raw_tags) or
+                self._parse_and_validate_raw_tags(lineno, raw_tags))
+        else:
+            tags = _NO_TAGS
+        results, retry_on_failure, is_slow_test, raw_results = (
+            self._parsed_raw_results.get(raw_results) or
+            self._parse_and_validate_raw_results(lineno, raw_results))
 
         if self._decode_func:
             test = self._decode_func(test)
 
-        # remove escapes for asterisks
-        is_glob = self._determine_if_test_is_glob(test)
-        test = self._process_wildcards(test, is_glob)
-        if raw_tags:
-            raw_tags = raw_tags.split()
-        if raw_results:
-            raw_results = raw_results.split()
+        if ESCAPED_WILDCARD in test or self.full_wildcard_support:
+            # remove escapes for asterisks
+            is_glob = self._determine_if_test_is_glob(test)
+            test = self._process_wildcards(test, is_glob)
+        else:
+            is_glob = test.endswith(UNESCAPED_WILDCARD)
         # Tags from tag groups will be stored in lower case in the Expectation
         # instance. These tags will be compared to the tags passed in to
         # the Runner instance which are also stored in lower case.
         return Expectation(
             reason, test, tags, results, lineno, retry_on_failure, is_slow_test,
-            self.conflict_resolution, raw_tags=raw_tags,
-            raw_results=raw_results, is_glob=is_glob,
+            self.conflict_resolution,
+            raw_tags=list(raw_tags) if raw_tags else raw_tags,
+            raw_results=list(raw_results), is_glob=is_glob,
             full_wildcard_support=self.full_wildcard_support,
             trailing_comments=trailing_comments, encode_func=self._encode_func)
 
@@ -538,15 +568,26 @@ class TaggedTestListParser(object):
             * All tags used are known
             * Only one tag from each tag set is used
         """
-        tag_set_ids = set()
+        self._validate_wildcards(lineno, test)
+        self._validate_tags(lineno, tags)
 
-        if not self.full_wildcard_support:
-            for i in range(len(test)-1):
-                if (test[i] == UNESCAPED_WILDCARD and
-                    (i == 0 or test[i-1] != '\\')):
-                    raise ParseError(lineno,
-                        f'Invalid glob, \'{UNESCAPED_WILDCARD}\' can only be '
-                        f'at the end of the pattern')
+    def _validate_wildcards(self, lineno, test):
+        """Checks that only a trailing wildcard is used, if required."""
+        if self.full_wildcard_support:
+            return
+        # Only look at the (rare) tests that actually contain a wildcard
+        # before the last character.
+        i = test.find(UNESCAPED_WILDCARD, 0, len(test) - 1)
+        while i != -1:
+            if i == 0 or test[i-1] != '\\':
+                raise ParseError(lineno,
+                    f'Invalid glob, \'{UNESCAPED_WILDCARD}\' can only be '
+                    f'at the end of the pattern')
+            i = test.find(UNESCAPED_WILDCARD, i + 1, len(test) - 1)
+
+    def _validate_tags(self, lineno, tags):
+        """Checks that all tags are known and from different tag sets."""
+        tag_set_ids = set()
 
         for t in tags:
             if not t in  self._tag_to_tag_set:
@@ -565,20 +606,41 @@ class TaggedTestListParser(object):
                               _group_to_string(sorted(tag_intersection)))
             raise ParseError(lineno, error_msg)
 
+    def _parse_and_validate_raw_tags(self, lineno, raw_tags):
+        """Helper function to validate and parse the raw tags of a line.
+
+        Returns:
+            A tuple (tags, raw_tags). |tags| is a frozenset of the lower-cased
+            tags, and |raw_tags| is a tuple of the tags as written.
+        """
+        parsed = self._parsed_raw_tags.get(raw_tags)
+        if parsed is None:
+            split_tags = [sys.intern(t) for t in raw_tags.split()]
+            tags = [sys.intern(t.lower()) for t in split_tags]
+            self._validate_tags(lineno, tags)
+            parsed = (frozenset(tags), tuple(split_tags))
+            self._parsed_raw_tags[raw_tags] = parsed
+        return parsed
+
     def _parse_and_validate_raw_results(self, lineno, raw_results):
         """Helper function to validate and parse raw results into known values.
 
         Returns:
-            A tuple (results, retry_on_failure, is_slow_test). |results| is a
-            list of parsed results. |retry_on_failure| is a boolean denoting
-            whether the test should be retried on failure or not. |is_slow_test|
-            is a boolean denoting whether the test should be considered slow or
-            not.
+            A tuple (results, retry_on_failure, is_slow_test, raw_results).
+            |results| is a frozenset of parsed results. |retry_on_failure| is a
+            boolean denoting whether the test should be retried on failure or
+            not. |is_slow_test| is a boolean denoting whether the test should be
+            considered slow or not. |raw_results| is a tuple of the results as
+            written.
         """
+        parsed = self._parsed_raw_results.get(raw_results)
+        if parsed is not None:
+            return parsed
         results = []
         retry_on_failure = False
         is_slow_test = False
-        for r in raw_results.split():
+        split_results = [sys.intern(r) for r in raw_results.split()]
+        for r in split_results:
             if r not in self._allowed_results:
                 raise ParseError(lineno, 'Unknown result type "%s"' % r)
             try:
@@ -594,7 +656,10 @@ class TaggedTestListParser(object):
                     raise KeyError
             except KeyError:
                 raise ParseError(lineno, 'Unknown result type "%s"' % r)
-        return results, retry_on_failure, is_slow_test
+        parsed = (frozenset(results), retry_on_failure, is_slow_test,
+                  tuple(split_results))
+        self._parsed_raw_results[raw_results] = parsed
+        return parsed
 
 class TestExpectations(object):
 
@@ -615,6 +680,9 @@ class TestExpectations(object):
         self._conflict_resolution = ConflictResolutionTypes.UNION
         self._encode_func = encode_func
         self._decode_func = decode_func
+        # The state needed to reload each parsed tagged list, by file name,
+        # or None for lists that were not parsed with reloadable=True.
+        self._tagged_lists = {}
 
     def set_tags(self, tags, raise_ex_for_bad_tags=False):
         self.validate_condition_tags(tags, raise_ex_for_bad_tags)
@@ -630,44 +698,22 @@ class TestExpectations(object):
         return self._tags[:]
 
     def validate_condition_tags(self, tags, raise_ex_for_bad_tags):
-        # This function will be used to validate if each tag in the tags list
-        # is declared in a test expectations file. This validation will make
-        # sure that the tags written in the test expectations files match tags
-        # that are generated by the test runner.
-        def _pluralize_unknown(missing):
-            if len(missing) > 1:
-                return ('s %s and %s are' % (', '.join(missing[:-1]),
-                                             missing[-1]),
-                        'have', 's are')
-            else:
-                return (' %s is' % missing[0], 'has', ' is')
-        tags = set(t.lower() for t in tags)
-        unknown_tags = set()
-        if self.tag_sets:
-            known_and_ignored_tags = set().union(
-                *self.tag_sets).union(self.ignored_tags)
-            unknown_tags = tags - known_and_ignored_tags
-        if unknown_tags:
-            msg = (
-                'Tag%s not declared in the expectations file and %s not been '
-                'explicitly ignored by the test. There may have been a typo in '
-                'the expectations file. Please make sure the aforementioned '
-                'tag%s declared at the top of the expectations file.' %
-                _pluralize_unknown(sorted(unknown_tags)))
-            if raise_ex_for_bad_tags:
-                raise ValueError(msg)
-            else:
-                logging.warning(msg)
+        _validate_condition_tags(self.tag_sets, self.ignored_tags, tags,
+                                 raise_ex_for_bad_tags)
 
     def parse_tagged_list(self, raw_data, file_name='',
                           tags_conflict=None,
-                          conflict_resolution=ConflictResolutionTypes.UNION):
+                          conflict_resolution=ConflictResolutionTypes.UNION,
+                          reloadable=False):
+        # If |reloadable| is true, the lines of |raw_data| are kept so that
+        # reload_tagged_list() can later re-parse only the lines that changed.
         ret = 0
         self.file_name = file_name
         self._conflict_resolution = conflict_resolution
         tags_conflict = tags_conflict or _default_tags_conflict
+        lines = _split_lines(raw_data)
         try:
-            parser = TaggedTestListParser(raw_data,
+            parser = TaggedTestListParser(lines,
                                           conflict_resolution,
                                           encode_func=self._encode_func,
                                           decode_func=self._decode_func)
@@ -704,6 +750,18 @@ class TestExpectations(object):
             self.glob_exps.setdefault(exp.test, []).append(exp)
             self._maybe_cache_reduced_glob(exp.test)
 
+        state = None
+        if reloadable:
+            state = _TaggedListState(
+                lines=lines, expectations=parser.expectations,
+                conflict_resolution=conflict_resolution,
+                conflicts_allowed=parser.conflicts_allowed,
+                header_length=_header_length(lines),
+                has_late_directives=any(
+                    _is_directive(line)
+                    for line in lines[_header_length(lines):]))
+        self._tagged_lists[file_name] = state
+
         errors = ''
         if not parser.conflicts_allowed:
             errors = self.check_test_expectations_patterns_for_conflicts(
@@ -711,6 +769,184 @@ class TestExpectations(object):
             ret = 1 if errors else 0
         return ret, errors
 
+    def reload_tagged_list(self, raw_data, file_name='', tags_conflict=None):
+        """Updates the expectations from a changed version of a tagged list.
+
+        Only the lines that differ from the version of |file_name| that was
+        parsed last are re-parsed, and conflicts are only checked for the
+        patterns those lines touch. If the header (tag sets, results and
+        other directives) changed, the whole list is parsed again instead.
+        If |file_name| was not parsed before, it is parsed as with
+        parse_tagged_list(reloadable=True).
+
+        Args:
+            raw_data: The new contents of the tagged list, as accepted by
+                parse_tagged_list().
+            file_name: The name the tagged list was parsed under.
+            tags_conflict: As in parse_tagged_list().
+
+        Returns:
+            A tuple (ret, errors) as returned by parse_tagged_list(). If the
+            new contents fail to parse, the previous expectations are kept.
+
+        Raises:
+            ValueError: |file_name| was parsed without reloadable=True.
+        """
+        if file_name not in self._tagged_lists:
+            return self.parse_tagged_list(raw_data, file_name, tags_conflict,
+                                          reloadable=True)
+        state = self._tagged_lists[file_name]
+        if state is None:
+            raise ValueError('Tagged list "%s" was not parsed with '
+                             'reloadable=True' % file_name)
+        tags_conflict = tags_conflict or _default_tags_conflict
+        lines = _split_lines(raw_data)
+        old_lines = state.lines
+
+        # Narrow the change down to a single range of lines by trimming the
+        # common prefix and suffix.
+        limit = min(len(lines), len(old_lines))
+        start = 0
+        while start < limit and lines[start] == old_lines[start]:
+            start += 1
+        end = 0
+        while (end < limit - start and
+               lines[-end - 1] == old_lines[-end - 1]):
+            end += 1
+        old_end = len(old_lines) - end
+        new_end = len(lines) - end
+        if start == old_end and start == new_end:
+            return 0, ''
+
+        if (state.has_late_directives or
+                start < state.header_length or
+                start < _header_length(lines) or
+                any(_is_directive(line) for line in itertools.chain(
+                    old_lines[start:old_end], lines[start:new_end]))):
+            return self._reparse_tagged_list(lines, file_name, state,
+                                             tags_conflict)
+
+        # Parse the changed lines behind the unchanged header, so that the
+        # parser knows about the tags and results, then shift the line
+        # numbers into place.
+        header = old_lines[:state.header_length]
+        try:
+            parser = TaggedTestListParser(header + lines[start:new_end],
+                                          state.conflict_resolution,
+                                          encode_func=self._encode_func,
+                                          decode_func=self._decode_func)
+        except ParseError:
+            # Report the error with the line numbers of the whole list.
+            return self._reparse_tagged_list(lines, file_name, state,
+                                             tags_conflict)
+        for exp in parser.expectations:
+            exp.lineno += start - len(header)
+
+        # Expectations are stored in line order, so the ones that need to be
+        # replaced or renumbered can be found by bisecting.
+        first = _first_after_line(state.expectations, start)
+        last = _first_after_line(state.expectations, old_end)
+        removed = state.expectations[first:last]
+        following = state.expectations[last:]
+        delta = new_end - old_end
+        if delta:
+            for exp in following:
+                exp.lineno += delta
+        state.expectations[first:last] = parser.expectations
+        state.lines = lines
+
+        touched = set()
+        for exp in removed:
+            self._remove_expectation(exp)
+            touched.add(exp.test)
+        for exp in parser.expectations:
+            self._insert_expectation(exp, state.expectations)
+            touched.add(exp.test)
+        self._place_glob_patterns(p for p in touched if p in self.glob_exps)
+
+        errors = ''
+        if not state.conflicts_allowed:
+            self.file_name = file_name
+            errors = self._conflicts_for_patterns(
+                sorted(p for p in touched
+                       if p in self.individual_exps or p in self.glob_exps),
+                tags_conflict)
+        return (1 if errors else 0), errors
+
+    def _reparse_tagged_list(self, lines, file_name, state, tags_conflict):
+        """Replaces every expectation from |file_name| by parsing |lines|."""
+        try:
+            TaggedTestListParser(lines, state.conflict_resolution,
+                                 encode_func=self._encode_func,
+                                 decode_func=self._decode_func)
+        except ParseError as e:
+            return 1, str(e)
+        for exp in state.expectations:
+            self._remove_expectation(exp)
+        del self._tagged_lists[file_name]
+        if not self._tagged_lists:
+            # Nothing else was parsed, so the tag sets may change too.
+            self.tag_sets = set()
+        return self.parse_tagged_list(lines, file_name, tags_conflict,
+                                      state.conflict_resolution,
+                                      reloadable=True)
+
+    def _remove_expectation(self, exp):
+        """Removes |exp| itself, not just an equal Expectation."""
+        exps_by_pattern = self.glob_exps if exp.is_glob else self.individual_exps
+        exps = exps_by_pattern[exp.test]
+        for i, other in enumerate(exps):
+            if other is exp:
+                del exps[i]
+                break
+        if not exps:
+            del exps_by_pattern[exp.test]
+            # An escaped test like a\*b has the same pattern as the glob a*b,
+            # whose ReducedGlob must stay cached.
+            if exp.test not in self.glob_exps:
+                self._cached_reduced_globs.pop(exp.test, None)
+
+    def _insert_expectation(self, exp, file_exps):
+        """Adds |exp| in line order among the expectations from its file.
+
+        Args:
+            exp: The Expectation to add.
+            file_exps: The expectations parsed from the same file as |exp|,
+                in line order.
+        """
+        if exp.is_glob:
+            exps_by_pattern = self.glob_exps
+            self._maybe_cache_reduced_glob(exp.test)
+        else:
+            exps_by_pattern = self.individual_exps
+        exps = exps_by_pattern.setdefault(exp.test, [])
+        index = len(exps)
+        for i, other in enumerate(exps):
+            if _contains_expectation(file_exps, other):
+                if other.lineno > exp.lineno:
+                    index = i
+                    break
+                index = i + 1
+        exps.insert(index, exp)
+
+    def _place_glob_patterns(self, patterns):
+        """Moves |patterns| to where parse_tagged_list() would put them.
+
+        Globs are ordered by decreasing length, and globs of the same length
+        by the line of their first expectation. The other globs must already
+        be in that order.
+        """
+        def key(pattern):
+            return -len(pattern), self.glob_exps[pattern][0].lineno
+
+        moved = sorted((key(p), p) for p in patterns)
+        moved = [(k, p, self.glob_exps.pop(p)) for k, p in moved]
+        for k, pattern, exps in moved:
+            following = [p for p in self.glob_exps if key(p) > k]
+            self.glob_exps[pattern] = exps
+            for p in following:
+                self.glob_exps.move_to_end(p)
+
     def merge_test_expectations(self, other):
         # Merges another TestExpectation instance into this instance.
         # It will merge the other instance's and this instance's
@@ -800,6 +1036,107 @@ class TestExpectations(object):
         # Nothing matched, so by default, the test is expected to pass.
         return Expectation(test=test, encode_func=self._encode_func)
 
+    def expectations_for_many(self, tests):
+        """Returns the Expectations for many tests at once.
+
+        This is equivalent to calling expectations_for() on each test, but
+        is much faster for large numbers of tests. The tests are walked in
+        sorted order against a trie built from the glob patterns, so the
+        globs along a shared prefix are only matched once, and the merged
+        data for each pattern is only computed once rather than once per
+        test.
+
+        Args:
+            tests: An iterable of test names.
+
+        Returns:
+            A dict mapping each test name in |tests| to its Expectation.
+        """
+        # Each pattern's contribution only depends on the tags in effect, so
+        # compute it once up front. Only patterns that would actually end the
+        # search in expectations_for() are interesting.
+        individual_data = {}
+        for pattern, exps in self.individual_exps.items():
+            data = self._merged_data_for(exps)
+            if data is None:
+                return self._expectations_for_each(tests)
+            if data.contains_merged_data():
+                individual_data[pattern] = data
+        glob_data = []
+        for priority, (pattern, exps) in enumerate(self.glob_exps.items()):
+            data = self._merged_data_for(exps)
+            if data is None:
+                return self._expectations_for_each(tests)
+            if data.contains_merged_data():
+                glob_data.append((priority, pattern, data))
+
+        if self._full_wildcard_support:
+            # Index full wildcard globs by their leading literal text; the
+            # rest of the pattern still needs to be checked per test.
+            glob_trie = _PrefixTrie(
+                (self._cached_reduced_globs[pattern].leading_literal,
+                 (priority, self._cached_reduced_globs[pattern], data))
+                for priority, pattern, data in glob_data)
+        else:
+            glob_trie = _PrefixTrie(
+                (pattern[:-1], (priority, None, data))
+                for priority, pattern, data in glob_data)
+
+        if self._decode_func:
+            decoded = {test: self._decode_func(test) for test in tests}
+        else:
+            decoded = {test: test for test in tests}
+
+        results = {}
+        for test in sorted(decoded, key=decoded.get):
+            name = decoded[test]
+            data = individual_data.get(name)
+            if data is None:
+                # Candidates come back ordered by priority, i.e., the order
+                # in which expectations_for() would have tried them.
+                for _, reduced, glob_match in glob_trie.values_along(name):
+                    if reduced is None or reduced.matchcase(name):
+                        data = glob_match
+                        break
+            if data is None:
+                results[test] = Expectation(test=name,
+                                            encode_func=self._encode_func)
+            else:
+                results[test] = data.as_expectation(
+                    name, self._conflict_resolution, self._encode_func)
+        return results
+
+    def compact(self):
+        """Returns a CompactTestExpectations snapshot of this instance.
+
+        The snapshot answers expectations_for() exactly like this instance
+        does, but is much smaller, which makes it cheap to hand to worker
+        processes. Changes made to this instance afterwards are not
+        reflected in the snapshot.
+        """
+        return CompactTestExpectations(self)
+
+    def _expectations_for_each(self, tests):
+        return {test: self.expectations_for(test) for test in tests}
+
+    def _merged_data_for(self, exps):
+        """Merges the data for the expectations of a single pattern.
+
+        Returns:
+            A _MergedExpectationData instance, or None if merging left data
+            behind without making contains_merged_data() true. In that
+            unusual case, the data would leak into the next pattern that
+            expectations_for() looks at, so the result cannot be computed
+            independently for each pattern.
+        """
+        data = _MergedExpectationData()
+        for exp in exps:
+            self._maybe_merge_expectation_data(exp, data)
+        if (not data.contains_merged_data() and
+                data != _MergedExpectationData()):
+            return None
+        return data
+
     def _maybe_merge_expectation_data(self, exp, merged_expectation_data):
         """Helper function to conditionally merge expectation data.
 
@@ -850,22 +1187,41 @@ class TestExpectations(object):
         # expectations file may have a tag declaration set for operating systems
         # which might look like [ win linux]. A test expectation that has the
         # linux tag will not conflict with an expectation that has the win tag.
-        error_msg = ''
+        #
+        # Rather than comparing every pair of expectations against every pair
+        # of tags (which is quadratic in the number of lines for a pattern),
+        # _find_conflicting_pairs() partitions the expectations by the tags
+        # they use from each tag set, and only enumerates the pairs that
+        # survive every partitioning step. The results are identical to
+        # calling tag_sets_conflict() on every pair.
         patterns_to_exps = dict(self.individual_exps)
         patterns_to_exps.update(self.glob_exps)
-        for pattern, exps in patterns_to_exps.items():
-            conflicts_exist = False
-            for e1, e2 in itertools.combinations(exps, 2):
-                if self.tag_sets_conflict(e1.tags, e2.tags, tags_conflict_fn):
-                    if not conflicts_exist:
-                        error_msg += (
-                            '\nFound conflicts for pattern %s%s:\n' %
-                            (pattern,
-                             (' in %s' %
-                              self.file_name if self.file_name else '')))
-                    conflicts_exist = True
-                    error_msg += ('  line %d conflicts with line %d\n' %
-                                  (e1.lineno, e2.lineno))
+        return self._conflicts_for_patterns(patterns_to_exps,
+                                            tags_conflict_fn)
+
+    def _conflicts_for_patterns(self, patterns, tags_conflict_fn):
+        """Returns the conflict error message for just |patterns|."""
+        error_msg = ''
+        tag_sets = list(self.tag_sets)
+        for pattern in patterns:
+            # A pattern with an escaped wildcard can be both an individual
+            # test and a glob, in which case the glob is checked.
+            exps = self.glob_exps.get(pattern)
+            if exps is None:
+                exps = self.individual_exps[pattern]
+            if len(exps) < 2:
+                continue
+            conflicting_pairs = _find_conflicting_pairs(
+                exps, tag_sets, tags_conflict_fn)
+            if not conflicting_pairs:
+                continue
+            error_msg += (
+                '\nFound conflicts for pattern %s%s:\n' %
+                (pattern,
+                 (' in %s' % self.file_name if self.file_name else '')))
+            for i, j in conflicting_pairs:
+                error_msg += ('  line %d conflicts with line %d\n' %
+                              (exps[i].lineno, exps[j].lineno))
         return error_msg
 
     def check_for_broken_expectations(self, test_names):
@@ -940,16 +1296,461 @@ class TestExpectations(object):
         """
         assert self._full_wildcard_support
 
+        used_globs = reduced_glob.globs_matching_any(
+            (self._cached_reduced_globs[pattern] for pattern in self.glob_exps),
+            test_names)
         broken_glob_exps = []
         for pattern, exps in self.glob_exps.items():
-            for test in test_names:
-                if self._cached_reduced_globs[pattern].matchcase(test):
-                    break
-            else:
+            if self._cached_reduced_globs[pattern] not in used_globs:
                 broken_glob_exps.extend(exps)
         return broken_glob_exps
 
 
+class CompactTestExpectations(object):
+    """A compact, read-only lookup table built from a TestExpectations.
+
+    Every Expectation is reduced to a small tuple in which its tags and
+    results are packed into bitmasks, and identical tuples are only stored
+    once. Patterns refer to their expectations by index. Raw strings and
+    line numbers are dropped, so this is much cheaper to hand to worker
+    processes than the TestExpectations it was built from, while
+    expectations_for() returns the same Expectations.
+
+    The tags in effect can still be changed with set_tags() and add_tags().
+    """
+
+    _RETRY_ON_FAILURE = 1
+    _SLOW = 2
+    _DEFAULT_PASS = 4
+    _OVERRIDE = 8
+
+    def __init__(self, test_expectations):
+        """Args:
+            test_expectations: The TestExpectations instance to snapshot.
+        """
+        exps = test_expectations
+        self.tag_sets = set(exps.tag_sets)
+        self.ignored_tags = set(exps.ignored_tags)
+        self._full_wildcard_support = exps._full_wildcard_support
+        self._conflict_resolution = exps._conflict_resolution
+        self._encode_func = exps._encode_func
+        self._decode_func = exps._decode_func
+
+        all_exps = [exp for pattern_exps in itertools.chain(
+                        exps.individual_exps.values(), exps.glob_exps.values())
+                    for exp in pattern_exps]
+        self._result_types = tuple(sorted(
+            {r for exp in all_exps for r in exp.results}))
+        self._tag_names = tuple(sorted(
+            {t for exp in all_exps for t in exp.tags}))
+        self._tag_bits = {t: 1 << i for i, t in enumerate(self._tag_names)}
+        result_bits = {r: 1 << i for i, r in enumerate(self._result_types)}
+
+        entry_indices = {}
+        self._entries = []
+
+        def _indices_for(pattern_exps):
+            indices = []
+            for exp in pattern_exps:
+                flags = (
+                    (self._RETRY_ON_FAILURE if exp.should_retry_on_failure
+                     else 0) |
+                    (self._SLOW if exp.is_slow_test else 0) |
+                    (self._DEFAULT_PASS if exp.is_default_pass else 0) |
+                    (self._OVERRIDE if exp.conflict_resolution !=
+                     ConflictResolutionTypes.UNION else 0))
+                entry = (sum(self._tag_bits[t] for t in exp.tags),
+                         sum(result_bits[r] for r in exp.results),
+                         flags, exp.reason, exp.trailing_comments)
+                index = entry_indices.setdefault(entry, len(self._entries))
+                if index == len(self._entries):
+                    self._entries.append(entry)
+                indices.append(index)
+            return tuple(indices)
+
+        self._exact = {pattern: _indices_for(pattern_exps)
+                       for pattern, pattern_exps in exps.individual_exps.items()}
+        self._globs = []
+        for pattern, pattern_exps in exps.glob_exps.items():
+            if self._full_wildcard_support:
+                glob = exps._cached_reduced_globs[pattern]
+            else:
+                glob = pattern[:-1]
+            self._globs.append((glob, _indices_for(pattern_exps)))
+        self._entries = tuple(self._entries)
+        self._globs = tuple(self._globs)
+        self._tags = exps.tags
+        self._tags_mask = self._mask_for_tags(self._tags)
+
+    def set_tags(self, tags, raise_ex_for_bad_tags=False):
+        _validate_condition_tags(self.tag_sets, self.ignored_tags, tags,
+                                 raise_ex_for_bad_tags)
+        self._tags = [tag.lower() for tag in tags]
+        self._tags_mask = self._mask_for_tags(self._tags)
+
+    def add_tags(self, new_tags, raise_ex_for_bad_tags=False):
+        _validate_condition_tags(self.tag_sets, self.ignored_tags, new_tags,
+                                 raise_ex_for_bad_tags)
+        self._tags = list(
+            set(self._tags) | set([tag.lower() for tag in new_tags]))
+        self._tags_mask = self._mask_for_tags(self._tags)
+
+    @property
+    def tags(self):
+        return self._tags[:]
+
+    def _mask_for_tags(self, tags):
+        return sum(self._tag_bits.get(t, 0) for t in set(tags))
+
+    def expectations_for(self, test):
+        """Returns the Expectation for |test|.
+
+        The result is equal to what TestExpectations.expectations_for()
+        returns for the same test and tags.
+        """
+        if self._decode_func:
+            test = self._decode_func(test)
+        merged_expectation_data = _MergedExpectationData()
+
+        self._merge_entries(self._exact.get(test, ()), merged_expectation_data)
+        if merged_expectation_data.contains_merged_data():
+            return merged_expectation_data.as_expectation(
+                test, self._conflict_resolution, self._encode_func)
+
+        # The globs are ordered from most to least specific.
+        for glob, indices in self._globs:
+            if self._full_wildcard_support:
+                matched = glob.matchcase(test)
+            else:
+                matched = test.startswith(glob)
+            if matched:
+                self._merge_entries(indices, merged_expectation_data)
+                if merged_expectation_data.contains_merged_data():
+                    return merged_expectation_data.as_expectation(
+                        test, self._conflict_resolution, self._encode_func)
+
+        return Expectation(test=test, encode_func=self._encode_func)
+
+    def _merge_entries(self, indices, merged_expectation_data):
+        """Merges the entries at |indices| that apply to the current tags.
+
+        This mirrors TestExpectations._maybe_merge_expectation_data().
+        """
+        tags_mask = self._tags_mask
+        for index in indices:
+            (entry_tags, entry_results, flags, reason,
+             trailing_comments) = self._entries[index]
+            if entry_tags & ~tags_mask:
+                continue
+            results = self._unpack(entry_results, self._result_types)
+            tags = self._unpack(entry_tags, self._tag_names)
+            retry_on_failure = bool(flags & self._RETRY_ON_FAILURE)
+            is_slow_test = bool(flags & self._SLOW)
+            if not flags & self._OVERRIDE:
+                if not flags & self._DEFAULT_PASS:
+                    merged_expectation_data.results.update(results)
+                merged_expectation_data.should_retry_on_failure |= (
+                    retry_on_failure)
+                merged_expectation_data.is_slow_test |= is_slow_test
+                merged_expectation_data.exp_tags.update(tags)
+                if trailing_comments:
+                    merged_expectation_data.trailing_comments += (
+                        trailing_comments + '\n')
+                if reason:
+                    merged_expectation_data.reasons.update([reason])
+            else:
+                merged_expectation_data.results = results
+                merged_expectation_data.should_retry_on_failure = (
+                    retry_on_failure)
+                merged_expectation_data.is_slow_test = is_slow_test
+                merged_expectation_data.exp_tags = tags
+                merged_expectation_data.trailing_comments = trailing_comments
+                if reason:
+                    merged_expectation_data.reasons = {reason}
+
+    @staticmethod
+    def _unpack(mask, names):
+        return {name for i, name in enumerate(names) if mask >> i & 1}
+
+
+def _validate_condition_tags(tag_sets, ignored_tags, tags,
+                              raise_ex_for_bad_tags):
+    # This function will be used to validate if each tag in the tags list
+    # is declared in a test expectations file. This validation will make
+    # sure that the tags written in the test expectations files match tags
+    # that are generated by the test runner.
+    def _pluralize_unknown(missing):
+        if len(missing) > 1:
+            return ('s %s and %s are' % (', '.join(missing[:-1]),
+                                         missing[-1]),
+                    'have', 's are')
+        else:
+            return (' %s is' % missing[0], 'has', ' is')
+    tags = set(t.lower() for t in tags)
+    unknown_tags = set()
+    if tag_sets:
+        known_and_ignored_tags = set().union(
+            *tag_sets).union(ignored_tags)
+        unknown_tags = tags - known_and_ignored_tags
+    if unknown_tags:
+        msg = (
+            'Tag%s not declared in the expectations file and %s not been '
+            'explicitly ignored by the test. There may have been a typo in '
+            'the expectations file. Please make sure the aforementioned '
+            'tag%s declared at the top of the expectations file.' %
+            _pluralize_unknown(sorted(unknown_tags)))
+        if raise_ex_for_bad_tags:
+            raise ValueError(msg)
+        else:
+            logging.warning(msg)
+
+
+@dataclasses.dataclass
+class _TaggedListState:
+    """What TestExpectations remembers about a parsed tagged list."""
+    lines: list
+    expectations: list
+    conflict_resolution: int  # A ConflictResolutionTypes value.
+    conflicts_allowed: bool
+    header_length: int
+    has_late_directives: bool
+
+
+_DIRECTIVE_TOKENS = (
+    TaggedTestListParser.TAG_TOKEN,
+    TaggedTestListParser.RESULT_TOKEN,
+    TaggedTestListParser.CONFLICTS_ALLOWED,
+    TaggedTestListParser.CONFLICT_RESOLUTION,
+    TaggedTestListParser.FULL_WILDCARD_SUPPORT,
+)
+
+
+_BUG_MATCHER = re.compile(
+    TaggedTestListParser.BUG_PREFIX_REGEX + r'(?:[^/]*/)?\d+')
+
+
+def _split_canonical_expectation_line(line):
+    """Splits an expectation line without using TaggedTestListParser.MATCHER.
+
+    Almost every line is written in the canonical form, with single spaces
+    and no trailing comment, which can be split faster than it can be
+    matched. This only handles lines in that form that MATCHER would split
+    the same way.
+
+    Returns:
+        The same tuple as
+        TaggedTestListParser._parse_expectation_line_into_components(), or
+        None if |line| has to be matched instead.
+    """
+    if '#' in line or '  ' in line or '\t' in line:
+        return None
+    head, sep, raw_results = line.rpartition(' [ ')
+    if not sep or not raw_results.endswith(' ]'):
+        return None
+    raw_results = raw_results[:-2]
+    if (not raw_results or '[' in raw_results or ']' in raw_results or
+            '.' in raw_results):
+        return None
+    prefix, _, test = head.rpartition(' ')
+    if '[' in test or ']' in test:
+        return None
+    raw_tags = None
+    if prefix.endswith(' ]') or prefix == ']':
+        prefix, sep, raw_tags = prefix.partition('[ ')
+        raw_tags = raw_tags[:-2]
+        if (not sep or not raw_tags or '[' in raw_tags or ']' in raw_tags or
+                (prefix and prefix[-1] != ' ')):
+            return None
+        prefix = prefix[:-1]
+    if not prefix:
+        return None, raw_tags, test, raw_results, None
+    # MATCHER does not always capture all of several bugs, so leave those
+    # lines to it.
+    if ' ' in prefix or not _BUG_MATCHER.fullmatch(prefix):
+        return None
+    return prefix, raw_tags, test, raw_results, None
+
+
+def _split_lines(raw_data):
+    """Returns |raw_data| as a list of lines without line endings."""
+    if isinstance(raw_data, str):
+        return raw_data.splitlines()
+    return [line.rstrip('\r\n') for line in raw_data]
+
+
+def _first_after_line(exps, lineno):
+    """Returns the index of the first of |exps| after line |lineno|.
+
+    Args:
+        exps: A list of Expectations in line order.
+        lineno: A line number.
+    """
+    lo, hi = 0, len(exps)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if exps[mid].lineno <= lineno:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _contains_expectation(exps, exp):
+    """Whether |exp| itself is in |exps|, a list in line order."""
+    i = _first_after_line(exps, exp.lineno - 1)
+    while i < len(exps) and exps[i].lineno == exp.lineno:
+        if exps[i] is exp:
+            return True
+        i += 1
+    return False
+
+
+def _is_directive(line):
+    return line.strip().startswith(_DIRECTIVE_TOKENS)
+
+
+def _header_length(lines):
+    """Returns the number of lines before the first expectation."""
+    for i, line in enumerate(lines):
+        line = line.strip()
+        if line and line[0] != '#':
+            return i
+    return len(lines)
+
+
+def _numbered_lines(lines, pending):
+    """Yields (lineno, stripped line) tuples for |lines|.
+
+    Any (lineno, line) tuples added to |pending| while iterating are yielded
+    before the next line from |lines|.
+    """
+    for lineno, line in enumerate(lines, 1):
+        while pending:
+            yield pending.popleft()
+        yield lineno, line.strip()
+    while pending:
+        yield pending.popleft()
+
+
+def _find_conflicting_pairs(exps, tag_sets, tags_conflict_fn):
+    """Finds all pairs of expectations that conflict with each other.
+
+    Two expectations for the same pattern are in conflict (i.e., they could
+    both apply to the same test run) unless some tag set contains a tag from
+    each of them that |tags_conflict_fn| says are mutually exclusive. This
+    is the same check as TestExpectations.tag_sets_conflict(), but instead of
+    being applied to every pair, the expectations are repeatedly partitioned
+    by the tags they use from each tag set. Each candidate is either a single
+    group (all pairs within it are candidates) or a cross between two groups
+    (all pairs with one member from each are candidates); a tag set can only
+    ever shrink the candidates, so groups that are known to be distinguished
+    are dropped without looking at their members pairwise.
+
+    Args:
+        exps: A list of Expectation instances for a single pattern.
+        tag_sets: An iterable of sets of tags, as in
+            TestExpectations.tag_sets.
+        tags_conflict_fn: A function taking two tags and returning whether
+            they are mutually exclusive.
+
+    Returns:
+        A sorted list of (i, j) tuples with i < j, where exps[i] and exps[j]
+        conflict. This is the same order itertools.combinations() produces.
+    """
+    conflict_cache = {}
+
+    def keys_conflict(k1, k2):
+        # Whether the tags two expectations use from a single tag set
+        # distinguish them, i.e. whether they can never both apply.
+        if (k1, k2) not in conflict_cache:
+            conflict_cache[(k1, k2)] = any(
+                tags_conflict_fn(t1, t2) for t1, t2 in itertools.product(
+                    k1, k2))
+        return conflict_cache[(k1, k2)]
+
+    def split(group, tag_set):
+        buckets = OrderedDict()
+        for i in group:
+            buckets.setdefault(exps[i].tags & tag_set, []).append(i)
+        return list(buckets.items())
+
+    # Each candidate is a tuple of (group,) or (group, other_group).
+    candidates = [(list(range(len(exps))),)]
+    for tag_set in tag_sets:
+        new_candidates = []
+        for candidate in candidates:
+            if len(candidate) == 1:
+                buckets = split(candidate[0], tag_set)
+                for n, (k1, g1) in enumerate(buckets):
+                    if len(g1) > 1 and not keys_conflict(k1, k1):
+                        new_candidates.append((g1,))
+                    for k2, g2 in buckets[n + 1:]:
+                        if not keys_conflict(k1, k2):
+                            new_candidates.append((g1, g2))
+            else:
+                buckets2 = split(candidate[1], tag_set)
+                for k1, g1 in split(candidate[0], tag_set):
+                    for k2, g2 in buckets2:
+                        if not keys_conflict(k1, k2):
+                            new_candidates.append((g1, g2))
+        candidates = new_candidates
+        if not candidates:
+            return []
+
+    pairs = []
+    for candidate in candidates:
+        if len(candidate) == 1:
+            pairs.extend(itertools.combinations(candidate[0], 2))
+        else:
+            pairs.extend((min(i, j), max(i, j))
+                         for i, j in itertools.product(*candidate))
+    return sorted(pairs)
+
+
+class _PrefixTrie:
+    """A trie used to find the values stored for every prefix of a string.
+
+    values_along() is meant to be called with strings in sorted order. The
+    walk for the previous string is kept, so only the characters past the
+    prefix it shares with the current string need to be walked again.
+    """
+
+    def __init__(self, items):
+        """Args:
+            items: An iterable of (prefix, value) tuples. Each value must be
+                a tuple whose first element is a sortable priority.
+        """
+        self._root = ({}, [])
+        for prefix, value in items:
+            node = self._root
+            for c in prefix:
+                node = node[0].setdefault(c, ({}, []))
+            node[1].append(value)
+        self._last = ''
+        self._path = [(self._root, sorted(self._root[1], key=lambda v: v[0]))]
+
+    def values_along(self, s):
+        """Returns the values of all prefixes of |s|, ordered by priority."""
+        # self._path[i] holds the node for self._last[:i] along with all of
+        # the values seen on the way to it.
+        common = 0
+        limit = min(len(s), len(self._path) - 1)
+        while common < limit and s[common] == self._last[common]:
+            common += 1
+        del self._path[common + 1:]
+        self._last = s
+
+        node, values = self._path[-1]
+        for c in s[common:]:
+            node = node[0].get(c)
+            if node is None:
+                break
+            if node[1]:
+                values = sorted(values + node[1], key=lambda v: v[0])
+            self._path.append((node, values))
+        return self._path[-1][1]
+
+
 @dataclasses.dataclass
 class _MergedExpectationData:
     """Helper dataclass used to store/pass information in expectations_for."""
@@ -0,0 +1,264 @@
+# Copyright 2025 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Updates an expectations file based on the results of test runs.
+
+Given one or more full results files (in the JSON test results format) and
+the TestExpectations parsed from an expectations file, this computes the
+lines that need to be added or changed to cover unexpected failures, and the
+stale lines that no longer apply to any test, then writes the file back with
+every untouched line, including comments, kept as is.
+"""
+
+import dataclasses
+import itertools
+
+from typ import expectations_parser
+from typ import json_results
+from typ.expectations_parser import Expectation
+from typ.json_results import ResultType
+
+
+_FAILURE_TYPES = frozenset(
+    [ResultType.Failure, ResultType.Crash, ResultType.Timeout])
+# pylint: disable=protected-access
+_RETRY_ON_FAILURE_TAG = expectations_parser._RETRY_ON_FAILURE_TAG
+
+
+@dataclasses.dataclass
+class ExpectationsUpdate:
+    """The changes needed to bring an expectations file up to date.
+
+    Attributes:
+        added: A list of new Expectations, to be appended to the file.
+        replaced: A dict mapping line numbers to the Expectations that should
+            replace the lines currently there.
+        removed: A list of stale Expectations whose lines should be deleted.
+    """
+    added: list = dataclasses.field(default_factory=list)
+    replaced: dict = dataclasses.field(default_factory=dict)
+    removed: list = dataclasses.field(default_factory=list)
+
+    def is_empty(self):
+        return not (self.added or self.replaced or self.removed)
+
+
+def compute_update(expectations, full_results_list, reason='',
+                   remove_stale=True, raw_data=None):
+    """Computes the changes needed to cover the given results.
+
+    A test that failed unexpectedly on every run gets a Failure expectation,
+    and one that failed unexpectedly but passed on a retry gets a
+    RetryOnFailure expectation. The new expectations use the tags from the
+    metadata of the full results the test came from, limited to the tags
+    declared in the expectations file. If there is already a line for the
+    test with exactly those tags, that line is updated instead of adding a
+    new one.
+
+    Args:
+        expectations: A TestExpectations instance parsed from the file that
+            should be updated.
+        full_results_list: A list of full results dicts, as written to
+            full_results.json.
+        reason: A string, usually a bug, to use as the reason of new lines.
+        remove_stale: Whether lines that do not apply to any test found in
+            |full_results_list| should be removed. This should only be used
+            if the results cover every test the expectations are for.
+        raw_data: A string containing the contents |expectations| was parsed
+            from. If given, the tags of new lines are spelled the way its
+            header declares them rather than lowercased.
+
+    Returns:
+        An ExpectationsUpdate instance.
+    """
+    # pylint: disable=protected-access
+    decode_func = expectations._decode_func
+    encode_func = expectations._encode_func
+    declared_tags = set().union(*expectations.tag_sets)
+    tag_spellings = {}
+    if raw_data is not None:
+        tag_spellings = _parse_header(raw_data.splitlines())._tag_spellings
+
+    # Maps (test, tags) to [results, should_retry_on_failure].
+    needed = {}
+    all_test_names = set()
+    for full_results in full_results_list:
+        tags = frozenset(
+            t.lower() for t in full_results.get('metadata', {}).get('tags', [])
+            if t.lower() in declared_tags)
+        for test, result in json_results.iterate_over_trie(
+                full_results['tests'], full_results['path_delimiter'], ''):
+            all_test_names.add(test)
+            # Any expected failure type is taken to cover the others, since
+            # only Failure expectations are added.
+            actual = set(result['actual'].split())
+            if (not actual & _FAILURE_TYPES or
+                    set(result['expected'].split()) & _FAILURE_TYPES):
+                continue
+            if decode_func:
+                test = decode_func(test)
+            entry = needed.setdefault((test, tags), [set(), False])
+            if ResultType.Pass in actual:
+                entry[1] = True
+            else:
+                entry[0].add(ResultType.Failure)
+
+    update = ExpectationsUpdate()
+    for (test, tags), (results, retry_on_failure) in sorted(
+            needed.items(), key=lambda item: (item[0][0], sorted(item[0][1]))):
+        existing = None
+        for exp in expectations.individual_exps.get(test, []):
+            if exp.tags == tags:
+                existing = exp
+                break
+        if existing is None:
+            update.added.append(_new_expectation(
+                test, tags, results, retry_on_failure, reason, encode_func,
+                tag_spellings))
+        else:
+            replacement = _updated_expectation(
+                existing, results, retry_on_failure, encode_func)
+            if replacement is not None:
+                update.replaced[existing.lineno] = replacement
+
+    if remove_stale:
+        update.removed = sorted(
+            expectations.check_for_broken_expectations(all_test_names),
+            key=lambda exp: exp.lineno)
+    return update
+
+
+def apply_update(raw_data, update):
+    """Applies |update| to the contents of an expectations file.
+
+    Results used by the new or replaced lines that the header does not
+    declare yet are added to its "# results:" line.
+
+    Args:
+        raw_data: A string containing the contents the TestExpectations passed
+            to compute_update() was parsed from.
+        update: An ExpectationsUpdate instance.
+
+    Returns:
+        A string containing the updated contents.
+    """
+    lines = raw_data.splitlines()
+    # pylint: disable=protected-access
+    undeclared = sorted(
+        {r for exp in itertools.chain(update.added, update.replaced.values())
+         for r in exp.raw_results} - _parse_header(lines)._allowed_results)
+    removed_linenos = {exp.lineno for exp in update.removed}
+    new_lines = []
+    for lineno, line in enumerate(lines, 1):
+        if lineno in removed_linenos:
+            continue
+        replacement = update.replaced.get(lineno)
+        new_lines.append(line if replacement is None
+                         else replacement.to_string())
+    new_lines.extend(exp.to_string() for exp in update.added)
+    if undeclared:
+        _declare_results(new_lines, undeclared)
+    contents = '\n'.join(new_lines)
+    if new_lines and (raw_data.endswith('\n') or update.added):
+        contents += '\n'
+    return contents
+
+
+def update_expectations_file(host, expectations_path, full_results_paths,
+                             reason='', remove_stale=True):
+    """Updates an expectations file in place from full results files.
+
+    Args:
+        host: A Host instance used to read and write files.
+        expectations_path: The path to the expectations file to update.
+        full_results_paths: A list of paths to full results files.
+        reason: As in compute_update().
+        remove_stale: As in compute_update().
+
+    Returns:
+        A tuple (ret, errors, update). |ret| and |errors| are as returned by
+        TestExpectations.parse_tagged_list() for the current contents of the
+        file or, if those parse, for the updated ones. If |ret| is non-zero
+        the file is left alone. |update| is the applied ExpectationsUpdate,
+        or None.
+    """
+    raw_data = host.read_text_file(expectations_path)
+    expectations = expectations_parser.TestExpectations()
+    ret, errors = expectations.parse_tagged_list(raw_data, expectations_path)
+    if ret:
+        return ret, errors, None
+    full_results_list = [json_results.read_json_file(host, path)
+                         for path in full_results_paths]
+    update = compute_update(expectations, full_results_list, reason,
+                            remove_stale, raw_data)
+    if not update.is_empty():
+        contents = apply_update(raw_data, update)
+        # Never write a file that can no longer be parsed.
+        ret, errors = expectations_parser.TestExpectations().parse_tagged_list(
+            contents, expectations_path)
+        if ret:
+            return ret, errors, None
+        host.write_text_file(expectations_path, contents)
+    return 0, '', update
+
+
+def _parse_header(lines):
+    """Returns a TaggedTestListParser for the header of |lines|."""
+    # pylint: disable=protected-access
+    return expectations_parser.TaggedTestListParser(
+        lines[:expectations_parser._header_length(lines)])
+
+
+def _declare_results(lines, results):
+    """Adds |results| to the results declared in the header of |lines|."""
+    token = expectations_parser.TaggedTestListParser.RESULT_TOKEN
+    # pylint: disable=protected-access
+    header_length = expectations_parser._header_length(lines)
+    for i in range(header_length):
+        if lines[i].lstrip().startswith(token):
+            # The declaration may continue on the following lines.
+            end = i
+            while ']' not in lines[end]:
+                end += 1
+            bracket = lines[end].rfind(']')
+            lines[end] = '%s %s %s' % (lines[end][:bracket].rstrip(),
+                                       ' '.join(results),
+                                       lines[end][bracket:])
+            return
+    lines.insert(header_length, '%s %s ]' % (token, ' '.join(results)))
+
+
+def _new_expectation(test, tags, results, retry_on_failure, reason,
+                     encode_func, tag_spellings):
+    raw_results = [expectations_parser.RESULT_TAGS[r] for r in results]
+    if retry_on_failure:
+        raw_results.append(_RETRY_ON_FAILURE_TAG)
+    return Expectation(
+        reason=reason, test=test, tags=tags, results=results,
+        retry_on_failure=retry_on_failure,
+        raw_tags=[tag_spellings.get(t, t) for t in sorted(tags)],
+        raw_results=sorted(raw_results),
+        encode_func=encode_func)
+
+
+def _updated_expectation(exp, results, retry_on_failure, encode_func):
+    """Returns |exp| extended with the given results, or None if unneeded."""
+    # A default pass expectation (e.g. just RetryOnFailure) does not actually
+    # expect a Pass, so its results should not be carried over.
+    old_results = set() if exp.is_default_pass else set(exp.results)
+    if (results <= old_results and
+            (exp.should_retry_on_failure or not retry_on_failure)):
+        return None
+    raw_results = set(exp.raw_results)
+    raw_results.update(expectations_parser.RESULT_TAGS[r] for r in results)
+    if retry_on_failure:
+        raw_results.add(_RETRY_ON_FAILURE_TAG)
+    return Expectation(
+        reason=exp.reason, test=exp.test, tags=exp.tags,
+        results=old_results | results, lineno=exp.lineno,
+        retry_on_failure=exp.should_retry_on_failure or retry_on_failure,
+        is_slow_test=exp.is_slow_test,
+        conflict_resolution=exp.conflict_resolution,
+        raw_tags=exp.raw_tags, raw_results=sorted(raw_results),
+        trailing_comments=exp.trailing_comments, encode_func=encode_func)
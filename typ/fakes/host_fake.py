@@ -17,7 +17,7 @@ import io
 import logging
 import sys
 
-from typ.host import _TeedStream
+from typ.host import _TeedStream, _discard_full_output
 
 
 class FakeHost(object):
@@ -46,6 +46,7 @@ class FakeHost(object):
         self.cmds = []
         self.cwd = '/tmp'
         self._orig_logging_handlers = []
+        self.full_output = (None, None)
 
     def __getstate__(self):
         d = copy.copy(self.__dict__)
@@ -177,6 +178,16 @@ class FakeHost(object):
     def mtime(self, *comps):
         return self.mtimes.get(self.join(*comps), 0)
 
+    def open(self, path, mode='r'):
+        full_path = self.abspath(path)
+        if 'w' not in mode:
+            contents = self.files[full_path]
+            return io.BytesIO(contents) if 'b' in mode else io.StringIO(
+                contents)
+        self.maybe_make_directory(self.dirname(full_path))
+        stream_class = _FakeBinaryFile if 'b' in mode else _FakeTextFile
+        return stream_class(lambda contents: self._write(full_path, contents))
+
     def print_(self, msg='', end='\n', stream=None):
         stream = stream or self.stdout
         message = msg + end
@@ -206,6 +217,12 @@ class FakeHost(object):
         self.files[path] = None
         self.written_files[path] = None
 
+    def replace(self, src, dst):
+        src = self.abspath(src)
+        contents = self.files[src]
+        self.remove(src)
+        self._write(dst, contents)
+
     def rmtree(self, *comps):
         path = self.abspath(*comps)
         for f in self.files:
@@ -263,17 +280,22 @@ class FakeHost(object):
             sys.stdout = self.stdout
             sys.stderr = self.stderr
 
-    def capture_output(self, divert=True):
+    def capture_output(self, divert=True, debugger=False, fds=False,
+                       limit=None):
+        _discard_full_output(self.full_output)
+        self.full_output = (None, None)
         self._tap_output()
         self._orig_logging_handlers = self.logger.handlers
         if self._orig_logging_handlers:
             self.logger.handlers = [logging.StreamHandler(self.stderr)]
-        self.stdout.capture(divert=divert)
-        self.stderr.capture(divert=divert)
+        self.stdout.capture(divert=divert, limit=limit)
+        self.stderr.capture(divert=divert, limit=limit)
 
-    def restore_output(self):
+    def restore_output(self, max_inline=None):
         assert isinstance(self.stdout, _TeedStream)
         out, err = (self.stdout.restore(), self.stderr.restore())
+        self.full_output = (self.stdout.full_output,
+                            self.stderr.full_output)
         if isinstance(out, bytes):
             out = out.decode('utf-8')
         if isinstance(err, bytes):
@@ -283,6 +305,34 @@ class FakeHost(object):
         return out, err
 
 
+class _FakeBinaryFile(io.BytesIO):
+    """A binary file opened for writing that is stored in a FakeHost on close.
+    """
+
+    def __init__(self, on_close):
+        super().__init__()
+        self._on_close = on_close
+
+    def close(self):
+        if not self.closed:
+            self._on_close(self.getvalue())
+        super().close()
+
+
+class _FakeTextFile(io.StringIO):
+    """A text file opened for writing that is stored in a FakeHost on close.
+    """
+
+    def __init__(self, on_close):
+        super().__init__()
+        self._on_close = on_close
+
+    def close(self):
+        if not self.closed:
+            self._on_close(self.getvalue())
+        super().close()
+
+
 class FakeResponse(io.StringIO):
 
     def __init__(self, response, url, code=200):
@@ -13,7 +13,9 @@
 # limitations under the License.
 
 import sys
+import unittest
 
+from typ.host import OutputLimit
 from typ.tests import host_test
 from typ.fakes.host_fake import FakeHost, FakeResponse
 
@@ -80,6 +82,48 @@ class TestFakeHost(host_test.TestHost):
         sys.stdout = orig_stdout
         sys.stderr = orig_stderr
 
+    def test_capture_output_fds(self):
+        # FakeHost has no file descriptors to capture, so fds=True just
+        # captures the streams.
+        orig_stdout = sys.stdout
+        orig_stderr = sys.stderr
+        try:
+            h = self.host()
+            h.capture_output(fds=True)
+            h.print_('on stdout')
+            out, err = h.restore_output(max_inline=1)
+            self.assertEqual(out, 'on stdout\n')
+            self.assertEqual(err, '')
+        finally:
+            sys.stdout = orig_stdout
+            sys.stderr = orig_stderr
+
+    @unittest.skip('FakeHost never spills captured output to a file')
+    def test_capture_output_fds_spills_large_output(self):
+        pass
+
+    def test_capture_output_fds_with_limit(self):
+        # The limit applies to the captured streams just like it does to
+        # captured file descriptors.
+        orig_stdout = sys.stdout
+        orig_stderr = sys.stderr
+        try:
+            h = self.host()
+            h.capture_output(fds=True, limit=OutputLimit(head=3, tail=3,
+                                                         keep_full=True))
+            h.print_('native stdout')
+            h.print_('err', end='', stream=h.stderr)
+            out, err = h.restore_output()
+        finally:
+            sys.stdout = orig_stdout
+            sys.stderr = orig_stderr
+        self.assertEqual(out, 'nat\n[... 8 bytes of output omitted ...]\n'
+                              'ut\n')
+        self.assertEqual(err, 'err')
+        full_out, full_err = h.full_output
+        self.assertIsNone(full_err)
+        self.assertEqual(full_out.read(), 'native stdout\n')
+
     def test_for_mp(self):
         h = self.host()
         self.assertNotEqual(h.for_mp(), None)
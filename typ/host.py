@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import io
 import logging
 import multiprocessing
@@ -24,6 +25,8 @@ import tempfile
 import time
 from urllib.request import urlopen, Request  # pylint: disable=F0401,E0611
 
+from typ.spilled_text import SpilledText
+
 
 class Host(object):
     python_interpreter = sys.executable
@@ -37,6 +40,9 @@ class Host(object):
     def __init__(self):
         self.logger = logging.getLogger()
         self._orig_logging_handlers = None
+        self._fd_captures = None
+        self._output_limit = None
+        self.full_output = (None, None)
         self.stdout = sys.stdout
         self.stderr = sys.stderr
         self.stdin = sys.stdin
@@ -137,6 +143,11 @@ class Host(object):
     def mtime(self, *comps):
         return os.stat(self.join(*comps)).st_mtime
 
+    def open(self, path, mode='r'):
+        if 'b' in mode:
+            return open(path, mode)
+        return open(path, mode, encoding='utf-8')
+
     def print_(self, msg='', end='\n', stream=None):
         stream = stream or self.stdout
         message = str(msg) + end
@@ -166,6 +177,9 @@ class Host(object):
     def remove(self, *comps):
         os.remove(self.join(*comps))
 
+    def replace(self, src, dst):
+        os.replace(src, dst)
+
     def rmtree(self, path):
         shutil.rmtree(path, ignore_errors=True)
 
@@ -176,7 +190,18 @@ class Host(object):
         return time.time()
 
     def append_text_file(self, path, content):
-        return self._write(path, content, mode='a')
+        # Append everything with a single write() to an O_APPEND descriptor,
+        # so that the content appended by several processes at once doesn't
+        # get interleaved.
+        if os.linesep != '\n':  # pragma: win32
+            content = content.replace('\n', os.linesep)
+        data = content.encode('utf-8')
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        try:
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
 
     def write_text_file(self, path, contents):
         return self._write(path, contents, mode='w')
@@ -190,7 +215,9 @@ class Host(object):
 
     def fetch(self, url, data=None, headers=None):
         headers = headers or {}
-        return urlopen(Request(url, data.encode('utf8'), headers))
+        if isinstance(data, str):
+            data = data.encode('utf8')
+        return urlopen(Request(url, data, headers))
 
     def terminal_width(self):
         """Returns 0 if the width cannot be determined."""
@@ -240,17 +267,59 @@ class Host(object):
         self.stdout = sys.stdout = pdb.sys.stdout = self.stdout.stream
         self.stderr = sys.stderr = self.stderr.stream
 
-    def capture_output(self, divert=True, debugger=False):
+    def capture_output(self, divert=True, debugger=False, fds=False,
+                       limit=None):
+        """Starts capturing stdout and stderr.
+
+        Args:
+            divert: Whether the output should only be captured, rather than
+                also being passed through to the original streams.
+            debugger: Whether the debugger will be used while capturing.
+            fds: Whether to capture at the file descriptor level, by pointing
+                the stdout and stderr file descriptors at temporary files.
+                This also captures output from native code and subprocesses,
+                and does not hold the output in memory. Only used if
+                |divert| is set, |debugger| is not, and the streams have
+                file descriptors.
+            limit: An optional OutputLimit bounding how much of each stream
+                is kept.
+        """
+        _discard_full_output(self.full_output)
+        self.full_output = (None, None)
+        self._output_limit = limit
+        if (fds and divert and not debugger and
+                _fileno(self.stdout) is not None and
+                _fileno(self.stderr) is not None):
+            self._capture_fds()
+            return
         self._tap_output(debugger=debugger)
         self._orig_logging_handlers = self.logger.handlers
         if self._orig_logging_handlers:
             self.logger.handlers = [logging.StreamHandler(self.stderr)]
-        self.stdout.capture(divert)
-        self.stderr.capture(divert)
-
-    def restore_output(self):
+        self.stdout.capture(divert, limit)
+        self.stderr.capture(divert, limit)
+
+    def restore_output(self, max_inline=None):
+        """Stops capturing stdout and stderr.
+
+        Args:
+            max_inline: If output was captured at the file descriptor level
+                and is larger than this many bytes, it is returned as a
+                SpilledText referring to the capture file rather than as a
+                string. By default, strings are always returned.
+
+        Returns:
+            A tuple (out, err) of the captured output. If a stream was
+            truncated because of the OutputLimit passed to capture_output()
+            and the limit keeps the full output, |self.full_output| holds a
+            SpilledText with all of it, and None otherwise.
+        """
+        if self._fd_captures is not None:
+            return self._restore_fds(max_inline)
         assert isinstance(self.stdout, _TeedStream)
         out, err = (self.stdout.restore(), self.stderr.restore())
+        self.full_output = (self.stdout.full_output,
+                            self.stderr.full_output)
         if isinstance(out, bytes):
             out = out.decode('utf-8')
         if isinstance(err, bytes):
@@ -259,6 +328,112 @@ class Host(object):
         self._untap_output()
         return out, err
 
+    def _capture_fds(self):
+        self._flush_output()
+        self._orig_logging_handlers = self.logger.handlers
+        if self._orig_logging_handlers:
+            self.logger.handlers = [logging.StreamHandler(self.stderr)]
+        self._fd_captures = []
+        for stream in (self.stdout, self.stderr):
+            fd = _fileno(stream)
+            capture_fd, path = tempfile.mkstemp(prefix='typ-', suffix='.txt',
+                                                dir=_capture_dir())
+            saved_fd = os.dup(fd)
+            os.dup2(capture_fd, fd)
+            self._fd_captures.append((fd, saved_fd, capture_fd, path))
+
+    def _restore_fds(self, max_inline):
+        self._flush_output()
+        limit = self._output_limit
+        outputs = []
+        full_output = []
+        for fd, saved_fd, capture_fd, path in self._fd_captures:
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+            size = os.fstat(capture_fd).st_size
+            full_output.append(None)
+            if limit is not None and size > limit.head + limit.tail:
+                with os.fdopen(capture_fd, 'rb') as f:
+                    f.seek(0)
+                    head = f.read(limit.head)
+                    f.seek(size - limit.tail)
+                    tail = f.read(limit.tail)
+                outputs.append(_truncated_text(
+                    head, tail, size - len(head) - len(tail)))
+                if limit.keep_full:
+                    full_output[-1] = SpilledText(path, errors='replace')
+                else:
+                    os.remove(path)
+                continue
+            if max_inline is not None and size > max_inline:
+                os.close(capture_fd)
+                outputs.append(SpilledText(path, errors='replace'))
+                continue
+            with os.fdopen(capture_fd, 'rb') as f:
+                f.seek(0)
+                outputs.append(f.read().decode('utf-8', errors='replace'))
+            os.remove(path)
+        self._fd_captures = None
+        self.full_output = tuple(full_output)
+        self.logger.handlers = self._orig_logging_handlers
+        return tuple(outputs)
+
+    def _flush_output(self):
+        self.stdout.flush()
+        self.stderr.flush()
+        if sys.platform != 'win32':  # pragma: no win32
+            # Native code may have output sitting in the C library's buffers.
+            try:
+                import ctypes
+                ctypes.CDLL(None).fflush(None)
+            except Exception:  # pragma: no cover
+                pass
+
+
+class OutputLimit(object):
+    """Bounds how much of a captured stream is kept.
+
+    Only the first |head| and the last |tail| bytes of the output (encoded as
+    UTF-8) are kept, with a marker saying how much was omitted in between.
+    """
+
+    def __init__(self, head=0, tail=0, keep_full=False):
+        """Args:
+            head: The number of bytes to keep from the start of the output.
+            tail: The number of bytes to keep from the end of the output.
+            keep_full: Whether the full output should be kept in a temporary
+                file when it is truncated, so that it can be saved elsewhere.
+        """
+        self.head = head
+        self.tail = tail
+        self.keep_full = keep_full
+
+
+def _truncated_text(head, tail, omitted):
+    return '%s\n[... %d bytes of output omitted ...]\n%s' % (
+        head.decode('utf-8', errors='replace'), omitted,
+        tail.decode('utf-8', errors='replace'))
+
+
+def _discard_full_output(full_output):
+    for full in full_output:
+        if full is not None:
+            full.remove()
+
+
+def _fileno(stream):
+    try:
+        return stream.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def _capture_dir():
+    """Returns a tmpfs directory for capture files if there is one."""
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return None
+
 
 class _TeedStream(io.StringIO):
 
@@ -269,6 +444,8 @@ class _TeedStream(io.StringIO):
         self.stream = stream
         self.capturing = False
         self.diverting = False
+        self.full_output = None
+        self._bounded = None
 
     @property
     def encoding(self):
@@ -279,7 +456,10 @@ class _TeedStream(io.StringIO):
             self.messages.append(msg)
             return
         elif self.capturing:
-            super(_TeedStream, self).write(msg, *args, **kwargs)
+            if self._bounded is not None:
+                self._bounded.write(msg)
+            else:
+                super(_TeedStream, self).write(msg, *args, **kwargs)
         if not self.diverting:
             self.stream.write(msg, *args, **kwargs)
 
@@ -289,14 +469,86 @@ class _TeedStream(io.StringIO):
         if not self.diverting:
             self.stream.flush()
 
-    def capture(self, divert=True):
+    def capture(self, divert=True, limit=None):
         self.truncate(0)
         self.capturing = True
         self.diverting = divert
+        self.full_output = None
+        self._bounded = _BoundedText(limit) if limit is not None else None
 
     def restore(self):
-        msg = self.getvalue()
+        if self._bounded is not None:
+            msg = self._bounded.getvalue()
+            self.full_output = self._bounded.close()
+            self._bounded = None
+        else:
+            msg = self.getvalue()
         self.truncate(0)
         self.capturing = False
         self.diverting = False
         return msg
+
+
+class _BoundedText(object):
+    """Keeps the start and the end of the text written to it.
+
+    See OutputLimit. If the full output is to be kept, it is written to a
+    temporary file once the text no longer fits, and everything after that is
+    appended to the file as well.
+    """
+
+    def __init__(self, limit):
+        self._limit = limit
+        self._head = bytearray()
+        self._tail = collections.deque()
+        self._tail_size = 0
+        self._omitted = 0
+        self._full = None
+        self._full_path = None
+
+    def write(self, msg):
+        data = msg.encode('utf-8', errors='surrogatepass')
+        if self._full is not None:
+            self._full.write(data)
+        room = self._limit.head - len(self._head)
+        if room > 0:
+            self._head += data[:room]
+            data = data[room:]
+            if not data:
+                return
+        self._tail.append(data)
+        self._tail_size += len(data)
+        excess = self._tail_size - self._limit.tail
+        if excess <= 0:
+            return
+        if self._limit.keep_full and self._full is None:
+            fd, self._full_path = tempfile.mkstemp(prefix='typ-',
+                                                   suffix='.txt')
+            self._full = os.fdopen(fd, 'wb')
+            self._full.write(self._head)
+            self._full.writelines(self._tail)
+        self._omitted += excess
+        self._tail_size -= excess
+        while excess:
+            chunk = self._tail[0]
+            if len(chunk) <= excess:
+                self._tail.popleft()
+                excess -= len(chunk)
+            else:
+                self._tail[0] = chunk[excess:]
+                excess = 0
+
+    def getvalue(self):
+        tail = b''.join(self._tail)
+        if self._omitted:
+            return _truncated_text(self._head, tail, self._omitted)
+        return (bytes(self._head) + tail).decode('utf-8',
+                                                 errors='surrogatepass')
+
+    def close(self):
+        """Returns a SpilledText with the full output if it was kept."""
+        if self._full is None:
+            return None
+        self._full.close()
+        self._full = None
+        return SpilledText(self._full_path, errors='replace')
@@ -15,10 +15,21 @@
 from collections import OrderedDict, defaultdict
 
 import datetime
+import gzip
 import json
+import os
+
+from typ.spilled_text import SpilledText
 
 _show_only_in_metadata = set(['tags', 'expectations_files', 'test_name_prefix'])
 
+# The formats that outputs can be compressed with.
+COMPRESSION_FORMATS = ('gzip', 'zstd')
+_COMPRESSION_EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+_GZIP_MAGIC = b'\x1f\x8b'
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+_COMPACT_SEPARATORS = (',', ':')
+
 class ResultType(object):
     Pass = 'PASS'
     Failure = 'FAIL'
@@ -77,29 +88,138 @@ class Result(object):
         self.unexpected = unexpected
         self.flaky = flaky
         self.code = code
-        self.out = out
-        self.err = err
+        self._out = out
+        self._err = err
         self.pid = pid
         self.is_regression = actual != ResultType.Pass and unexpected
         self.artifacts = artifacts
-        self.in_memory_text_artifacts = in_memory_text_artifacts
+        self._in_memory_text_artifacts = in_memory_text_artifacts
         self.file_path = file_path
         self.line_number = line_number
         self.failure_reason = failure_reason
         self.associated_bugs = associated_bugs
         self.result_sink_retcode = 0
+        # The result converted for ResultSink, if a worker left uploading it
+        # to the parent process.
+        self.result_sink_payload = None
+        # A list of (name, start time, duration) tuples for the phases of
+        # running the test, if they were timed.
+        self.phases = []
+
+    # Any of the text below may have been spilled to a file by
+    # spill_large_text(), in which case it is read back on first access.
+
+    @property
+    def out(self):
+        if isinstance(self._out, SpilledText):
+            self._out = self._out.read()
+        return self._out
+
+    @out.setter
+    def out(self, out):
+        self._out = out
+
+    @property
+    def err(self):
+        if isinstance(self._err, SpilledText):
+            self._err = self._err.read()
+        return self._err
+
+    @err.setter
+    def err(self, err):
+        self._err = err
+
+    @property
+    def in_memory_text_artifacts(self):
+        artifacts = self._in_memory_text_artifacts
+        if artifacts:
+            for name, content in artifacts.items():
+                if isinstance(content, SpilledText):
+                    artifacts[name] = content.read()
+        return artifacts
+
+    @in_memory_text_artifacts.setter
+    def in_memory_text_artifacts(self, in_memory_text_artifacts):
+        self._in_memory_text_artifacts = in_memory_text_artifacts
+
+    def stored_text(self):
+        """Returns the output and text artifacts without reading them back.
+
+        Returns:
+            A tuple (out, err, in_memory_text_artifacts) like the properties
+            of those names, except that any text that was spilled is a
+            SpilledText.
+        """
+        return self._out, self._err, self._in_memory_text_artifacts
+
+    def spill_large_text(self, threshold):
+        """Moves any output or text artifact over |threshold| into a file.
+
+        This keeps the Result small when it has to be sent to another
+        process, e.g. from a worker back to the parent. The text is read back
+        (and the file removed) the first time it is accessed.
+
+        Args:
+            threshold: The length, in characters, above which text is spilled.
+        """
+        if _is_large_text(self._out, threshold):
+            self._out = SpilledText.write(self._out)
+        if _is_large_text(self._err, threshold):
+            self._err = SpilledText.write(self._err)
+        if self._in_memory_text_artifacts:
+            for name, content in self._in_memory_text_artifacts.items():
+                if _is_large_text(content, threshold):
+                    self._in_memory_text_artifacts[name] = (
+                        SpilledText.write(content))
+
+
+def _is_large_text(text, threshold):
+    return not isinstance(text, SpilledText) and len(text) > threshold
+
+
+DEFAULT_TEST_SEPARATOR = '.'
 
 
 class ResultSet(object):
 
-    def __init__(self):
+    def __init__(self, sidecar=None):
         self.results = []
+        # An optional ResultsSidecar that every added result is written to.
+        self.sidecar = sidecar
 
     def add(self, result):
         self.results.append(result)
+        if self.sidecar:
+            self.sidecar.add(result)
 
 
-DEFAULT_TEST_SEPARATOR = '.'
+class ResultsSidecar(object):
+    """Writes results to a JSON lines file as soon as they are added.
+
+    The first line holds everything make_full_results() needs besides the
+    results, and each following line holds one result. Every line is
+    appended with a single write, so if the process is killed the file is
+    still usable, with at most its last line cut short. Use
+    make_full_results_from_sidecar() to turn the file into full results.
+    """
+
+    def __init__(self, host, path):
+        self.host = host
+        self.path = path
+
+    def start(self, metadata, seconds_since_epoch, all_test_names,
+              test_separator=DEFAULT_TEST_SEPARATOR):
+        """Replaces the file with a new one for a run of |all_test_names|."""
+        self.host.write_text_file(self.path, json.dumps({
+            'metadata': metadata,
+            'seconds_since_epoch': seconds_since_epoch,
+            'path_delimiter': test_separator,
+            'tests': list(all_test_names),
+        }) + '\n')
+
+    def add(self, result):
+        self.host.append_text_file(
+            self.path, json.dumps(_sidecar_entry(result)) + '\n')
 
 
 def make_full_results(metadata, seconds_since_epoch, all_test_names, results,
@@ -154,8 +274,79 @@ def make_full_results(metadata, seconds_since_epoch, all_test_names, results,
     return full_results
 
 
+def read_sidecar(host, path):
+    """Reads a file written by a ResultsSidecar.
+
+    The file is read a line at a time, and a last line that was cut short,
+    e.g. because the process writing it was killed, is ignored.
+
+    Returns:
+        A tuple (header, results), where |header| is a dict with the
+        arguments passed to ResultsSidecar.start() and |results| is a
+        ResultSet with the results that were added. The Results have every
+        field but their output.
+    """
+    header = None
+    results = ResultSet()
+    invalid_lineno = None
+    with host.open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            if invalid_lineno:
+                # Only the last line can have been cut short.
+                raise ValueError('%s:%d is not valid JSON' % (
+                    path, invalid_lineno))
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                invalid_lineno = lineno
+                continue
+            if header is None:
+                header = entry
+            else:
+                results.add(_result_from_sidecar_entry(entry))
+    if header is None:
+        raise ValueError('%s has no header' % path)
+    return header, results
+
+
+def make_full_results_from_sidecar(host, path, interrupted=False,
+                                   seconds_since_epoch=None):
+    """Makes the full results from a file written by a ResultsSidecar.
+
+    Args:
+        host: A Host instance used to read the file.
+        path: The path of the file.
+        interrupted: Whether the run may not have finished. If so, only the
+            tests that have results are included, and the full results are
+            marked as interrupted.
+        seconds_since_epoch: The time to record in the full results.
+            Defaults to the time the run started.
+
+    Returns:
+        The full results, as returned by make_full_results().
+    """
+    header, results = read_sidecar(host, path)
+    all_test_names = header['tests']
+    if interrupted:
+        names_with_results = set(r.name for r in results.results)
+        all_test_names = [name for name in all_test_names
+                          if name in names_with_results]
+    if seconds_since_epoch is None:
+        seconds_since_epoch = header['seconds_since_epoch']
+    full_results = make_full_results(
+        header['metadata'], seconds_since_epoch, all_test_names, results,
+        header['path_delimiter'])
+    full_results['interrupted'] = interrupted
+    return full_results
+
+
 def make_upload_request(test_results_server, builder, master, testtype,
-                        full_results):
+                        full_results, compression=None):
+    """Returns the (url, content_type, data) to upload the full results with.
+
+    If |compression| is given, |data| is the compressed bytes of the body,
+    which must be sent with a Content-Encoding header of |compression|.
+    """
     if test_results_server.startswith('http'):
         url = '%s/testfile/upload' % test_results_server
     else:
@@ -163,10 +354,89 @@ def make_upload_request(test_results_server, builder, master, testtype,
     attrs = [('builder', builder),
              ('master', master),
              ('testtype', testtype)]
-    content_type, data = _encode_multipart_form_data(attrs, full_results)
+    content_type, data = _encode_multipart_form_data(
+        attrs, full_results, compact=bool(compression))
+    if compression:
+        data = compress(data.encode('utf-8'), compression)
     return url, content_type, data
 
 
+def resolve_compression(compression):
+    """Returns the format to actually compress with for |compression|.
+
+    zstd is only used if a zstd module is available, and gzip otherwise.
+    """
+    if compression == 'zstd' and _zstd_module() is None:
+        return 'gzip'
+    return compression
+
+
+def compression_extension(compression):
+    """Returns the file extension for data compressed with |compression|."""
+    return _COMPRESSION_EXTENSIONS[compression]
+
+
+def compress(data, compression):
+    """Compresses |data| with a format returned by resolve_compression()."""
+    if compression == 'zstd':
+        return _zstd_module().compress(data)
+    # A fixed mtime keeps the output the same for the same data.
+    return gzip.compress(data, mtime=0)
+
+
+def decompress(data):
+    """Decompresses |data| if it is compressed, or returns it as is."""
+    if data.startswith(_GZIP_MAGIC):
+        return gzip.decompress(data)
+    if data.startswith(_ZSTD_MAGIC):
+        zstd = _zstd_module()
+        if zstd is None:
+            raise ValueError('Cannot decompress zstd data without the '
+                             'zstandard module.')
+        return zstd.decompress(data)
+    return data
+
+
+def write_json_file(host, path, obj, compression=None):
+    """Writes |obj| as JSON, e.g. the full results or a trace, to |path|.
+
+    Without compression the JSON is indented, to be easy to read. Otherwise
+    it is written with compact separators and compressed.
+    """
+    if not compression:
+        host.write_text_file(path, json.dumps(obj, indent=2) + '\n')
+        return
+    host.write_binary_file(path, compress(
+        json.dumps(obj, separators=_COMPACT_SEPARATORS).encode('utf-8'),
+        compression))
+
+
+def decode_json(contents):
+    """Decodes JSON read from a file, which may be compressed."""
+    if isinstance(contents, bytes):
+        contents = decompress(contents)
+    return json.loads(contents)
+
+
+def read_json_file(host, path):
+    """Reads a file written by write_json_file(), detecting the format."""
+    return decode_json(host.read_binary_file(path))
+
+
+def _zstd_module():
+    try:
+        # Python 3.14+.
+        from compression import zstd  # type: ignore[import-not-found]
+        return zstd
+    except ImportError:
+        pass
+    try:
+        import zstandard  # type: ignore[import-not-found]
+        return zstandard
+    except ImportError:
+        return None
+
+
 def exit_code_from_full_results(full_results):
     return 1 if full_results['num_regressions'] else 0
 
@@ -213,6 +483,16 @@ def regressed_tests_names(full_results):
                if r.get('is_regression', False))
 
 
+def test_times(full_results):
+    """Returns a dict mapping test names to their mean time in seconds."""
+    times = {}
+    for test_name, result in iterate_over_trie(
+            full_results['tests'], full_results['path_delimiter'], ''):
+        if result['times']:
+            times[test_name] = sum(result['times']) / len(result['times'])
+    return times
+
+
 def _get_test_names_for_result_type(full_results, result_type):
     return set(tn for tn, r in iterate_over_trie(
         full_results['tests'], full_results['path_delimiter'], '')
@@ -299,6 +579,50 @@ def _results_for_test(test_name, results_by_test_name):
     value['times'] = times
     return value
 
+def _sidecar_entry(result):
+    # Everything but the output, which can be large and was already printed.
+    failure_reason = None
+    if result.failure_reason:
+        failure_reason = {'primary_error_message':
+                          result.failure_reason.primary_error_message}
+    return {
+        'name': result.name,
+        'actual': result.actual,
+        'started': result.started,
+        'took': result.took,
+        'worker': result.worker,
+        'expected': sorted(result.expected),
+        'unexpected': result.unexpected,
+        'flaky': result.flaky,
+        'code': result.code,
+        'pid': result.pid,
+        'file_path': result.file_path,
+        'line_number': result.line_number,
+        'artifacts': result.artifacts,
+        'in_memory_text_artifacts': result.in_memory_text_artifacts,
+        'failure_reason': failure_reason,
+        'associated_bugs': result.associated_bugs,
+    }
+
+
+def _result_from_sidecar_entry(entry):
+    failure_reason = None
+    if entry['failure_reason']:
+        failure_reason = FailureReason(
+            entry['failure_reason']['primary_error_message'])
+    return Result(entry['name'], entry['actual'], started=entry['started'],
+                  took=entry['took'], worker=entry['worker'],
+                  expected=entry['expected'],
+                  unexpected=entry['unexpected'], flaky=entry['flaky'],
+                  code=entry['code'], pid=entry['pid'],
+                  file_path=entry['file_path'],
+                  line_number=entry['line_number'],
+                  artifacts=entry['artifacts'],
+                  in_memory_text_artifacts=entry['in_memory_text_artifacts'],
+                  failure_reason=failure_reason,
+                  associated_bugs=entry['associated_bugs'])
+
+
 def _add_artifacts_to_dict(value, result):
     if not result.artifacts:
         return
@@ -328,7 +652,7 @@ def _add_path_to_trie(trie, path, value, test_separator):
     _add_path_to_trie(trie[directory], rest, value, test_separator)
 
 
-def _encode_multipart_form_data(attrs, test_results):
+def _encode_multipart_form_data(attrs, test_results, compact=False):
     # Cloned from webkitpy/common/net/file_uploader.py
     BOUNDARY = '-J-S-O-N-R-E-S-U-L-T-S---B-O-U-N-D-A-R-Y-'
     CRLF = '\r\n'
@@ -345,7 +669,8 @@ def _encode_multipart_form_data(attrs, test_results):
                  'filename="full_results.json"')
     lines.append('Content-Type: application/json')
     lines.append('')
-    lines.append(json.dumps(test_results))
+    lines.append(json.dumps(
+        test_results, separators=_COMPACT_SEPARATORS if compact else None))
 
     lines.append('--' + BOUNDARY + '--')
     lines.append('')
@@ -93,8 +93,13 @@ class _ProcessPool(object):
     def send(self, msg, msg_type=_MessageType.Request):
         self.request_pool.put((_MessageType.Request, msg))
 
-    def get(self):
-        msg_type, resp = self.responses.get()
+    def get(self, timeout=None):
+        """Returns the next response.
+
+        Raises queue.Empty if |timeout| is given and no response arrives
+        within that many seconds.
+        """
+        msg_type, resp = self.responses.get(timeout=timeout)
         if msg_type == _MessageType.Error:
             self._handle_error(resp)
         elif msg_type == _MessageType.Interrupt:
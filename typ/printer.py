@@ -15,18 +15,61 @@
 
 class Printer(object):
 
-    def __init__(self, print_, should_overwrite, cols):
+    def __init__(self, print_, should_overwrite, cols, time_fn=None,
+                 min_interval=0):
+        """Args:
+            print_: The function used to print messages.
+            should_overwrite: Whether each update should overwrite the last
+                line printed.
+            cols: The width of the terminal, used to elide long messages.
+            time_fn: A function returning the current time, in seconds.
+            min_interval: When overwriting, elided updates that come less
+                than this many seconds after the last one printed are held
+                back, and only the latest one is printed when it is next
+                needed. Requires |time_fn|.
+        """
         self.print_ = print_
         self.should_overwrite = should_overwrite
         self.cols = cols
         self.last_line = ''
+        self.time_fn = time_fn
+        self.min_interval = min_interval
+        self.coalesced_updates = 0
+        self._pending = None
+        self._last_update_time = None
 
     def flush(self):
+        self.write_pending()
         if self.last_line:
             self.print_('')
             self.last_line = ''
 
+    def has_pending_update(self):
+        return self._pending is not None
+
+    def write_pending(self):
+        """Prints the update held back by rate limiting, if any."""
+        if self._pending is not None:
+            msg, self._pending = self._pending, None
+            self._update(msg, elide=True)
+
     def update(self, msg, elide=True):
+        if elide and self.should_overwrite and self.min_interval:
+            now = self.time_fn()
+            if (self._last_update_time is not None and
+                    now - self._last_update_time < self.min_interval):
+                if self._pending is not None:
+                    self.coalesced_updates += 1
+                self._pending = msg
+                return
+            self._last_update_time = now
+        if self._pending is not None:
+            # The held back update would be overwritten right away.
+            self._pending = None
+            self.coalesced_updates += 1
+        self._update(msg, elide)
+
+    def _update(self, msg, elide):
         msg_len = len(msg)
         if elide and self.cols and msg_len > self.cols - 5:
             new_len = int((self.cols - 5) / 2)
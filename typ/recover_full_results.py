@@ -0,0 +1,57 @@
+# Copyright 2025 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Recovers the full results of a run that was killed before it finished.
+
+When the runner is passed --write-results-sidecar-to, it appends each result
+to that file as soon as it is available. If the runner is then killed, e.g.
+by a CI timeout, before it writes the full results, run
+
+  python -m typ.recover_full_results SIDECAR OUTPUT
+
+to write full results for the tests that did finish, marked as interrupted.
+"""
+
+import argparse
+import sys
+
+from typ import json_results
+from typ.host import Host
+
+
+def main(argv=None, host=None):
+    host = host or Host()
+    parser = argparse.ArgumentParser(
+        prog='python -m typ.recover_full_results',
+        description=('Writes the full results of an interrupted run from '
+                     'the file it was passed --write-results-sidecar-to.'))
+    parser.add_argument('sidecar',
+                        help='The file the results were written to.')
+    parser.add_argument('output',
+                        help='The file to write the full results to.')
+    parser.add_argument('--compress-outputs', metavar='FORMAT',
+                        choices=json_results.COMPRESSION_FORMATS,
+                        help='Compresses the full results, as the runner '
+                             'option of the same name does.')
+    args = parser.parse_args(argv)
+
+    try:
+        full_results = json_results.make_full_results_from_sidecar(
+            host, args.sidecar, interrupted=True)
+    except (IOError, KeyError, ValueError) as e:
+        host.print_('Error: could not read "%s": %s' % (args.sidecar, e),
+                    stream=host.stderr)
+        return 1
+    json_results.write_json_file(
+        host, args.output, full_results,
+        json_results.resolve_compression(args.compress_outputs))
+    num_tests = len(list(json_results.iterate_over_trie(
+        full_results['tests'], full_results['path_delimiter'], '')))
+    host.print_('Wrote the results of %d tests to "%s".' % (num_tests,
+                                                          args.output))
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main())
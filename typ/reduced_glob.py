@@ -8,6 +8,8 @@ This avoids having to escape non-asterisk patterns when we only want to match
 * wildcards.
 """
 
+import bisect
+
 ESCAPED_WILDCARD = '\\*'
 UNESCAPED_WILDCARD = '*'
 
@@ -23,6 +25,16 @@ class ReducedGlob:
         self._pattern = pattern
         self._substrings = []
         self._compute_substrings()
+        self._match = self._compile()
+
+    @property
+    def pattern(self):
+        return self._pattern
+
+    @property
+    def leading_literal(self):
+        """The literal text any matching name must start with."""
+        return self._substrings[0]
 
     def _compute_substrings(self):
         """Performs the one-time split of a pattern into substrings."""
@@ -53,6 +65,47 @@ class ReducedGlob:
         self._substrings = [s.replace(ESCAPED_WILDCARD, UNESCAPED_WILDCARD)
                             for s in self._substrings]
 
+    def _compile(self):
+        """Picks the matcher specialized for the shape of the pattern.
+
+        Returns:
+            A bound method taking a name and returning whether it matches.
+        """
+        # The first substring must be a prefix of the name and the last one a
+        # suffix, and both can be checked directly. The remaining substrings
+        # only need to be found, in order, in what is left in between.
+        self._prefix = self._substrings[0]
+        self._suffix = self._substrings[-1]
+        self._infixes = tuple(self._substrings[1:-1])
+        self._min_length = sum(len(s) for s in self._substrings)
+        if len(self._substrings) == 1:
+            return self._match_literal
+        if not self._infixes:
+            return self._match_prefix_and_suffix
+        return self._match_with_infixes
+
+    def _match_literal(self, name):
+        return name == self._prefix
+
+    def _match_prefix_and_suffix(self, name):
+        return (len(name) >= self._min_length and
+                name.startswith(self._prefix) and
+                name.endswith(self._suffix))
+
+    def _match_with_infixes(self, name):
+        if not self._match_prefix_and_suffix(name):
+            return False
+        # Finding each infix as early as possible leaves the most room for
+        # the ones after it.
+        start = len(self._prefix)
+        end = len(name) - len(self._suffix)
+        for infix in self._infixes:
+            index = name.find(infix, start, end)
+            if index == -1:
+                return False
+            start = index + len(infix)
+        return True
+
     def matchcase(self, name):
         """Test if |name| matches the stored pattern. Case-sensitive.
 
@@ -62,30 +115,77 @@ class ReducedGlob:
         Returns:
             True if |name| matches the stored pattern, otherwise False.
         """
-        # Look for each substring in order, shifting the starting point to avoid
-        # anything we've matched already.
-        starting_index = 0
-        for i, substr in enumerate(self._substrings):
-            substr_start_index = name.find(substr, starting_index)
-            if substr_start_index == -1:
-                return False
+        return self._match(name)
 
-            # The first substring is special since we need to ensure that |name|
-            # starts with it. Otherwise, we could find a match later in the
-            # string, which would implicitly add a * to the front of the stored
-            # pattern.
-            if i == 0 and substr_start_index != 0:
-                return False
+    def match_many(self, names):
+        """Filters |names| down to the ones matching the stored pattern.
 
-            # Similarly, the last substring is special since we need to ensure
-            # that all characters in |name| were matched. Otherwise, we would
-            # implicitly add a * to the end of the stored pattern.
-            if i + 1 == len(self._substrings) and not name.endswith(substr):
-                return False
+        Args:
+            names: An iterable of strings to test.
 
-            # Consume everything we just matched.
-            starting_index = substr_start_index + len(substr)
-        return True
+        Returns:
+            A list of the strings in |names| that match the stored pattern, in
+            their original order.
+        """
+        return list(filter(self._match, names))
+
+
+def globs_matching_any(globs, names):
+    """Finds which globs match at least one of the given names.
+
+    This is equivalent to checking every glob against every name with
+    matchcase(), but instead of scanning all of |names| for each glob, the
+    names are sorted once (both forwards and reversed) so that each glob only
+    needs to look at the names sharing its leading or trailing literal text,
+    whichever range is smaller.
+
+    Args:
+        globs: An iterable of ReducedGlob instances.
+        names: An iterable of strings to match the globs against.
+
+    Returns:
+        A set containing the ReducedGlob instances from |globs| that match at
+        least one name in |names|.
+    """
+    names = sorted(set(names))
+    reversed_names = sorted(n[::-1] for n in names)
+    matched = set()
+    for glob in globs:
+        # pylint: disable=protected-access
+        substrings = glob._substrings
+        if len(substrings) == 1:
+            i = bisect.bisect_left(names, substrings[0])
+            if i < len(names) and names[i] == substrings[0]:
+                matched.add(glob)
+            continue
+
+        prefix_lo, prefix_hi = _prefix_range(names, substrings[0])
+        suffix_lo, suffix_hi = _prefix_range(reversed_names,
+                                             substrings[-1][::-1])
+        if prefix_hi - prefix_lo <= suffix_hi - suffix_lo:
+            candidates = (names[i] for i in range(prefix_lo, prefix_hi))
+        else:
+            candidates = (reversed_names[i][::-1]
+                          for i in range(suffix_lo, suffix_hi))
+        for name in candidates:
+            if glob.matchcase(name):
+                matched.add(glob)
+                break
+    return matched
+
+
+def _prefix_range(sorted_names, prefix):
+    """Returns the [lo, hi) range of |sorted_names| starting with |prefix|."""
+    if not prefix:
+        return 0, len(sorted_names)
+    lo = bisect.bisect_left(sorted_names, prefix)
+    if ord(prefix[-1]) == 0x10ffff:
+        # There is no next character to bound the range with; fall back to
+        # the end of the list, which is correct but slower.
+        return lo, len(sorted_names)
+    # Every string that is >= |prefix| and < |upper| starts with |prefix|.
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return lo, bisect.bisect_left(sorted_names, upper, lo)
 
 
 def _find_all_indices(s, substr):
@@ -21,12 +21,18 @@ See go/resultdb and go/resultsink for more details.
 """
 
 import base64
+import collections
 from collections.abc import Mapping
+import concurrent.futures
 import contextlib
+import gzip
 import hashlib
 import json
 import os
+import queue
 import sys
+import threading
+import time
 
 # The requests module is only needed if we actually need to talk to a sink.
 try:
@@ -34,6 +40,7 @@ try:
 except ImportError:
     requests = None
 
+from typ import artifacts as typ_artifacts
 from typ import host as typ_host
 from typ import json_results
 from typ import expectations_parser
@@ -55,6 +62,25 @@ STDERR_KEY = 'typ_stderr'
 # From https://source.chromium.org/chromium/infra/infra/+/main:go/src/go.chromium.org/luci/resultdb/pbutil/strpair.go;l=28
 MAX_TAG_LENGTH = 256
 SHA1_HEX_HASH_LENGTH = 40
+# How long a result may wait in the background uploader before the batch it
+# is in gets uploaded, in seconds.
+DEFAULT_FLUSH_INTERVAL = 1.0
+# The batch size and number of concurrent uploads used when the results of
+# all workers are uploaded from a single process.
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_CONCURRENT_UPLOADS = 4
+# How long stopping the background uploader keeps retrying failed uploads,
+# in seconds.
+DEFAULT_FLUSH_TIMEOUT = 30.0
+# The delay before the first retry of a failed upload, which doubles with
+# each further attempt up to the maximum, in seconds.
+_RETRY_DELAY = 0.5
+_MAX_RETRY_DELAY = 30.0
+# The maximum total length of the texts whose base64 encodings are cached.
+_MAX_BASE64_CACHE_LENGTH = 4 * 1024 * 1024
+# How many batches worth of results the background uploader queues before
+# reporting blocks, to bound memory use if the sink falls behind.
+_QUEUED_BATCHES = 4
 
 
 class ResultSinkReporter(object):
@@ -65,10 +91,12 @@ class ResultSinkReporter(object):
             host: A typ_host.Host or host_fake.FakeHost instance.
             disable: Whether to explicitly disable ResultSink integration.
             output_file: A string pointing to a filepath to write POST request
-                data to instead of actually POSTing to ResultSink. Note: this
-                makes no attempt at being thread-safe, as it is only intended
-                as a workaround for Skylab, and it is not expected to run tests
-                in parallel there.
+                data to instead of actually POSTing to ResultSink. Each
+                batch of results is appended with a single write, so
+                several processes can share the file without their lines
+                getting interleaved, although the lines are then in no
+                particular order. This is only intended as a workaround for
+                Skylab.
         """
         self.host = host or typ_host.Host()
         self._sink = None
@@ -79,6 +107,10 @@ class ResultSinkReporter(object):
         self._chromium_src_dir = None
         self._output_file = output_file
         self._pending_results = None
+        self._uploader = None
+        # Retries and similar tests often produce the same text, e.g. the
+        # same log output, so avoid encoding it over and over again.
+        self._base64_encodings = _Base64Cache()
         if disable:
             return
 
@@ -150,7 +182,8 @@ class ResultSinkReporter(object):
                     artifacts are saved on disk. If a relative path, will be
                     automatically joined with the cwd. Use '.' instead of '' to
                     point to the cwd.
-            expectations: An expectations_parser.TestExpectations instance, or
+            expectations: An expectations_parser.TestExpectations or
+                    expectations_parser.CompactTestExpectations instance, or
                     None if one is not available.
             test_file_location: A string containing the path to the file
                     containing the test.
@@ -170,8 +203,34 @@ class ResultSinkReporter(object):
             0 if the result was reported successfully or ResultDB is not
             supported, otherwise 1.
         """
-        if not self.resultdb_supported:
+        test_result = self.prepare_individual_test_result(
+                result, artifact_output_dir, expectations, test_file_location,
+                test_file_line, test_name_prefix, additional_tags,
+                html_summary)
+        if test_result is None:
             return 0
+        return self.report_prepared_result(test_result)
+
+    def prepare_individual_test_result(
+            self, result, artifact_output_dir, expectations, test_file_location,
+            test_file_line=None, test_name_prefix='', additional_tags=None,
+            html_summary=None):
+        """Converts a single test result to the format ResultSink ingests.
+
+        This does everything report_individual_test_result() does except for
+        the upload, so that the result can be converted where its artifacts
+        are available and uploaded by report_prepared_result() elsewhere,
+        e.g. in another process.
+
+        Args:
+            See report_individual_test_result().
+
+        Returns:
+            A dict that can be passed to report_prepared_result(), or None if
+            ResultDB is not supported.
+        """
+        if not self.resultdb_supported:
+            return None
 
         expectation_tags = expectations.tags if expectations else []
         additional_tags = additional_tags or []
@@ -214,7 +273,8 @@ class ResultSinkReporter(object):
 
         artifacts = {}
         original_artifacts = result.artifacts or {}
-        in_memory_text_artifacts = result.in_memory_text_artifacts or {}
+        out, err, in_memory_text_artifacts = result.stored_text()
+        in_memory_text_artifacts = in_memory_text_artifacts or {}
         https_artifacts = ''
         assert STDOUT_KEY not in original_artifacts
         assert STDOUT_KEY not in in_memory_text_artifacts
@@ -244,29 +304,22 @@ class ResultSinkReporter(object):
             # a single artifact name due to retries, but ResultDB does not.
             elif len(artifact_filepaths) > 1:
                 for index, filepath in enumerate(artifact_filepaths):
-                    artifacts[artifact_name + '-file%d' % index] = {
-                        'filePath': self.host.join(
-                                artifact_output_dir, filepath),
-                    }
+                    artifacts[artifact_name + '-file%d' % index] = (
+                        self._file_artifact(artifact_output_dir, filepath))
             else:
-                artifacts[artifact_name] = {
-                    'filePath': self.host.join(
-                            artifact_output_dir, artifact_filepaths[0]),
-                }
+                artifacts[artifact_name] = self._file_artifact(
+                        artifact_output_dir, artifact_filepaths[0])
 
         for artifact_name, text_content in in_memory_text_artifacts.items():
             artifacts[artifact_name] = {
-                'contents': base64.b64encode(
-                    text_content.encode('utf-8')).decode('utf-8'),
+                'contents': self._encode_text(text_content),
                 'content_type': 'text/plain; charset=utf-8',
             }
 
-        for artifact_id, contents in [(STDOUT_KEY, result.out),
-                                      (STDERR_KEY, result.err)]:
+        for artifact_id, contents in [(STDOUT_KEY, out), (STDERR_KEY, err)]:
             if contents:
                 artifacts[artifact_id] = {
-                    'contents': base64.b64encode(
-                        contents.encode('utf-8')).decode('utf-8'),
+                    'contents': self._encode_text(contents),
                     'content_type': 'text/plain; charset=utf-8',
                 }
 
@@ -291,10 +344,62 @@ class ResultSinkReporter(object):
             test_metadata['location'].update({'line': test_file_line})
 
         status = _JSON_TO_RESULTDB_STATUSES.get(result.actual, result.actual)
-        return self._report_result(
+        return _create_json_test_result(
                 test_id, status, result_is_expected, artifacts, tag_list,
                 html_summary, result.took, test_metadata, result.failure_reason)
 
+    def _encode_text(self, text):
+        # Text that a worker spilled to a file is left there until the result
+        # is reported, see _read_spilled_text().
+        if isinstance(text, json_results.SpilledText):
+            return text
+        return self._base64_encodings.encode(text)
+
+    @staticmethod
+    def _read_spilled_text(test_result):
+        """Encodes the text artifacts of |test_result| that are still spilled.
+        """
+        for artifact in test_result.get('artifacts', {}).values():
+            contents = artifact.get('contents')
+            if isinstance(contents, json_results.SpilledText):
+                # The Result may still read the text itself, so keep the file.
+                artifact['contents'] = base64.b64encode(
+                    contents.read(remove=False).encode('utf-8')).decode(
+                        'utf-8')
+
+    def _file_artifact(self, artifact_output_dir, filepath):
+        # The sink can only read plain files, so send the contents of
+        # archived artifacts instead.
+        if typ_artifacts.IsArchivedArtifact(filepath):
+            return {
+                'contents': base64.b64encode(typ_artifacts.ReadArtifact(
+                        artifact_output_dir, filepath)).decode('utf-8'),
+            }
+        return {'filePath': self.host.join(artifact_output_dir, filepath)}
+
+    def report_prepared_result(self, test_result):
+        """Reports a result returned by prepare_individual_test_result().
+
+        Args:
+            test_result: A dict returned by prepare_individual_test_result().
+
+        Returns:
+            0 if the result was reported successfully or ResultDB is not
+            supported, otherwise 1.
+        """
+        if not self.resultdb_supported:
+            return 0
+        self._read_spilled_text(test_result)
+        if self._pending_results:
+            self._pending_results.add(test_result)
+            # Treat the deferred upload as a tentative success.
+            return 0
+        if self._uploader:
+            # Failures are reported by stop_background_upload() instead.
+            self._uploader.put(test_result)
+            return 0
+        return self._upload_test_results([test_result])
+
     @contextlib.contextmanager
     def batch_results(self):
         """Begin buffering test results, which will be uploaded on exit.
@@ -316,10 +421,8 @@ class ResultSinkReporter(object):
         try:
             yield
             if self._pending_results.results:
-                payload = json.dumps({
-                    'testResults': self._pending_results.results,
-                })
-                status = self._post(self._url, payload)
+                status = self._upload_test_results(
+                        self._pending_results.results)
                 if status != 0:
                     # There's no easy way to pass the status code to the caller,
                     # so signal failure through an exception instead.
@@ -328,6 +431,71 @@ class ResultSinkReporter(object):
         finally:
             self._pending_results = None
 
+    def start_background_upload(self, batch_size,
+                                flush_interval=DEFAULT_FLUSH_INTERVAL,
+                                max_concurrent_uploads=1,
+                                flush_timeout=DEFAULT_FLUSH_TIMEOUT,
+                                spool_dir=None, recover_spool=False):
+        """Starts uploading reported results from a background thread.
+
+        Until stop_background_upload() is called, results passed to
+        `report_individual_test_result()` are queued and uploaded in batches
+        of up to |batch_size| results, so that the caller does not wait on
+        the sink. A partial batch is uploaded once its oldest result has been
+        waiting for |flush_interval| seconds. If the sink falls behind,
+        reporting a result blocks until there is room in the queue again.
+        Batches that fail to upload are retried with exponential backoff.
+
+        Args:
+            batch_size: The maximum number of results to upload per request.
+            flush_interval: The maximum number of seconds a result is held
+                    before being uploaded.
+            max_concurrent_uploads: The maximum number of batches to upload
+                    at the same time. Requests share the session, and so
+                    reuse its kept-alive connections. Results written to an
+                    output file are always written one batch at a time, in
+                    the order they were reported.
+            flush_timeout: The maximum number of seconds
+                    stop_background_upload() keeps retrying failed uploads.
+            spool_dir: An optional directory each batch is written to
+                    before it is uploaded. Batches that still haven't been
+                    uploaded when the background upload stops are kept there.
+            recover_spool: Whether to also upload the batches left in
+                    |spool_dir| by earlier runs. Only one reporter should do
+                    this, before any other starts using |spool_dir|.
+        """
+        if self._uploader is not None:
+            raise ResultSinkError('background upload is already running')
+        if not self.resultdb_supported:
+            return
+        if not self._session:
+            max_concurrent_uploads = 1
+        spool = None
+        recovered = None
+        if spool_dir:
+            spool = _Spool(self.host, spool_dir)
+            if recover_spool:
+                recovered = spool.recover()
+        self._uploader = _BackgroundUploader(
+                self, batch_size, flush_interval, max_concurrent_uploads,
+                flush_timeout, spool, recovered)
+
+    def stop_background_upload(self):
+        """Uploads any queued results and stops the background thread.
+
+        Failed uploads are retried for up to the flush timeout passed to
+        start_background_upload() before this gives up on them.
+
+        Returns:
+            0 if every result was uploaded successfully or no background
+            upload was running, otherwise 1.
+        """
+        if self._uploader is None:
+            return 0
+        uploader = self._uploader
+        self._uploader = None
+        return uploader.stop()
+
     def _report_result(
             self, test_id, status, expected, artifacts, tag_list, html_summary,
             duration, test_metadata, failure_reason):
@@ -360,12 +528,7 @@ class ResultSinkReporter(object):
         test_result = _create_json_test_result(
                 test_id, status, expected, artifacts, tag_list, html_summary,
                 duration, test_metadata, failure_reason)
-
-        if self._pending_results:
-            self._pending_results.add(test_result)
-            # Treat the deferred upload as a tentative success.
-            return 0
-        return self._post(self._url, json.dumps({'testResults': [test_result]}))
+        return self.report_prepared_result(test_result)
 
     def _post(self, url, content):
         """POST to ResultSink.
@@ -385,17 +548,36 @@ class ResultSinkReporter(object):
                 data=content)
             ret = 0 if res.ok else 1
         elif self._output_file:
-            test_results = json.loads(content)['testResults']
-            # Append the test results to the jsonl file, where
-            # each line represents a test result in json string.
-            for t in test_results:
-                self.host.append_text_file(self._output_file,
-                                           '{}\n'.format(json.dumps(t)))
-            ret = 0
+            ret = self._write_test_results(json.loads(content)['testResults'])
         else:
             raise RuntimeError('Called _post without a session or output file')
         return ret
 
+    def _upload_test_results(self, test_results):
+        """Uploads a list of test results in one request.
+
+        Returns:
+            0 if the upload succeeded, otherwise 1.
+        """
+        if self._output_file:
+            return self._write_test_results(test_results)
+        return self._post(self._url,
+                          json.dumps({'testResults': test_results}))
+
+    def _write_test_results(self, test_results):
+        """Appends test results to the output file as JSON lines.
+
+        All the lines are appended at once, so that they don't get interleaved
+        with the lines appended by other processes.
+
+        Returns:
+            0, since writing either succeeds or raises.
+        """
+        self.host.append_text_file(
+                self._output_file,
+                ''.join(json.dumps(t) + '\n' for t in test_results))
+        return 0
+
     def _convert_path_to_repo_path(self, filepath):
         """Converts an absolute file path to a repo relative file path.
 
@@ -427,6 +609,247 @@ class ResultSinkError(Exception):
     """Base exception for errors when using a result sink reporter."""
 
 
+class _Base64Cache(object):
+    """Caches the base64 encodings of recently encoded texts.
+
+    The texts are evicted least recently used first, to keep the total length
+    of the cached texts under |max_length|.
+    """
+
+    def __init__(self, max_length=_MAX_BASE64_CACHE_LENGTH):
+        self._max_length = max_length
+        self._length = 0
+        self._encodings = collections.OrderedDict()
+
+    def encode(self, text):
+        encoding = self._encodings.get(text)
+        if encoding is not None:
+            self._encodings.move_to_end(text)
+            return encoding
+        encoding = base64.b64encode(text.encode('utf-8')).decode('utf-8')
+        if len(text) <= self._max_length:
+            self._encodings[text] = encoding
+            self._length += len(text)
+            while self._length > self._max_length:
+                evicted, _ = self._encodings.popitem(last=False)
+                self._length -= len(evicted)
+        return encoding
+
+
+_STOP = object()
+
+
+class _PendingBatch(object):
+    """A batch of results that has not been uploaded yet."""
+
+    def __init__(self, test_results, path=None):
+        self.test_results = test_results
+        # The spool file holding the batch, if it was spooled.
+        self.path = path
+        self.attempts = 0
+        self.retry_at = 0
+
+
+class _Spool(object):
+    """Keeps batches of results on disk until they have been uploaded.
+
+    Each spool writes to its own subdirectory of the spool directory, so
+    that the workers of a run can share it. Batches are stored as gzipped
+    JSON.
+    """
+
+    def __init__(self, host, spool_dir):
+        self._host = host
+        self._spool_dir = spool_dir
+        self._dir = None
+        self._next_index = 0
+        # The directories holding the batches added or recovered.
+        self._dirs = set()
+
+    def add(self, test_results):
+        if self._dir is None:
+            self._host.maybe_make_directory(self._spool_dir)
+            self._dir = self._host.mkdtemp(prefix='%d-' % self._host.getpid(),
+                                           dir=self._spool_dir)
+            self._dirs.add(self._dir)
+        path = self._host.join(self._dir, '%08d.json.gz' % self._next_index)
+        self._next_index += 1
+        self._host.write_binary_file(
+                path, gzip.compress(json.dumps(test_results).encode('utf-8')))
+        return _PendingBatch(test_results, path)
+
+    def load(self, pending):
+        return json.loads(gzip.decompress(
+                self._host.read_binary_file(pending.path)).decode('utf-8'))
+
+    def remove(self, pending):
+        self._host.remove(pending.path)
+
+    def recover(self):
+        """Returns the batches left in the spool by earlier runs.
+
+        This must be called before anything else writes to the spool
+        directory, since files that are being written can't be told apart
+        from those left by a process that was killed.
+        """
+        if not self._host.isdir(self._spool_dir):
+            return []
+        recovered = [
+            _PendingBatch(None, self._host.join(self._spool_dir, f))
+            for f in sorted(self._host.files_under(self._spool_dir))
+            if f.endswith('.json.gz')]
+        self._dirs.update(self._host.dirname(p.path) for p in recovered)
+        return recovered
+
+    def remove_empty_dirs(self):
+        for d in self._dirs:
+            if not self._host.files_under(d):
+                self._host.rmtree(d)
+        self._dirs = set()
+
+
+class _BackgroundUploader(object):
+    """Uploads the results queued by a reporter from a daemon thread.
+
+    Batches that fail to upload are retried with exponential backoff. When
+    stopped, the uploader keeps retrying for up to |flush_timeout| seconds
+    before giving up on the remaining batches.
+    """
+
+    def __init__(self, reporter, batch_size, flush_interval,
+                 max_concurrent_uploads=1, flush_timeout=DEFAULT_FLUSH_TIMEOUT,
+                 spool=None, recovered=None):
+        self._reporter = reporter
+        self._batch_size = max(1, batch_size)
+        self._flush_interval = flush_interval
+        self._flush_timeout = flush_timeout
+        self._queue = queue.Queue(maxsize=self._batch_size * _QUEUED_BATCHES)
+        self._spool = spool
+        self._retry_delay = _RETRY_DELAY
+        self._lock = threading.Lock()
+        # Batches waiting to be retried.
+        self._retries = list(recovered or [])
+        self._executor = None
+        if max_concurrent_uploads > 1:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=max_concurrent_uploads)
+            # Don't let batches pile up behind a slow sink either.
+            self._in_flight = threading.BoundedSemaphore(
+                    max_concurrent_uploads * _QUEUED_BATCHES)
+        self._thread = threading.Thread(target=self._run,
+                                        name='result_sink_uploader')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, test_result):
+        self._queue.put(test_result)
+
+    def stop(self):
+        self._queue.put(_STOP)
+        self._thread.join()
+        if self._executor:
+            self._executor.shutdown(wait=True)
+        deadline = time.monotonic() + self._flush_timeout
+        while True:
+            pending = self._next_retry()
+            if not pending:
+                if self._spool:
+                    self._spool.remove_empty_dirs()
+                return 0
+            now = time.monotonic()
+            if pending.retry_at >= deadline:
+                # Anything spooled is left for a later run to upload.
+                return 1
+            time.sleep(max(0, pending.retry_at - now))
+            self._attempt(self._pop_retry(pending))
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            now = time.monotonic()
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, deadline - now)
+            pending = self._next_retry()
+            if pending:
+                if pending.retry_at <= now:
+                    self._upload(self._pop_retry(pending))
+                    continue
+                if timeout is None or pending.retry_at - now < timeout:
+                    timeout = pending.retry_at - now
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                if batch:
+                    self._upload(self._new_batch(batch))
+                return
+            if item is not None:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self._flush_interval
+            if batch and (len(batch) >= self._batch_size or
+                          time.monotonic() >= deadline):
+                self._upload(self._new_batch(batch))
+                batch = []
+                deadline = None
+
+    def _new_batch(self, test_results):
+        if self._spool:
+            try:
+                return self._spool.add(test_results)
+            except Exception:  # pylint: disable=broad-except
+                pass
+        return _PendingBatch(test_results)
+
+    def _next_retry(self):
+        with self._lock:
+            if not self._retries:
+                return None
+            return min(self._retries, key=lambda p: p.retry_at)
+
+    def _pop_retry(self, pending):
+        with self._lock:
+            self._retries.remove(pending)
+        return pending
+
+    def _upload(self, pending):
+        if self._executor:
+            self._in_flight.acquire()
+            future = self._executor.submit(self._attempt, pending)
+            future.add_done_callback(lambda _: self._in_flight.release())
+        else:
+            self._attempt(pending)
+
+    def _attempt(self, pending):
+        # pylint: disable=protected-access
+        try:
+            test_results = pending.test_results
+            if test_results is None:
+                test_results = self._spool.load(pending)
+            ret = self._reporter._upload_test_results(test_results)
+        except Exception:  # pylint: disable=broad-except
+            ret = 1
+        if not ret:
+            if pending.path:
+                try:
+                    self._spool.remove(pending)
+                except Exception:  # pylint: disable=broad-except
+                    pass
+            return
+        pending.attempts += 1
+        pending.retry_at = time.monotonic() + min(
+                _MAX_RETRY_DELAY,
+                self._retry_delay * 2 ** (pending.attempts - 1))
+        if pending.path:
+            # The batch can be read back from the spool when it is retried.
+            pending.test_results = None
+        with self._lock:
+            self._retries.append(pending)
+
+
 def _create_json_test_result(
         test_id, status, expected, artifacts, tag_list, html_summary,
         duration, test_metadata, failure_reason):
@@ -18,6 +18,7 @@ import inspect
 import json
 import os
 import pdb
+import queue
 import re
 import sys
 import unittest
@@ -43,9 +44,9 @@ for path in (dir_above_typ, dir_cov):
 from typ import artifacts
 from typ import json_results
 from typ import result_sink
-from typ.arg_parser import ArgumentParser
+from typ.arg_parser import ArgumentParser, DEFAULT_STATUS_REFRESH_RATE
 from typ.expectations_parser import TestExpectations, Expectation
-from typ.host import Host
+from typ.host import Host, OutputLimit
 from typ.pool import make_pool_group
 from typ.stats import Stats
 from typ.printer import Printer
@@ -57,6 +58,7 @@ Result = json_results.Result
 ResultSet = json_results.ResultSet
 ResultType = json_results.ResultType
 FailureReason = json_results.FailureReason
+SpilledText = json_results.SpilledText
 
 # Matches the first line of stack entries in formatted Python tracebacks.
 # The first capture group is the name of the file, the second is the line.
@@ -64,6 +66,15 @@ FailureReason = json_results.FailureReason
 # See: https://github.com/python/cpython/blob/3.10/Lib/traceback.py#L440
 _TRACEBACK_FILE_RE = re.compile(r'^  File "[^"]*[/\\](.*)", line ([0-9]+), in ')
 
+# Output or text artifacts longer than this (in characters, or bytes for
+# fd-level captures) are passed from workers to the parent through temporary
+# files rather than the result queue.
+_SPILL_THRESHOLD = 1024 * 1024
+
+# The artifacts the full output of a test is saved as if it was truncated.
+_FULL_STDOUT_ARTIFACT = 'typ_full_stdout'
+_FULL_STDERR_ARTIFACT = 'typ_full_stderr'
+
 
 def main(argv=None, host=None, win_multiprocessing=None, **defaults):
     host = host or Host()
@@ -151,6 +162,7 @@ class Runner(object):
         self.host = host or Host()
         self.loader = unittest.loader.TestLoader()
         self.printer = None
+        self.printing_time = 0
         self.setup_fn = None
         self.stats = None
         self.teardown_fn = None
@@ -158,8 +170,10 @@ class Runner(object):
         self.top_level_dirs = []
         self.win_multiprocessing = WinMultiprocessing.spawn
         self.final_responses = []
+        self.result_sink_reporter = None
         self.has_expectations = False
         self.expectations = None
+        self._prefetched_expectations = {}
         self.metadata = {}
         self.path_delimiter = json_results.DEFAULT_TEST_SEPARATOR
         self.artifact_output_dir = None
@@ -239,7 +253,12 @@ class Runner(object):
             return
 
     def print_(self, msg='', end='\n', stream=None):
+        if self.printer:
+            # Anything printed must come after the status update it follows.
+            self.printer.write_pending()
+        start = self.host.time()
         self.host.print_(msg, end, stream=stream)
+        self.printing_time += self.host.time() - start
 
     def run(self, test_set=None):
         ret = 0
@@ -281,6 +300,11 @@ class Runner(object):
             self.stats.total = (len(test_set.parallel_tests) +
                                 len(test_set.isolated_tests) +
                                 len(test_set.tests_to_skip)) * self.args.repeat
+            for _ in range(self.args.repeat):
+                self.stats.add_tests(
+                    ti.name for ti in (test_set.parallel_tests +
+                                       test_set.isolated_tests +
+                                       test_set.tests_to_skip))
             all_tests = [ti.name for ti in
             _sort_inputs(test_set.parallel_tests +
                          test_set.isolated_tests +
@@ -303,6 +327,11 @@ class Runner(object):
             if self.args.list_only:
                 self.print_('\n'.join(all_tests))
             else:
+                if self.args.write_results_sidecar_to:
+                    result_set.sidecar = json_results.ResultsSidecar(
+                        h, self.args.write_results_sidecar_to)
+                    result_set.sidecar.start(self.metadata, int(h.time()),
+                                             all_tests, self.path_delimiter)
                 if self.args.print_start_time:
                     self.print_('Start running tests: %s' % str(datetime.now()))
                 for _ in range(self.args.repeat):
@@ -315,17 +344,28 @@ class Runner(object):
             self.cov.save()
         test_end = h.time()
 
-        trace = self._trace_from_results(result_set)
+        # The trace is only built when it is written, since it needs the
+        # output of every test.
+        trace = None
+        if self.args.write_trace_to:
+            trace = self._trace_from_results(result_set)
         if full_results:
             self._summarize(full_results)
             self._write(self.args.write_full_results_to, full_results)
             upload_ret = self._upload(full_results)
             reporting_end = h.time()
-            self._add_trace_event(trace, 'run', find_start, reporting_end)
-            self._add_trace_event(trace, 'discovery', find_start, find_end)
-            self._add_trace_event(trace, 'testing', find_end, test_end)
-            self._add_trace_event(trace, 'reporting', test_end, reporting_end)
-            self._write(self.args.write_trace_to, trace)
+            if trace is not None:
+                self._add_trace_event(
+                    trace, 'run', find_start, reporting_end,
+                    args={'printing_time': self.printing_time,
+                          'coalesced_updates': self.printer.coalesced_updates,
+                          'test_phases': _phase_totals(result_set.results)})
+                self._add_trace_event(
+                    trace, 'discovery', find_start, find_end)
+                self._add_trace_event(trace, 'testing', find_end, test_end)
+                self._add_trace_event(
+                    trace, 'reporting', test_end, reporting_end)
+                self._write(self.args.write_trace_to, trace)
             cov_ret = self.report_coverage() if self.args.coverage else 0
             # Exit with the code of the first failing step, but do not skip
             # any steps with short-circuiting.
@@ -419,8 +459,22 @@ class Runner(object):
         args = self.args
 
         self.stats = Stats(args.status_format, h.time, args.jobs)
+        refresh_rate = args.status_refresh_rate
+        if refresh_rate is None:
+            refresh_rate = (DEFAULT_STATUS_REFRESH_RATE if h.stdout.isatty()
+                            else 0)
         self.printer = Printer(
-            self.print_, args.overwrite, args.terminal_width)
+            self.print_, args.overwrite, args.terminal_width, h.time,
+            1.0 / refresh_rate if refresh_rate else 0)
+
+        if args.test_times_file:
+            try:
+                self.stats.expected_times = json_results.test_times(
+                    json.loads(h.read_text_file(args.test_times_file)))
+            except (IOError, ValueError, KeyError) as e:
+                self.print_('Error: could not read test times from "%s": %s' %
+                            (args.test_times_file, e), stream=h.stderr)
+                return 1
 
         if self.args.top_level_dirs and self.args.top_level_dir:
             self.print_(
@@ -572,7 +626,11 @@ class Runner(object):
                           name):
         h = self.host
         loader = self.loader
-        add_tests = _test_adder(test_set, classifier)
+        # Collect the tests first so that the expectations for all of them
+        # can be looked up in a single batch before they are classified.
+        test_cases = []
+        add_tests = _test_adder(
+            test_set, lambda _, test_case: test_cases.append(test_case))
 
         found = set()
         for d in top_level_dirs:
@@ -617,6 +675,22 @@ class Runner(object):
                 raise ImportError('\n'.join(loader.errors))
             raise ImportError(loader.errors)
 
+        self._prefetch_expectations(test_cases)
+        try:
+            for test_case in test_cases:
+                classifier(test_set, test_case)
+        finally:
+            self._prefetched_expectations = {}
+
+    def _prefetch_expectations(self, test_cases):
+        if not self.has_expectations or self.args.all:
+            return
+        prefix = self.args.test_name_prefix
+        test_names = [test_case.id()[len(prefix):] for test_case in test_cases
+                      if test_case.id().startswith(prefix)]
+        self._prefetched_expectations = (
+            self.expectations.expectations_for_many(test_names))
+
     def _run_tests(self, result_set, test_set, all_tests):
         h = self.host
         self.last_runs_retry_on_failure_tests = set()
@@ -641,6 +715,7 @@ class Runner(object):
         else:
             jobs = 1
 
+        self._start_result_sink_upload()
         child = _Child(self)
         pool_group = make_pool_group(h, jobs, self.args.stable_jobs,
                                      _run_one_test, child, _setup_process,
@@ -671,14 +746,16 @@ class Runner(object):
                                 (iteration, self.args.retry_limit))
                     self.print_('')
 
-                    stats = Stats(self.args.status_format, h.time, 1)
+                    stats = Stats(self.args.status_format, h.time, 1,
+                                  self.stats.expected_times)
                     stats.total = len(tests_to_retry)
+                    stats.add_tests(tests_to_retry)
                     test_set = TestSet(self.args.test_name_prefix)
                     test_set.isolated_tests = [
                         TestInput(name,
                             iteration=iteration) for name in tests_to_retry]
                     tests_to_retry = test_set
-                    retry_set = ResultSet()
+                    retry_set = ResultSet(result_set.sidecar)
                     self._run_one_set(stats, retry_set, tests_to_retry, 1,
                                       pool_group)
                     result_set.results.extend(retry_set.results)
@@ -697,9 +774,45 @@ class Runner(object):
                                                       self.path_delimiter)
 
         retcode = (json_results.exit_code_from_full_results(full_results)
-                   | result_sink.result_sink_retcode_from_result_set(result_set))
+                   | result_sink.result_sink_retcode_from_result_set(result_set)
+                   | int(any(resp[3] for resp in self.final_responses))
+                   | self._stop_result_sink_upload())
         return (retcode, full_results)
 
+    def _start_result_sink_upload(self):
+        # Even if the workers report their own results, the results left in
+        # the spool by earlier runs are uploaded from here, since this
+        # happens before any worker starts adding to the spool.
+        if not (self.args.result_sink_in_parent or
+                self.args.result_sink_spool_dir):
+            return
+        self.result_sink_reporter = result_sink.ResultSinkReporter(
+            self.host, self.args.disable_resultsink,
+            self.args.rdb_content_output_file)
+        self.result_sink_reporter.start_background_upload(
+            (self.args.result_sink_batch_size or
+             result_sink.DEFAULT_BATCH_SIZE),
+            (self.args.result_sink_flush_interval or
+             result_sink.DEFAULT_FLUSH_INTERVAL),
+            result_sink.DEFAULT_CONCURRENT_UPLOADS,
+            _flush_timeout(self.args),
+            self.args.result_sink_spool_dir, recover_spool=True)
+
+    def _stop_result_sink_upload(self):
+        if not self.result_sink_reporter:
+            return 0
+        reporter = self.result_sink_reporter
+        self.result_sink_reporter = None
+        return reporter.stop_background_upload()
+
+    def _report_to_result_sink(self, result):
+        if result.result_sink_payload is None:
+            return
+        self.result_sink_reporter.report_prepared_result(
+            result.result_sink_payload)
+        # The payload has a copy of the output, so don't hold on to it.
+        result.result_sink_payload = None
+
     def _run_one_set(self, stats, result_set, test_set, jobs, pool_group):
         self._skip_tests(stats, result_set, test_set.tests_to_skip)
         # Don't bother spinning up any pools if we don't have any use for them.
@@ -764,7 +877,7 @@ class Runner(object):
                 running_jobs.add(test_input.name)
                 self._print_test_started(stats, test_input)
 
-            result, should_retry_on_failure = pool.get()
+            result, should_retry_on_failure = self._get_result(pool, jobs)
             if result.is_regression:
                 stats.failed += 1
             if (self.args.retry_only_retry_on_failure_tests and
@@ -773,6 +886,7 @@ class Runner(object):
                 self.last_runs_retry_on_failure_tests.add(result.name)
 
             running_jobs.remove(result.name)
+            self._report_to_result_sink(result)
             result_set.add(result)
             stats.finished += 1
             self._print_test_finished(stats, result)
@@ -784,6 +898,20 @@ class Runner(object):
                     stats.exited_early = True
                     test_inputs = []
 
+    def _get_result(self, pool, jobs):
+        # Don't let a status update held back by the printer go stale while
+        # waiting on a slow test.
+        if self.printer.has_pending_update():
+            if jobs == 1:
+                # The test will be run in this process.
+                self.printer.write_pending()
+            else:
+                try:
+                    return pool.get(timeout=self.printer.min_interval)
+                except queue.Empty:
+                    self.printer.write_pending()
+        return pool.get()
+
     def _print_test_started(self, stats, test_input):
         if self.args.quiet:
             # Print nothing when --quiet was passed.
@@ -803,7 +931,7 @@ class Runner(object):
             self.update(test_start_msg, elide=(not self.args.verbose))
 
     def _print_test_finished(self, stats, result):
-        stats.add_time()
+        stats.add_time(result.name, result.took)
 
         assert result.actual in [ResultType.Failure, ResultType.Skip,
                                  ResultType.Pass]
@@ -841,9 +969,11 @@ class Runner(object):
         else:
             worker_str = ''
         suffix = '%s%s%s%s' % (result_str, bug_str, timing_str, worker_str)
-        out = result.out
-        err = result.err
+        # The output may have been spilled to files by the worker, so it is
+        # only read if it is going to be printed.
         if result.is_regression:
+            out = result.out
+            err = result.err
             if out or err:
                 suffix += ':\n'
             self.update(stats.format() + result.name + suffix, elide=False)
@@ -852,15 +982,17 @@ class Runner(object):
             for l in err.splitlines():
                 self.print_('  %s' % l)
         elif not self.args.quiet:
-            if self.args.verbose > 1 and (out or err):
+            print_output = self.args.verbose > 1
+            out = result.out if print_output else ''
+            err = result.err if print_output else ''
+            if out or err:
                 suffix += ':\n'
             self.update(stats.format() + result.name + suffix,
                         elide=(not self.args.verbose))
-            if self.args.verbose > 1:
-                for l in out.splitlines():
-                    self.print_('  %s' % l)
-                for l in err.splitlines():
-                    self.print_('  %s' % l)
+            for l in out.splitlines():
+                self.print_('  %s' % l)
+            for l in err.splitlines():
+                self.print_('  %s' % l)
             if self.args.verbose:
                 self.flush()
 
@@ -916,29 +1048,36 @@ class Runner(object):
         h = self.host
         obj = None
         if h.exists(path):
-            contents = h.read_text_file(path)
+            contents = h.read_binary_file(path)
             if contents:
-                obj = json.loads(contents)
+                obj = json_results.decode_json(contents)
             if delete:
                 h.remove(path)
         return obj
 
     def _write(self, path, obj):
         if path:
-            self.host.write_text_file(path, json.dumps(obj, indent=2) + '\n')
+            json_results.write_json_file(
+                self.host, path, obj,
+                json_results.resolve_compression(self.args.compress_outputs))
 
     def _upload(self, full_results):
         h = self.host
         if not self.args.test_results_server:
             return 0
 
+        compression = json_results.resolve_compression(
+            self.args.compress_outputs)
         url, content_type, data = json_results.make_upload_request(
             self.args.test_results_server, self.args.builder_name,
             self.args.master_name, self.args.test_type,
-            full_results)
+            full_results, compression)
+        headers = {'Content-Type': content_type}
+        if compression:
+            headers['Content-Encoding'] = compression
 
         try:
-            h.fetch(url, data, {'Content-Type': content_type})
+            h.fetch(url, data, headers)
             return 0
         except Exception as e:
             h.print_('Uploading the JSON results raised "%s"' % str(e))
@@ -958,7 +1097,7 @@ class Runner(object):
         # https://coverage.readthedocs.io/en/6.4.2/config.html#report-fail-under
         return 2 if percentage < cov.get_option('report:fail_under') else 0
 
-    def _add_trace_event(self, trace, name, start, end):
+    def _add_trace_event(self, trace, name, start, end, args=None):
         event = {
             'name': name,
             'ts': int((start - self.stats.started_time) * 1000000),
@@ -967,6 +1106,8 @@ class Runner(object):
             'pid': self.host.getpid(),
             'tid': 0,
         }
+        if args:
+            event['args'] = args
         trace['traceEvents'].append(event)
 
     def _trace_from_results(self, result_set):
@@ -991,8 +1132,9 @@ class Runner(object):
             args = OrderedDict()
             args['expected'] = sorted(str(r) for r in result.expected)
             args['actual'] = str(result.actual)
-            args['out'] = result.out
-            args['err'] = result.err
+            out, err, _ = result.stored_text()
+            args['out'] = _trace_text(out)
+            args['err'] = _trace_text(err)
             args['code'] = result.code
             args['unexpected'] = result.unexpected
             args['flaky'] = result.flaky
@@ -1001,6 +1143,18 @@ class Runner(object):
             event['args'] = args
 
             trace['traceEvents'].append(event)
+            if self.args.trace_test_phases:
+                for name, phase_started, phase_took in result.phases:
+                    trace['traceEvents'].append({
+                        'name': name,
+                        'cat': 'phase',
+                        'ts': int((phase_started -
+                                   self.stats.started_time) * 1000000),
+                        'dur': int(phase_took * 1000000),
+                        'ph': 'X',
+                        'pid': result.pid,
+                        'tid': result.worker,
+                    })
         return trace
 
     def expectations_for(self, test_case):
@@ -1053,7 +1207,9 @@ class Runner(object):
         if self.args.all:
             return False
         test_name = test_case.id()[len(self.args.test_name_prefix):]
-        if self.has_expectations:
+        if test_name in self._prefetched_expectations:
+            expected_results = self._prefetched_expectations[test_name].results
+        elif self.has_expectations:
             expected_results = self.expectations.expectations_for(test_name).results
         else:
             expected_results = {ResultType.Pass}
@@ -1100,6 +1256,15 @@ class _Child(object):
         self.dry_run = parent.args.dry_run
         self.loader = parent.loader
         self.passthrough = parent.args.passthrough
+        self.capture_fds = parent.args.capture_fds
+        self.output_limit = None
+        if (parent.args.max_output_head_kb is not None or
+                parent.args.max_output_tail_kb is not None):
+            self.output_limit = OutputLimit(
+                head=(parent.args.max_output_head_kb or 0) * 1024,
+                tail=(parent.args.max_output_tail_kb or 0) * 1024,
+                keep_full=(parent.args.save_full_output and
+                           bool(parent.artifact_output_dir)))
         self.context = parent.context
         self.setup_fn = parent.setup_fn
         self.teardown_fn = parent.teardown_fn
@@ -1109,13 +1274,40 @@ class _Child(object):
         self.loaded_suites = {}
         self.cov = None
         self.has_expectations = parent.has_expectations
+        # Workers only ever look expectations up, so give them a compact
+        # snapshot rather than a copy of every parsed Expectation.
         self.expectations = parent.expectations
+        if parent.has_expectations:
+            try:
+                self.expectations = parent.expectations.compact()
+            except ValueError as e:
+                # The full expectations answer lookups just as well, they
+                # are only more expensive to hand to the workers.
+                parent.print_('Warning: could not compact the expectations, '
+                              'using them as parsed: %s' % e,
+                              stream=parent.host.stderr)
         self.test_name_prefix = parent.args.test_name_prefix
         self.artifact_output_dir = parent.artifact_output_dir
+        self.dedupe_artifacts = parent.args.dedupe_artifacts
+        self.artifact_blob_store = None
+        self.artifact_writer_threads = parent.args.artifact_writer_threads
+        self.artifact_writer = None
+        self.archive_artifacts = parent.args.archive_artifacts
+        self.artifact_archive = None
+        self.artifact_compression = json_results.resolve_compression(
+            parent.args.compress_outputs)
         self.result_sink_reporter = None
         self.disable_resultsink = parent.args.disable_resultsink
         self.result_sink_output_file = parent.args.rdb_content_output_file
+        self.result_sink_batch_size = parent.args.result_sink_batch_size
+        self.result_sink_in_parent = parent.args.result_sink_in_parent
+        self.result_sink_flush_interval = (
+            parent.args.result_sink_flush_interval or
+            result_sink.DEFAULT_FLUSH_INTERVAL)
+        self.result_sink_flush_timeout = _flush_timeout(parent.args)
+        self.result_sink_spool_dir = parent.args.result_sink_spool_dir
         self.jobs = parent.args.jobs
+        self.parent_pid = os.getpid()
         self.starting_directory = parent.starting_directory
         self.chromium_build_directory = parent.chromium_build_directory
 
@@ -1124,10 +1316,32 @@ class _Child(object):
         return _expectations_for(test_case, expectations, self.test_name_prefix)
 
 
+def _flush_timeout(args):
+    if args.result_sink_flush_timeout is None:
+        return result_sink.DEFAULT_FLUSH_TIMEOUT
+    return args.result_sink_flush_timeout
+
+
 def _setup_process(host, worker_num, child):
     child.host = host
     child.result_sink_reporter = result_sink.ResultSinkReporter(
             host, child.disable_resultsink, child.result_sink_output_file)
+    if ((child.result_sink_batch_size or child.result_sink_spool_dir) and
+            not child.result_sink_in_parent):
+        child.result_sink_reporter.start_background_upload(
+            child.result_sink_batch_size or 1,
+            child.result_sink_flush_interval,
+            flush_timeout=child.result_sink_flush_timeout,
+            spool_dir=child.result_sink_spool_dir)
+    if child.artifact_writer_threads and child.artifact_output_dir:
+        child.artifact_writer = artifacts.AsyncWriter(
+            host, child.artifact_writer_threads)
+    if child.archive_artifacts and child.artifact_output_dir:
+        child.artifact_archive = artifacts.ArtifactArchive(
+            child.artifact_output_dir, host, worker_num)
+    if child.dedupe_artifacts and child.artifact_output_dir:
+        child.artifact_blob_store = artifacts.BlobStore(
+            child.artifact_output_dir, host)
     child.worker_num = worker_num
     # pylint: disable=protected-access
 
@@ -1156,11 +1370,21 @@ def _teardown_process(child):
             exc = e
             pass
 
+    if child.artifact_writer:
+        child.artifact_writer.Shutdown()
+    if child.artifact_archive:
+        child.artifact_archive.Close()
+
+    # Results uploaded in the background were tentatively reported as
+    # successes, so any failure to upload them is returned from here.
+    result_sink_retcode = (
+        child.result_sink_reporter.stop_background_upload())
+
     if child.cov:  # pragma: no cover
         child.cov.stop()
         child.cov.save()
 
-    return (child.worker_num, res, exc)
+    return (child.worker_num, res, exc, result_sink_retcode)
 
 
 def _run_one_test(child, test_input):
@@ -1181,6 +1405,7 @@ def _run_one_test(child, test_input):
     test_name = test_input.name
 
     started = h.time()
+    timer = _PhaseTimer(h.time, started)
 
     # It is important to capture the output before loading the test
     # to ensure that
@@ -1191,10 +1416,13 @@ def _run_one_test(child, test_input):
     # but could come up when testing non-typ code as well.
     if child.debugger:
         h.print_('')
-    h.capture_output(divert=not child.passthrough, debugger=child.debugger)
+    h.capture_output(divert=not child.passthrough, debugger=child.debugger,
+                     fds=child.capture_fds, limit=child.output_limit)
+    timer.mark('capture_output')
     (expected_results,
         should_retry_on_failure,
         associated_bugs) = _get_expectation_information()
+    timer.mark('expectations')
     ex_str = ''
     try:
         orig_skip = unittest.skip
@@ -1204,10 +1432,13 @@ def _run_one_test(child, test_input):
             unittest.skipIf = lambda condition, reason: lambda x: x
         elif ResultType.Skip in expected_results:
             h.restore_output()
-            return (Result(test_name, ResultType.Skip, started, 0,
-                           child.worker_num, expected=expected_results,
-                           unexpected=False, pid=pid,
-                           associated_bugs=associated_bugs), False)
+            timer.mark('restore_output')
+            result = Result(test_name, ResultType.Skip, started, 0,
+                            child.worker_num, expected=expected_results,
+                            unexpected=False, pid=pid,
+                            associated_bugs=associated_bugs)
+            result.phases = timer.phases
+            return (result, False)
 
         test_name_to_load = child.test_name_prefix + test_name
         try:
@@ -1240,18 +1471,25 @@ def _run_one_test(child, test_input):
         unittest.skipIf = orig_skip_if
 
     tests = list(suite)
+    timer.mark('load')
     if len(tests) != 1:
         err = 'Failed to load "%s" in run_one_test' % test_name
         if ex_str:  # pragma: untested
             err += '\n  ' + '\n  '.join(ex_str.splitlines())
 
         h.restore_output()
-        return (Result(test_name, ResultType.Failure, started, took=0,
-                       worker=child.worker_num, unexpected=True, code=1,
-                       err=err, pid=pid), False)
+        timer.mark('restore_output')
+        result = Result(test_name, ResultType.Failure, started, took=0,
+                        worker=child.worker_num, unexpected=True, code=1,
+                        err=err, pid=pid)
+        result.phases = timer.phases
+        return (result, False)
 
     art = artifacts.Artifacts(
-        child.artifact_output_dir, h, test_input.iteration, test_name)
+        child.artifact_output_dir, h, test_input.iteration, test_name,
+        blob_store=child.artifact_blob_store,
+        writer=child.artifact_writer, archive=child.artifact_archive,
+        compression=child.artifact_compression)
 
     test_case = tests[0]
     if isinstance(test_case, TypTestCase):
@@ -1265,6 +1503,7 @@ def _run_one_test(child, test_input):
     err = ''
     if child.post_mortem:
         _patch_test_case_for_post_mortem(test_case)
+    timer.mark('prepare')
     try:
         if child.dry_run:
             pass
@@ -1273,11 +1512,19 @@ def _run_one_test(child, test_input):
         else:
             suite.run(test_result)
     finally:
-        out, err = h.restore_output()
+        timer.mark('test')
+        # Large fd-level captures in workers are left in their files, so that
+        # they never need to be held in memory or sent through the queue.
+        out, err = h.restore_output(
+            max_inline=(_SPILL_THRESHOLD if os.getpid() != child.parent_pid
+                        else None))
+        _save_full_output(h, art)
+        _wait_for_artifact_writes(art, test_case, test_result)
         # Clear the artifact implementation so that later tests don't try to
         # use a stale instance.
         if isinstance(test_case, TypTestCase):
             test_case.set_artifacts(None)
+        timer.mark('restore_output')
 
     # We retrieve the expected results again since it's possible that running
     # the test changed something, e.g. restarted the browser with new browser
@@ -1285,6 +1532,7 @@ def _run_one_test(child, test_input):
     (expected_results,
         should_retry_on_failure,
         associated_bugs) = _get_expectation_information()
+    timer.mark('expectations')
 
     took = h.time() - started
     additional_tags = None
@@ -1300,6 +1548,7 @@ def _run_one_test(child, test_input):
         test_line = inspect.getsourcelines(test_method)[1]
     else:
         test_line = None
+    timer.mark('inspect')
 
     # If the test signaled that it should be retried on failure, do so.
     if isinstance(test_case, TypTestCase):
@@ -1313,11 +1562,9 @@ def _run_one_test(child, test_input):
                            child.worker_num, expected={ResultType.Skip},
                            unexpected=False, pid=pid,
                            associated_bugs=associated_bugs)
-            result.result_sink_retcode =\
-                    child.result_sink_reporter.report_individual_test_result(
-                        result, child.artifact_output_dir, child.expectations,
-                        test_location, test_line, child.test_name_prefix,
-                        additional_tags)
+            _report_and_spill(child, result, test_location, test_line,
+                              additional_tags, timer)
+            result.phases = timer.phases
             return (result, False)
         should_retry_on_failure = (should_retry_on_failure
                                    or test_case.retryOnFailure)
@@ -1326,14 +1573,64 @@ def _run_one_test(child, test_input):
                                     expected_results, child.has_expectations,
                                     art.artifacts, art.in_memory_text_artifacts,
                                     associated_bugs)
-    result.result_sink_retcode =\
-            child.result_sink_reporter.report_individual_test_result(
-                result, child.artifact_output_dir, child.expectations,
-                test_location, test_line, child.test_name_prefix,
-                additional_tags)
+    timer.mark('make_result')
+    _report_and_spill(child, result, test_location, test_line,
+                      additional_tags, timer)
+    result.phases = timer.phases
     return (result, should_retry_on_failure)
 
 
+def _report_and_spill(child, result, test_location, test_line,
+                      additional_tags, timer):
+    """Reports |result| to ResultSink and spills its large text in workers.
+
+    Spilling keeps large output from holding up the response queue. If the
+    parent uploads the result, the text is spilled first, so that the
+    payload refers to the files instead of holding another copy of the text.
+    Otherwise the worker uploads the result itself, which needs the text.
+    """
+    spill = os.getpid() != child.parent_pid
+    if spill and child.result_sink_in_parent:
+        result.spill_large_text(_SPILL_THRESHOLD)
+        timer.mark('spill')
+    _report_to_result_sink(child, result, test_location, test_line,
+                           additional_tags)
+    timer.mark('result_sink')
+    if spill and not child.result_sink_in_parent:
+        result.spill_large_text(_SPILL_THRESHOLD)
+        timer.mark('spill')
+
+
+def _report_to_result_sink(child, result, test_location, test_line,
+                           additional_tags):
+    reporter = child.result_sink_reporter
+    args = (result, child.artifact_output_dir, child.expectations,
+            test_location, test_line, child.test_name_prefix, additional_tags)
+    if child.result_sink_in_parent:
+        # The parent uploads the result once it gets it back.
+        result.result_sink_payload = (
+            reporter.prepare_individual_test_result(*args))
+    else:
+        result.result_sink_retcode = (
+            reporter.report_individual_test_result(*args))
+
+
+class _PhaseTimer(object):
+    """Records how long each phase of running a test takes."""
+
+    def __init__(self, time_fn, started):
+        self._time = time_fn
+        self._last = started
+        # A list of (name, start time, duration) tuples.
+        self.phases = []
+
+    def mark(self, name):
+        """Ends the phase |name|, which started when the last one ended."""
+        now = self._time()
+        self.phases.append((name, self._last, now - self._last))
+        self._last = now
+
+
 def _run_under_debugger(host, test_case, suite,
                         test_result):  # pragma: no cover
     # Access to protected member pylint: disable=W0212
@@ -1407,7 +1704,7 @@ def _result_from_test_result(test_result, test_name, started, took, out, err,
     if test_result.failures:
         actual = ResultType.Failure
         code = 1
-        err = err + test_result.failures[0][1]
+        err = _append_output(err, test_result.failures[0][1])
         unexpected = actual not in expected_results
         for i, failure in enumerate(test_result.failures):
             if failure_reason is None:
@@ -1415,14 +1712,14 @@ def _result_from_test_result(test_result, test_name, started, took, out, err,
     elif test_result.errors:
         actual = ResultType.Failure
         code = 1
-        err = err + test_result.errors[0][1]
+        err = _append_output(err, test_result.errors[0][1])
         unexpected = actual not in expected_results
         for i, error in enumerate(test_result.errors):
             if failure_reason is None:
                 failure_reason = _failure_reason_from_traceback(error[1])
     elif test_result.skipped:
         actual = ResultType.Skip
-        err = err + test_result.skipped[0][1]
+        err = _append_output(err, test_result.skipped[0][1])
         code = 0
         if has_expectations:
             unexpected = actual not in expected_results
@@ -1432,7 +1729,7 @@ def _result_from_test_result(test_result, test_name, started, took, out, err,
     elif test_result.expectedFailures:
         actual = ResultType.Failure
         code = 1
-        err = err + test_result.expectedFailures[0][1]
+        err = _append_output(err, test_result.expectedFailures[0][1])
         unexpected = False
     elif test_result.unexpectedSuccesses:
         actual = ResultType.Pass
@@ -1454,6 +1751,55 @@ def _result_from_test_result(test_result, test_name, started, took, out, err,
                   failure_reason, associated_bugs)
 
 
+def _phase_totals(results):
+    """Returns the total time spent in each phase of running the tests."""
+    totals = OrderedDict()
+    for result in results:
+        for name, _, took in result.phases:
+            totals[name] = totals.get(name, 0) + took
+    return totals
+
+
+def _save_full_output(host, art):
+    """Saves the full output of any truncated streams as artifacts."""
+    for name, full in zip((_FULL_STDOUT_ARTIFACT, _FULL_STDERR_ARTIFACT),
+                          host.full_output):
+        if full is not None:
+            # The full output can be very large, so stream it from the file
+            # it was captured to rather than reading it into memory.
+            with art.OpenArtifact(name, name + '.txt',
+                                  force_overwrite=True) as f:
+                full.copy_to(f)
+    host.full_output = (None, None)
+
+
+def _wait_for_artifact_writes(art, test_case, test_result):
+    """Fails the test if any of its artifacts could not be written."""
+    exceptions = art.WaitForWrites()
+    if exceptions:
+        test_result.errors.append((test_case, ''.join(
+            'Failed to write an artifact:\n' +
+            ''.join(traceback.format_exception(type(e), e, e.__traceback__))
+            for e in exceptions)))
+
+
+def _trace_text(text):
+    """Returns |text| for a trace, leaving out text that was spilled."""
+    if isinstance(text, SpilledText):
+        # Reading it back would hold all of the large output in memory.
+        return '[... %d bytes of output not included in the trace ...]' % (
+            os.path.getsize(text.path))
+    return text
+
+
+def _append_output(output, text):
+    """Returns |output| with |text| added, where |output| may be spilled."""
+    if isinstance(output, SpilledText):
+        output.append(text)
+        return output
+    return output + text
+
+
 def _failure_reason_from_traceback(traceback):
     """Attempts to extract a failure reason from formatted Traceback data.
 
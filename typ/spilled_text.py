@@ -0,0 +1,95 @@
+# Copyright 2025 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Keeps large text in temporary files rather than in memory."""
+
+import atexit
+import os
+import tempfile
+from typing import Set
+
+
+# The number of characters SpilledText.copy_to() reads at a time.
+_SPILLED_COPY_CHUNK_SIZE = 1 << 20
+
+# The files SpilledTexts refer to that this process has to remove. Any that
+# were never read are removed when the process exits.
+_spilled_paths: Set[str] = set()
+
+
+def _remove_spilled_files():
+    for path in _spilled_paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    _spilled_paths.clear()
+
+
+atexit.register(_remove_spilled_files)
+
+
+class SpilledText(object):
+    """A reference to text that was written to a temporary file.
+
+    The file is removed when it is read, or else when the process that owns
+    it exits. Pickling a SpilledText, e.g. to send a Result from a worker to
+    the parent process, hands the file over to the process that unpickles it.
+    """
+
+    def __init__(self, path, errors='surrogatepass'):
+        """Args:
+            path: The path to the UTF-8 encoded file.
+            errors: How to handle encoding errors when reading the file.
+        """
+        self.path = path
+        self.errors = errors
+        _spilled_paths.add(path)
+
+    def __getstate__(self):
+        _spilled_paths.discard(self.path)
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        _spilled_paths.add(self.path)
+
+    @classmethod
+    def write(cls, text):
+        fd, path = tempfile.mkstemp(prefix='typ-', suffix='.txt')
+        with os.fdopen(fd, 'w', encoding='utf-8', errors='surrogatepass',
+                       newline='') as f:
+            f.write(text)
+        return cls(path)
+
+    def append(self, text):
+        """Adds |text| to the end of the file."""
+        with open(self.path, 'a', encoding='utf-8', errors='surrogatepass',
+                  newline='') as f:
+            f.write(text)
+
+    def read(self, remove=True):
+        """Returns the text and, if |remove|, removes the file it was in."""
+        with open(self.path, encoding='utf-8', errors=self.errors,
+                  newline='') as f:
+            text = f.read()
+        if remove:
+            self.remove()
+        return text
+
+    def copy_to(self, f):
+        """Writes the text to the binary file |f| and removes the file.
+
+        Unlike read(), this does not hold the whole text in memory.
+        """
+        with open(self.path, encoding='utf-8', errors=self.errors,
+                  newline='') as src:
+            for chunk in iter(lambda: src.read(_SPILLED_COPY_CHUNK_SIZE), ''):
+                f.write(chunk.encode('utf-8', errors='surrogatepass'))
+        self.remove()
+
+    def remove(self):
+        """Removes the file without reading it."""
+        os.remove(self.path)
+        _spilled_paths.discard(self.path)
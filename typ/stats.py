@@ -12,10 +12,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+
 
 class Stats(object):
 
-    def __init__(self, status_format, time_fn, size):
+    def __init__(self, status_format, time_fn, size, expected_times=None):
+        """Args:
+            status_format: The format of the status line; see format().
+            time_fn: A function returning the current time, in seconds.
+            size: The number of tests run in parallel. This is also the
+                number of finished tests the current rate is computed from.
+            expected_times: An optional dict mapping test names to how long
+                they took in an earlier run, in seconds, for estimating how
+                much time is left.
+        """
         self.fmt = status_format
         self.failed = 0
         self.finished = 0
@@ -23,63 +34,177 @@ class Stats(object):
         self.total = 0
         self.started_time = time_fn()
         self.exited_early = False
-        self._times = []
         self._size = size
         self._time = time_fn
-        self._times.append(self.started_time)
+        # The times the last |size| tests finished at, plus the one before,
+        # for computing the current rate.
+        self._times = collections.deque([self.started_time], maxlen=size + 1)
+        self.expected_times = expected_times or {}
+        self._expected_mean = None
+        # The number of runs of each test that have yet to finish, and their
+        # total expected time (or number, for tests without one).
+        self._remaining = {}
+        self._remaining_count = 0
+        self._remaining_known_time = 0.0
+        self._remaining_unknown = 0
+        self._finished_time = 0.0
+        self._finished_time_count = 0
+
+    @property
+    def fmt(self):
+        return self._fmt
+
+    @fmt.setter
+    def fmt(self, status_format):
+        self._fmt = status_format
+        self._segments = self._compile(status_format)
+
+    def add_tests(self, test_names):
+        """Records tests that are going to be run.
+
+        This is only needed for the remaining time estimates (%E and %W),
+        which cover the tests added here that have not finished yet.
+        """
+        for name in test_names:
+            self._remaining[name] = self._remaining.get(name, 0) + 1
+            self._remaining_count += 1
+            expected = self.expected_times.get(name)
+            if expected is None:
+                self._remaining_unknown += 1
+            else:
+                self._remaining_known_time += expected
+
+    def add_time(self, test_name=None, took=None):
+        """Records that a test finished.
 
-    def add_time(self):
-        if len(self._times) > self._size:
-            self._times.pop(0)
+        Args:
+            test_name: The name of the test, if it was passed to add_tests().
+            took: How long the test took, in seconds, for estimating the time
+                of tests with no expected time.
+        """
         self._times.append(self._time())
+        if took is not None:
+            self._finished_time += took
+            self._finished_time_count += 1
+        count = self._remaining.get(test_name)
+        if count:
+            if count == 1:
+                del self._remaining[test_name]
+            else:
+                self._remaining[test_name] = count - 1
+            self._remaining_count -= 1
+            expected = self.expected_times.get(test_name)
+            if expected is None:
+                self._remaining_unknown -= 1
+            else:
+                self._remaining_known_time -= expected
+
+    def remaining_work(self):
+        """Returns the estimated seconds of test time left, or None.
+
+        Tests with an expected time are counted at that time, and the others
+        at the average time of the tests finished so far, or of the expected
+        times if no test has finished yet.
+        """
+        work = max(self._remaining_known_time, 0.0)
+        if not self._remaining_unknown:
+            return work
+        if self._finished_time_count:
+            mean = self._finished_time / self._finished_time_count
+        elif self.expected_times:
+            if self._expected_mean is None:
+                self._expected_mean = (sum(self.expected_times.values()) /
+                                       len(self.expected_times))
+            mean = self._expected_mean
+        else:
+            return None
+        return work + self._remaining_unknown * mean
+
+    def eta(self):
+        """Returns the estimated seconds until the tests finish, or None."""
+        work = self.remaining_work()
+        if work is None or not self._remaining_count:
+            return work
+        return work / min(self._size, self._remaining_count)
 
     def format(self):
-        # Too many statements pylint: disable=R0915
-        out = ''
+        return ''.join([segment if segment.__class__ is str else segment()
+                        for segment in self._segments])
+
+    def _compile(self, status_format):
+        """Splits |status_format| into literal strings and field functions."""
+        fields = {
+            'c': self._current_rate,
+            'e': self._elapsed_time,
+            'E': self._format_eta,
+            'f': lambda: str(self.finished),
+            'o': self._overall_rate,
+            'p': self._percent_started,
+            'r': lambda: str(self.started - self.finished),
+            's': lambda: str(self.started),
+            't': lambda: str(self.total),
+            'u': lambda: str(self.total - self.finished),
+            'W': self._format_remaining_work,
+        }
+        segments = []
+        literal = ''
         p = 0
-        end = len(self.fmt)
+        end = len(status_format)
         while p < end:
-            c = self.fmt[p]
+            c = status_format[p]
             if c == '%' and p < end - 1:
-                cn = self.fmt[p + 1]
-                if cn == 'c':
-                    elapsed = self._times[-1] - self._times[0]
-                    if elapsed > 0:
-                        out += '%5.1f' % ((len(self._times) - 1) / elapsed)
-                    else:
-                        out += '-'
-                elif cn == 'e':
-                    now = self._time()
-                    assert now >= self.started_time
-                    out += '%-5.3f' % (now - self.started_time)
-                elif cn == 'f':
-                    out += str(self.finished)
-                elif cn == 'o':
-                    now = self._time()
-                    if now > self.started_time:
-                        out += '%5.1f' % (self.finished * 1.0 /
-                                          (now - self.started_time))
-                    else:
-                        out += '-'
-                elif cn == 'p':
-                    if self.total:
-                        out += '%5.1f' % (self.started * 100.0 / self.total)
-                    else:
-                        out += '-'
-                elif cn == 'r':
-                    out += str(self.started - self.finished)
-                elif cn == 's':
-                    out += str(self.started)
-                elif cn == 't':
-                    out += str(self.total)
-                elif cn == 'u':
-                    out += str(self.total - self.finished)
+                cn = status_format[p + 1]
+                if cn in fields:
+                    if literal:
+                        segments.append(literal)
+                        literal = ''
+                    segments.append(fields[cn])
                 elif cn == '%':
-                    out += '%'
+                    literal += '%'
                 else:
-                    out += c + cn
+                    literal += c + cn
                 p += 2
             else:
-                out += c
+                literal += c
                 p += 1
-        return out
+        if literal:
+            segments.append(literal)
+        return segments
+
+    def _current_rate(self):
+        elapsed = self._times[-1] - self._times[0]
+        if elapsed > 0:
+            return '%5.1f' % ((len(self._times) - 1) / elapsed)
+        return '-'
+
+    def _elapsed_time(self):
+        now = self._time()
+        assert now >= self.started_time
+        return '%-5.3f' % (now - self.started_time)
+
+    def _format_eta(self):
+        eta = self.eta()
+        if eta is None:
+            return '-'
+        minutes, seconds = divmod(int(eta + 0.5), 60)
+        hours, minutes = divmod(minutes, 60)
+        if hours:
+            return '%d:%02d:%02d' % (hours, minutes, seconds)
+        return '%d:%02d' % (minutes, seconds)
+
+    def _format_remaining_work(self):
+        work = self.remaining_work()
+        if work is None:
+            return '-'
+        return '%.1f' % work
+
+    def _overall_rate(self):
+        now = self._time()
+        if now > self.started_time:
+            return '%5.1f' % (self.finished * 1.0 / (now - self.started_time))
+        return '-'
+
+    def _percent_started(self):
+        if self.total:
+            return '%5.1f' % (self.started * 100.0 / self.total)
+        return '-'
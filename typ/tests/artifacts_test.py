@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import gzip
 import hashlib
 import logging
 import os
@@ -22,6 +23,7 @@ import unittest
 
 from typ import artifacts
 from typ.fakes.host_fake import FakeHost
+from typ.host import Host
 
 class ArtifactsArtifactCreationTests(unittest.TestCase):
 
@@ -191,6 +193,102 @@ class ArtifactsArtifactCreationTests(unittest.TestCase):
         'linux2', artifacts.LINUX_MAX_FILE_NAME)
 
 
+class ArtifactsOpenArtifactTests(unittest.TestCase):
+  def test_open_artifact_writes_to_disk_on_close(self):
+    host = FakeHost()
+    output_dir = '%stmp' % host.sep
+    ar = artifacts.Artifacts(output_dir, host, iteration=1,
+                             artifacts_base_dir='a.b.c')
+    file_rel_path = host.join('traces', 'trace.json')
+    with ar.OpenArtifact('trace', file_rel_path) as f:
+      f.write(b'con')
+      f.write(b'tents')
+      self.assertEqual(ar.artifacts, {})
+    subdir_relative_path = host.join('a.b.c', 'retry_1', file_rel_path)
+    self.assertEqual(ar.artifacts, {'trace': [subdir_relative_path]})
+    self.assertEqual(
+        host.read_binary_file(output_dir, subdir_relative_path), b'contents')
+
+  def test_open_text_artifact(self):
+    host = FakeHost()
+    output_dir = '%stmp' % host.sep
+    ar = artifacts.Artifacts(output_dir, host)
+    with ar.OpenArtifact('log', 'log.txt', write_as_text=True) as f:
+      f.write('log')
+    self.assertEqual(host.read_text_file(output_dir, 'log.txt'), 'log')
+
+  def test_open_artifact_not_added_on_exception(self):
+    host = FakeHost()
+    output_dir = '%stmp' % host.sep
+    ar = artifacts.Artifacts(output_dir, host)
+    with self.assertRaises(RuntimeError):
+      with ar.OpenArtifact('trace', 'trace.json') as f:
+        f.write(b'partial')
+        raise RuntimeError('test failure')
+    self.assertEqual(ar.artifacts, {})
+
+  def test_opening_existing_artifact_raises_value_error(self):
+    host = FakeHost()
+    output_dir = '%stmp' % host.sep
+    ar = artifacts.Artifacts(output_dir, host)
+    ar.CreateArtifact('artifact_name', 'test.jpg', b'contents')
+    with self.assertRaises(ValueError) as ve:
+      with ar.OpenArtifact('artifact_name', 'test.jpg'):
+        pass
+    self.assertIn('already exists', str(ve.exception))
+    with ar.OpenArtifact('artifact_name', 'test.jpg',
+                         force_overwrite=True) as f:
+      f.write(b'overwritten contents')
+    self.assertEqual(ar.artifacts, {'artifact_name': ['test.jpg']})
+    self.assertEqual(host.read_binary_file(output_dir, 'test.jpg'),
+                     b'overwritten contents')
+
+  def test_open_artifact_path_too_long(self):
+    host = FakeHost()
+    host.platform = 'win32'
+    output_dir = '%stmp' % host.sep
+    ar = artifacts.Artifacts(output_dir, host)
+    file_rel_path = 'a' * (artifacts.WINDOWS_MAX_PATH)
+    with self.assertLogs(logging.getLogger(), logging.ERROR):
+      with ar.OpenArtifact('artifact_name', file_rel_path) as f:
+        f.write(b'contents')
+    self.assertEqual(ar.artifacts, {})
+    self.assertEqual(host.written_files, {})
+
+  def test_open_text_artifact_path_too_long(self):
+    host = FakeHost()
+    host.platform = 'win32'
+    output_dir = '%stmp' % host.sep
+    ar = artifacts.Artifacts(output_dir, host)
+    file_rel_path = 'a' * (artifacts.WINDOWS_MAX_PATH)
+    with self.assertLogs(logging.getLogger(), logging.ERROR):
+      with ar.OpenArtifact('artifact_name', file_rel_path,
+                           write_as_text=True) as f:
+        self.assertEqual(f.encoding, 'utf-8')
+        f.write('\u2603')
+    self.assertEqual(ar.artifacts, {})
+
+
+class ArtifactsCompressionTests(unittest.TestCase):
+  def test_text_artifacts_are_compressed(self):
+    host = FakeHost()
+    output_dir = '%stmp' % host.sep
+    ar = artifacts.Artifacts(output_dir, host, artifacts_base_dir='a.b.c',
+                             compression='gzip')
+    ar.CreateArtifact('log', 'log.txt', 'log', write_as_text=True)
+    ar.CreateArtifact('screenshot', 'screenshot.png', b'contents')
+    log_path = host.join('a.b.c', 'log.txt.gz')
+    self.assertEqual(ar.artifacts, {
+        'log': [log_path],
+        'screenshot': [host.join('a.b.c', 'screenshot.png')],
+    })
+    self.assertEqual(
+        gzip.decompress(host.read_binary_file(output_dir, log_path)), b'log')
+    self.assertEqual(
+        host.read_binary_file(output_dir, 'a.b.c', 'screenshot.png'),
+        b'contents')
+
+
 class ArtifactsCreateInMemoryTextArtifactTests(unittest.TestCase):
   def test_create_success(self):
     ar = artifacts.Artifacts('', FakeHost())
@@ -218,6 +316,349 @@ class ArtifactsCreateInMemoryTextArtifactTests(unittest.TestCase):
       ar.CreateInMemoryTextArtifact('artifact_name', b'content')
 
 
+class ArtifactsBlobStoreTests(unittest.TestCase):
+  def _blob_path(self, host, data, extension):
+    digest = hashlib.sha256(data).hexdigest()
+    return host.join('blobs', digest[:2], digest + extension)
+
+  def test_identical_artifacts_are_written_once(self):
+    host = FakeHost()
+    output_dir = '%stmp' % host.sep
+    store = artifacts.BlobStore(output_dir, host)
+    ar = artifacts.Artifacts(output_dir, host, artifacts_base_dir='a.b.c',
+                             blob_store=store)
+    ar.CreateArtifact('screenshot', 'screenshot.png', b'contents')
+    ar.CreateArtifact('log', 'log.txt', 'log', write_as_text=True)
+    retry_ar = artifacts.Artifacts(output_dir, host, iteration=1,
+                                   artifacts_base_dir='a.b.c',
+                                   blob_store=store)
+    retry_ar.CreateArtifact('screenshot', 'screenshot.png', b'contents')
+
+    blob_path = self._blob_path(host, b'contents', '.png')
+    self.assertEqual(ar.artifacts, {
+        'screenshot': [blob_path],
+        'log': [self._blob_path(host, b'log', '.txt')],
+    })
+    self.assertEqual(retry_ar.artifacts, {'screenshot': [blob_path]})
+    self.assertEqual(
+        host.read_binary_file(host.join(output_dir, blob_path)), b'contents')
+    # Removed temporary files are recorded as None.
+    written = {path for path, contents in host.written_files.items()
+               if contents is not None}
+    self.assertEqual(written, {
+        host.join(output_dir, blob_path),
+        host.join(output_dir, self._blob_path(host, b'log', '.txt')),
+    })
+
+  def test_existing_blob_is_not_rewritten(self):
+    host = FakeHost()
+    output_dir = '%stmp' % host.sep
+    blob_path = self._blob_path(host, b'contents', '')
+    host.write_binary_file(host.join(output_dir, blob_path), b'contents')
+    host.written_files = {}
+    store = artifacts.BlobStore(output_dir, host)
+    self.assertEqual(store.Store(b'contents'), blob_path)
+    self.assertEqual(host.written_files, {})
+
+  def test_failed_write_does_not_store_blob(self):
+    host = FakeHost()
+    output_dir = '%stmp' % host.sep
+    store = artifacts.BlobStore(output_dir, host)
+    write_binary_file = host.write_binary_file
+
+    def failing_write(path, contents):
+      write_binary_file(path, contents[:1])
+      raise IOError('disk full')
+
+    host.write_binary_file = failing_write
+    with self.assertRaises(IOError):
+      store.Store(b'contents')
+    blob_path = host.join(output_dir, self._blob_path(host, b'contents', ''))
+    # Nothing is left at the blob's path or in a temporary file.
+    self.assertFalse(host.exists(blob_path))
+    self.assertEqual(
+        [path for path, contents in host.files.items()
+         if contents is not None], [])
+
+    host.write_binary_file = write_binary_file
+    store.Store(b'contents')
+    self.assertEqual(host.read_binary_file(blob_path), b'contents')
+
+  def test_overwriting_blob_artifact_raises_value_error(self):
+    host = FakeHost()
+    output_dir = '%stmp' % host.sep
+    ar = artifacts.Artifacts(output_dir, host,
+                             blob_store=artifacts.BlobStore(output_dir, host))
+    ar.CreateArtifact('artifact_name', 'test.jpg', b'contents')
+    with self.assertRaises(ValueError) as ve:
+      ar.CreateArtifact('artifact_name', 'test.jpg', b'overwritten contents')
+    self.assertIn('already exists', str(ve.exception))
+
+  def test_force_overwriting_blob_artifact_replaces_reference(self):
+    host = FakeHost()
+    output_dir = '%stmp' % host.sep
+    ar = artifacts.Artifacts(output_dir, host,
+                             blob_store=artifacts.BlobStore(output_dir, host))
+    ar.CreateArtifact('artifact_name', 'test.jpg', b'contents')
+    ar.CreateArtifact('artifact_name', 'test.jpg', b'overwritten contents',
+                      force_overwrite=True)
+    self.assertEqual(
+        ar.artifacts,
+        {'artifact_name': [
+            self._blob_path(host, b'overwritten contents', '.jpg')]})
+
+
+  def test_open_blob_artifact(self):
+    host = Host()
+    output_dir = tempfile.mkdtemp()
+    try:
+      store = artifacts.BlobStore(output_dir, host)
+      ar = artifacts.Artifacts(output_dir, host, artifacts_base_dir='a.b.c',
+                               blob_store=store)
+      ar.CreateArtifact('screenshot', 'screenshot.png', b'contents')
+      with ar.OpenArtifact('trace', 'trace.png') as f:
+        f.write(b'contents')
+      with ar.OpenArtifact('log', 'log.txt', write_as_text=True) as f:
+        f.write('log')
+      with self.assertRaises(ValueError):
+        with ar.OpenArtifact('log', 'log.txt') as f:
+          f.write(b'overwritten log')
+
+      blob_path = self._blob_path(host, b'contents', '.png')
+      log_path = self._blob_path(host, b'log', '.txt')
+      self.assertEqual(ar.artifacts, {
+          'screenshot': [blob_path],
+          'trace': [blob_path],
+          'log': [log_path],
+      })
+      self.assertEqual(
+          host.read_binary_file(output_dir, log_path), b'log')
+      # No temporary files are left behind.
+      self.assertEqual(os.listdir(output_dir), ['blobs'])
+    finally:
+      shutil.rmtree(output_dir)
+
+  def test_open_blob_artifact_creates_output_dir(self):
+    host = Host()
+    temp_dir = tempfile.mkdtemp()
+    try:
+      output_dir = os.path.join(temp_dir, 'output')
+      ar = artifacts.Artifacts(
+          output_dir, host,
+          blob_store=artifacts.BlobStore(output_dir, host))
+      with ar.OpenArtifact('trace', 'trace.json') as f:
+        f.write(b'contents')
+      self.assertEqual(
+          host.read_binary_file(output_dir, ar.artifacts['trace'][0]),
+          b'contents')
+    finally:
+      shutil.rmtree(temp_dir)
+
+
+class ArtifactsAsyncWriterTests(unittest.TestCase):
+  def test_create_artifact_with_writer(self):
+    host = FakeHost()
+    output_dir = '%stmp' % host.sep
+    writer = artifacts.AsyncWriter(host, 2)
+    try:
+      ar = artifacts.Artifacts(output_dir, host, artifacts_base_dir='a.b.c',
+                               writer=writer)
+      ar.CreateArtifact('screenshot', 'screenshot.png', b'contents')
+      ar.CreateArtifact('log', 'log.txt', 'log', write_as_text=True)
+      self.assertEqual(ar.WaitForWrites(), [])
+    finally:
+      writer.Shutdown()
+    self.assertEqual(ar.artifacts, {
+        'screenshot': [host.join('a.b.c', 'screenshot.png')],
+        'log': [host.join('a.b.c', 'log.txt')],
+    })
+    self.assertEqual(
+        host.read_binary_file(output_dir, 'a.b.c', 'screenshot.png'),
+        b'contents')
+    self.assertEqual(host.read_text_file(output_dir, 'a.b.c', 'log.txt'),
+                     'log')
+
+  def test_writes_to_the_same_path_happen_in_order(self):
+    host = FakeHost()
+    output_dir = '%stmp' % host.sep
+    writer = artifacts.AsyncWriter(host, 4)
+    try:
+      ar = artifacts.Artifacts(output_dir, host, writer=writer)
+      for i in range(20):
+        ar.CreateArtifact('artifact_name', 'test.txt', b'%d' % i,
+                          force_overwrite=True)
+      self.assertEqual(ar.WaitForWrites(), [])
+    finally:
+      writer.Shutdown()
+    self.assertEqual(host.read_binary_file(output_dir, 'test.txt'), b'19')
+
+  def test_overwriting_artifact_is_reported_by_wait(self):
+    host = FakeHost()
+    output_dir = '%stmp' % host.sep
+    writer = artifacts.AsyncWriter(host, 2)
+    try:
+      ar = artifacts.Artifacts(output_dir, host, writer=writer)
+      ar.CreateArtifact('artifact_name', 'test.jpg', b'contents')
+      ar.CreateArtifact('artifact_name', 'test.jpg', b'overwritten contents')
+      errors = ar.WaitForWrites()
+      self.assertEqual(len(errors), 1)
+      self.assertIn('already exists', str(errors[0]))
+      # The errors are only reported once.
+      self.assertEqual(ar.WaitForWrites(), [])
+    finally:
+      writer.Shutdown()
+    self.assertEqual(host.read_binary_file(output_dir, 'test.jpg'),
+                     b'contents')
+
+  def test_write_larger_than_budget(self):
+    host = FakeHost()
+    writer = artifacts.AsyncWriter(host, 1, max_pending_bytes=4)
+    try:
+      writer.Write('/tmp/a', b'0123456789')
+      writer.Write('/tmp/b', b'0123456789')
+      self.assertEqual(writer.Wait(), [])
+    finally:
+      writer.Shutdown()
+    self.assertEqual(host.read_binary_file('/tmp/b'), b'0123456789')
+
+
+class ArtifactsArchiveTests(unittest.TestCase):
+  def setUp(self):
+    self._host = Host()
+    self._output_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self._output_dir)
+
+  def test_artifacts_are_archived(self):
+    archive = artifacts.ArtifactArchive(self._output_dir, self._host, 1)
+    ar = artifacts.Artifacts(self._output_dir, self._host,
+                             artifacts_base_dir='a.b.c', archive=archive)
+    ar.CreateArtifact('screenshot', 'screenshot.png', b'contents')
+    retry_ar = artifacts.Artifacts(self._output_dir, self._host, iteration=1,
+                                   artifacts_base_dir='a.b.c', archive=archive)
+    retry_ar.CreateArtifact('log', os.path.join('logs', 'log.txt'), 'log',
+                            write_as_text=True)
+
+    archive_path = os.path.join(
+        'archives', 'worker_1_%d.tar' % self._host.getpid())
+    self.assertEqual(archive.relative_path, archive_path)
+    screenshot_path = archive_path + '!/a.b.c/screenshot.png'
+    log_path = archive_path + '!/a.b.c/retry_1/logs/log.txt'
+    self.assertEqual(ar.artifacts, {'screenshot': [screenshot_path]})
+    self.assertEqual(retry_ar.artifacts, {'log': [log_path]})
+    self.assertTrue(artifacts.IsArchivedArtifact(log_path))
+    self.assertEqual(os.listdir(self._output_dir), ['archives'])
+
+    # Members can be read before the archive is closed.
+    self.assertEqual(
+        artifacts.ReadArtifact(self._output_dir, screenshot_path),
+        b'contents')
+    archive.Close()
+    self.assertEqual(artifacts.ReadArtifact(self._output_dir, log_path),
+                     b'log')
+
+  def test_overwriting_archived_artifact(self):
+    archive = artifacts.ArtifactArchive(self._output_dir, self._host, 1)
+    ar = artifacts.Artifacts(self._output_dir, self._host, archive=archive)
+    ar.CreateArtifact('artifact_name', 'test.jpg', b'contents')
+    with self.assertRaises(ValueError) as ve:
+      ar.CreateArtifact('artifact_name', 'test.jpg', b'overwritten contents')
+    self.assertIn('already exists', str(ve.exception))
+    ar.CreateArtifact('artifact_name', 'test.jpg', b'overwritten contents',
+                      force_overwrite=True)
+    archive.Close()
+    self.assertEqual(len(ar.artifacts['artifact_name']), 1)
+    self.assertEqual(
+        artifacts.ReadArtifact(self._output_dir,
+                               ar.artifacts['artifact_name'][0]),
+        b'overwritten contents')
+
+  def test_open_archived_artifact(self):
+    archive = artifacts.ArtifactArchive(self._output_dir, self._host, 1)
+    ar = artifacts.Artifacts(self._output_dir, self._host,
+                             artifacts_base_dir='a.b.c', archive=archive)
+    with ar.OpenArtifact('trace', 'trace.json') as f:
+      f.write(b'con')
+      f.write(b'tents')
+    with self.assertRaises(ValueError):
+      with ar.OpenArtifact('trace', 'trace.json') as f:
+        f.write(b'overwritten contents')
+    archive.Close()
+    trace_path = archive.relative_path + '!/a.b.c/trace.json'
+    self.assertEqual(ar.artifacts, {'trace': [trace_path]})
+    self.assertEqual(artifacts.ReadArtifact(self._output_dir, trace_path),
+                     b'contents')
+    self.assertEqual(os.listdir(self._output_dir), ['archives'])
+
+  def test_reopened_archive_is_appended_to(self):
+    archive = artifacts.ArtifactArchive(self._output_dir, self._host, 1)
+    archive.Add('first.txt', b'first')
+    archive.Close()
+    archive = artifacts.ArtifactArchive(self._output_dir, self._host, 1)
+    with self.assertRaises(ValueError):
+      archive.Add('first.txt', b'again')
+    path = archive.Add('second.txt', b'second')
+    archive.Close()
+    self.assertEqual(artifacts.ReadArtifact(self._output_dir, path),
+                     b'second')
+
+  def test_archived_artifacts_are_read_through_index(self):
+    archive = artifacts.ArtifactArchive(self._output_dir, self._host, 1)
+    archive.Add('first.txt', b'first')
+    archive.Add('big.bin', b'x' * 1000)
+    path = archive.Add('first.txt', b'replaced', overwrite=True)
+    archive_path = os.path.join(self._output_dir, archive.relative_path)
+    index_path = archive_path + artifacts.ARCHIVE_INDEX_SUFFIX
+    with open(index_path, 'rb') as f:
+      self.assertEqual(len(f.read().splitlines()), 3)
+    self.assertEqual(artifacts.ReadArtifact(self._output_dir, path),
+                     b'replaced')
+    # A line that is still being written is ignored until it is complete.
+    with open(index_path, 'ab') as f:
+      f.write(b'["partial.txt", ')
+    self.assertEqual(artifacts.ReadArtifact(self._output_dir, path),
+                     b'replaced')
+    archive.Close()
+    # The index rebuilt by a reopened archive drops the partial line.
+    archive = artifacts.ArtifactArchive(self._output_dir, self._host, 1)
+    path = archive.Add('second.txt', b'second')
+    archive.Close()
+    self.assertEqual(artifacts.ReadArtifact(self._output_dir, path),
+                     b'second')
+    self.assertEqual(
+        artifacts.ReadArtifact(self._output_dir,
+                               path.replace('second.txt', 'big.bin')),
+        b'x' * 1000)
+
+  def test_archived_artifact_is_read_without_index(self):
+    archive = artifacts.ArtifactArchive(self._output_dir, self._host, 1)
+    path = archive.Add('first.txt', b'first')
+    archive.Close()
+    os.remove(os.path.join(self._output_dir, archive.relative_path) +
+              artifacts.ARCHIVE_INDEX_SUFFIX)
+    self.assertEqual(artifacts.ReadArtifact(self._output_dir, path),
+                     b'first')
+
+  def test_extract_archives(self):
+    for worker_num in (1, 2):
+      archive = artifacts.ArtifactArchive(
+          self._output_dir, self._host, worker_num)
+      archive.Add(os.path.join('test_%d' % worker_num, 'log.txt'),
+                  b'log %d' % worker_num)
+      archive.Close()
+    dest_dir = os.path.join(self._output_dir, 'extracted')
+    self.assertEqual(
+        sorted(artifacts.ExtractArchives(self._output_dir, dest_dir)),
+        ['test_1/log.txt', 'test_2/log.txt'])
+    self.assertEqual(
+        artifacts.ReadArtifact(dest_dir, os.path.join('test_2', 'log.txt')),
+        b'log 2')
+
+  def test_extract_archives_without_archives(self):
+    self.assertEqual(artifacts.ExtractArchives(self._output_dir), [])
+
+
 class ArtifactsLinkCreationTests(unittest.TestCase):
   def test_create_link(self):
     ar = artifacts.Artifacts('', FakeHost())
@@ -2,6 +2,10 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import io
+import itertools
+import pickle
+import random
 import unittest
 
 from typ import expectations_parser
@@ -417,6 +421,33 @@ crbug.com/12345 [ tag3 tag4 ] b1/s1 [ Skip ]
         with self.assertRaises(expectations_parser.ParseError):
             expectations_parser.TaggedTestListParser(raw_data)
 
+    def testParseUnterminatedMultiline(self):
+        raw_data = ('# tags: [ Mac\n'
+                    '#          Win\n')
+        with self.assertRaises(expectations_parser.ParseError) as context:
+            expectations_parser.TaggedTestListParser(raw_data)
+        self.assertEqual('3: Multi-line tag set missing closing "]"',
+                         str(context.exception))
+
+    def testParseFromIterableMatchesParseFromString(self):
+        raw_data = """# tags: [ Mac Win
+#         Linux ]
+# tags: [ Release Debug ]
+# results: [ Failure Skip RetryOnFailure ]
+
+# A comment.
+crbug.com/12345 [ mac ] b1/s1 [ Skip ]
+crbug.com/23456 [ Win Debug ] b1/s2* [ Failure RetryOnFailure ] # abc
+b1/s3 [ Failure ]
+"""
+        expected = expectations_parser.TaggedTestListParser(raw_data)
+        for lines in (raw_data.splitlines(True), io.StringIO(raw_data)):
+            parser = expectations_parser.TaggedTestListParser(lines)
+            self.assertEqual(parser.tag_sets, expected.tag_sets)
+            self.assertEqual(parser.expectations, expected.expectations)
+            self.assertEqual([e.to_string() for e in parser.expectations],
+                             [e.to_string() for e in expected.expectations])
+
     def testParseTwoSetsOfTagsOnOneLineAreNotAllowed(self):
         raw_data = ('# tags: [ Debug ] [ Release ]\n')
         with self.assertRaises(expectations_parser.ParseError):
@@ -749,6 +780,359 @@ crbug.com/12345 [ tag3 tag4 ] b1/s1 [ Skip ]
         exp = expectations.expectations_for('foo123bar123baz')
         self.assertEqual(exp.results, {ResultType.Pass})
 
+    def assertExpectationsForManyMatches(self, expectations, tests):
+        many = expectations.expectations_for_many(tests)
+        self.assertEqual(sorted(many), sorted(set(tests)))
+        for test in tests:
+            self.assertEqual(many[test], expectations.expectations_for(test))
+
+    def testExpectationsForMany(self):
+        raw_data = (
+            '# tags: [ linux win ]\n'
+            '# results: [ Failure Skip Slow RetryOnFailure ]\n'
+            '# conflicts_allowed: true\n'
+            'crbug.com/1 [ linux ] a/b/c [ Failure ]\n'
+            'crbug.com/2 [ win ] a/b/c [ Skip ]\n'
+            'crbug.com/3 a/b* [ Slow ]\n'
+            'crbug.com/4 [ linux ] a/b/* [ Skip ]  # comment\n'
+            '[ win ] a/b/d* [ RetryOnFailure ]\n'
+            'a/* [ Failure ]\n'
+            'a/b/c/\\* [ Failure ]\n')
+        tests = ['a/b/c', 'a/b/c/d', 'a/b/c/*', 'a/b/d', 'a/bc', 'a/x', 'b',
+                 'a/b', '', 'a/b/c']
+        for tags in ([], ['linux'], ['win'], ['linux', 'win']):
+            expectations = expectations_parser.TestExpectations(tags=tags)
+            ret, errors = expectations.parse_tagged_list(raw_data)
+            self.assertFalse(ret, errors)
+            self.assertExpectationsForManyMatches(expectations, tests)
+        exps = expectations.expectations_for_many(tests)
+        self.assertEqual(exps['a/b/c'].results, {ResultType.Failure,
+                                                  ResultType.Skip})
+        self.assertEqual(exps['a/b/d'].results, {ResultType.Pass})
+        self.assertTrue(exps['a/b/d'].should_retry_on_failure)
+        self.assertEqual(exps['a/b/c/d'].results, {ResultType.Skip})
+        self.assertEqual(exps['b'].results, {ResultType.Pass})
+
+    def testExpectationsForManyFullWildcardSupport(self):
+        raw_data = (
+            '# tags: [ linux win ]\n'
+            '# results: [ Failure Skip ]\n'
+            '# full_wildcard_support: true\n'
+            '# conflicts_allowed: true\n'
+            '[ linux ] foo*bar [ Failure ]\n'
+            '[ win ] foo*bar*baz [ Skip ]\n'
+            'foo\\*bar*baz [ Failure ]\n'
+            '*baz [ Skip ]\n'
+            'foo*bar [ Skip ]\n')
+        tests = ['foobar', 'foo1bar', 'foo*bar2baz', 'foo1bar2baz', 'baz',
+                 'foo', 'bar', 'foo*bar']
+        for tags in ([], ['linux'], ['win']):
+            expectations = expectations_parser.TestExpectations(tags=tags)
+            ret, errors = expectations.parse_tagged_list(raw_data)
+            self.assertFalse(ret, errors)
+            self.assertExpectationsForManyMatches(expectations, tests)
+
+    def testExpectationsForManyRandomized(self):
+        rand = random.Random(1234)
+        for full_wildcard_support in (False, True):
+            lines = [
+                '# tags: [ linux win ]\n',
+                '# results: [ Failure Skip Slow ]\n',
+                '# conflicts_allowed: true\n',
+                '# full_wildcard_support: %s\n' % full_wildcard_support,
+            ]
+            for _ in range(100):
+                test = ''.join(rand.choice('ab/') for _ in range(
+                    rand.randint(1, 6)))
+                if full_wildcard_support:
+                    i = rand.randint(0, len(test))
+                    test = test[:i] + '*' + test[i:]
+                elif rand.random() < 0.5:
+                    test += '*'
+                tags = rand.choice(['', '[ linux ] ', '[ win ] '])
+                result = rand.choice(['Failure', 'Skip', 'Slow'])
+                lines.append('%s%s [ %s ]\n' % (tags, test, result))
+            tests = [''.join(rand.choice('ab/') for _ in range(
+                rand.randint(0, 8))) for _ in range(300)]
+            expectations = expectations_parser.TestExpectations(
+                tags=['linux'])
+            ret, errors = expectations.parse_tagged_list(''.join(lines))
+            self.assertFalse(ret, errors)
+            self.assertExpectationsForManyMatches(expectations, tests)
+
+    def testExpectationsForManyWithDecodeFunc(self):
+        raw_data = (
+            '# results: [ Failure ]\n'
+            'a%2Fb* [ Failure ]\n')
+        expectations = expectations_parser.TestExpectations(
+            encode_func=lambda s: s.replace('/', '%2F'),
+            decode_func=lambda s: s.replace('%2F', '/'))
+        expectations.parse_tagged_list(raw_data)
+        self.assertExpectationsForManyMatches(
+            expectations, ['a/b/c', 'a%2Fbc', 'a/c'])
+        exps = expectations.expectations_for_many(['a%2Fb/c'])
+        self.assertEqual(exps['a%2Fb/c'].test, 'a/b/c')
+        self.assertEqual(exps['a%2Fb/c'].results, {ResultType.Failure})
+
+    def testCompactMatchesExpectationsFor(self):
+        rand = random.Random(4321)
+        for full_wildcard_support in (False, True):
+            lines = [
+                '# tags: [ linux win ]\n',
+                '# tags: [ debug release ]\n',
+                '# results: [ Failure Skip Slow RetryOnFailure ]\n',
+                '# conflicts_allowed: true\n',
+                '# full_wildcard_support: %s\n' % full_wildcard_support,
+            ]
+            for _ in range(100):
+                test = ''.join(rand.choice('ab/') for _ in range(
+                    rand.randint(1, 6)))
+                if full_wildcard_support:
+                    i = rand.randint(0, len(test))
+                    test = test[:i] + '*' + test[i:]
+                elif rand.random() < 0.5:
+                    test += '*'
+                reason = rand.choice(['', 'crbug.com/1 ', 'crbug.com/2 '])
+                tags = rand.choice(
+                    ['', '[ linux ] ', '[ win ] ', '[ linux debug ] '])
+                result = rand.choice(
+                    ['Failure', 'Skip', 'Slow', 'Failure RetryOnFailure'])
+                lines.append('%s%s%s [ %s ]\n' % (reason, tags, test, result))
+            tests = [''.join(rand.choice('ab/') for _ in range(
+                rand.randint(0, 8))) for _ in range(300)]
+            expectations = expectations_parser.TestExpectations(
+                tags=['linux', 'debug'])
+            ret, errors = expectations.parse_tagged_list(''.join(lines))
+            self.assertFalse(ret, errors)
+            compact = expectations.compact()
+            for tags in (['linux', 'debug'], ['win'], []):
+                expectations.set_tags(tags)
+                compact.set_tags(tags)
+                self.assertEqual(compact.tags, expectations.tags)
+                for test in tests:
+                    expected = expectations.expectations_for(test)
+                    actual = compact.expectations_for(test)
+                    self.assertEqual(actual, expected)
+                    self.assertEqual(actual.is_slow_test,
+                                     expected.is_slow_test)
+                    self.assertEqual(actual.raw_results, expected.raw_results)
+
+    def testCompactWithOverrideConflictResolution(self):
+        raw_data = (
+            '# tags: [ linux win ]\n'
+            '# results: [ Failure Skip ]\n'
+            '# conflict_resolution: override\n'
+            '# conflicts_allowed: true\n'
+            'crbug.com/1 a/b [ Failure ]\n'
+            'crbug.com/2 [ linux ] a/b [ Skip ]\n')
+        expectations = expectations_parser.TestExpectations(tags=['linux'])
+        expectations.parse_tagged_list(raw_data)
+        compact = expectations.compact()
+        self.assertEqual(compact.expectations_for('a/b'),
+                         expectations.expectations_for('a/b'))
+        self.assertEqual(compact.expectations_for('a/b').results,
+                         {ResultType.Skip})
+        compact.add_tags(['win'])
+        self.assertEqual(sorted(compact.tags), ['linux', 'win'])
+
+    def assertReloadMatchesParse(self, expectations, raw_data):
+        ret, errors = expectations.reload_tagged_list(raw_data, 'test.txt')
+        fresh = expectations_parser.TestExpectations(
+            tags=expectations.tags)
+        self.assertEqual(
+            (ret, errors), fresh.parse_tagged_list(raw_data, 'test.txt'))
+        self.assertEqual(dict(expectations.individual_exps),
+                         dict(fresh.individual_exps))
+        self.assertEqual(dict(expectations.glob_exps), dict(fresh.glob_exps))
+        self.assertEqual(list(expectations.glob_exps), list(fresh.glob_exps))
+        self.assertEqual(sorted(expectations._cached_reduced_globs),
+                         sorted(fresh._cached_reduced_globs))
+
+    def testReloadTaggedList(self):
+        header = ('# tags: [ linux win ]\n'
+                  '# results: [ Failure Skip ]\n')
+        lines = ['crbug.com/1 [ linux ] a/b [ Failure ]',
+                 'a/c* [ Skip ]',
+                 '[ win ] a/b [ Skip ]']
+        expectations = expectations_parser.TestExpectations(tags=['linux'])
+        expectations.parse_tagged_list(header + '\n'.join(lines), 'test.txt',
+                                       reloadable=True)
+        # Change a line in place.
+        lines[1] = 'a/c/d* [ Failure ]'
+        self.assertReloadMatchesParse(expectations,
+                                      header + '\n'.join(lines))
+        # Insert lines, shifting the following expectations down.
+        lines[1:1] = ['', '# comment', 'a/e [ Skip ]']
+        self.assertReloadMatchesParse(expectations,
+                                      header + '\n'.join(lines))
+        # Delete lines, shifting the following expectations up.
+        del lines[0:2]
+        self.assertReloadMatchesParse(expectations,
+                                      header + '\n'.join(lines))
+        self.assertEqual(expectations.expectations_for('a/c/d/e').results,
+                         {ResultType.Failure})
+        self.assertEqual(expectations.expectations_for('a/c').results,
+                         {ResultType.Pass})
+
+    def testReloadTaggedListReportsConflictsForTouchedPatterns(self):
+        raw_data = ('# tags: [ linux win ]\n'
+                    '# results: [ Failure Skip ]\n'
+                    '[ linux ] a/b [ Failure ]\n'
+                    '[ win ] a/b [ Skip ]\n')
+        expectations = expectations_parser.TestExpectations()
+        self.assertEqual(
+            expectations.parse_tagged_list(raw_data, 'test.txt',
+                                          reloadable=True),
+            (0, ''))
+        ret, errors = expectations.reload_tagged_list(
+            raw_data.replace('[ win ] a/b', '[ linux ] a/b'), 'test.txt')
+        self.assertEqual(ret, 1)
+        self.assertEqual(
+            errors,
+            '\nFound conflicts for pattern a/b in test.txt:\n'
+            '  line 3 conflicts with line 4\n')
+
+    def testReloadTaggedListWithHeaderChange(self):
+        raw_data = ('# tags: [ linux win ]\n'
+                    '# results: [ Failure ]\n'
+                    'a/b [ Failure ]\n')
+        expectations = expectations_parser.TestExpectations()
+        expectations.parse_tagged_list(raw_data, 'test.txt', reloadable=True)
+        self.assertReloadMatchesParse(
+            expectations,
+            raw_data.replace('Failure ]\n', 'Failure Skip ]\n', 1) +
+            '[ win ] a/c [ Skip ]\n')
+        self.assertReloadMatchesParse(
+            expectations,
+            raw_data.replace('linux win', 'linux mac'))
+
+    def testReloadTaggedListParseErrorKeepsExpectations(self):
+        raw_data = ('# tags: [ linux ]\n'
+                    '# results: [ Failure ]\n'
+                    'a/b [ Failure ]\n'
+                    'a/c [ Failure ]\n')
+        expectations = expectations_parser.TestExpectations()
+        expectations.parse_tagged_list(raw_data, 'test.txt', reloadable=True)
+        ret, errors = expectations.reload_tagged_list(
+            raw_data.replace('a/c [ Failure ]', 'a/c [ Skip ]'), 'test.txt')
+        self.assertEqual(ret, 1)
+        self.assertEqual(errors, '4: Unknown result type "Skip"')
+        self.assertEqual(sorted(expectations.individual_exps),
+                         ['a/b', 'a/c'])
+
+    def testReloadTaggedListRandomized(self):
+        rand = random.Random(2468)
+        for full_wildcard_support in (False, True):
+            header = ['# tags: [ linux win ]',
+                      '# results: [ Failure Skip Slow ]',
+                      '# conflicts_allowed: true',
+                      '# full_wildcard_support: %s' % full_wildcard_support]
+
+            def random_line():
+                if rand.random() < 0.1:
+                    return rand.choice(['', '# comment'])
+                test = ''.join(rand.choice('ab/') for _ in range(
+                    rand.randint(1, 5)))
+                if rand.random() < 0.5:
+                    i = (rand.randint(0, len(test)) if full_wildcard_support
+                         else len(test))
+                    test = test[:i] + '*' + test[i:]
+                tags = rand.choice(['', '[ linux ] ', '[ win ] '])
+                result = rand.choice(['Failure', 'Skip', 'Slow'])
+                return '%s%s [ %s ]' % (tags, test, result)
+
+            lines = [random_line() for _ in range(60)]
+            expectations = expectations_parser.TestExpectations(
+                tags=['linux'])
+            expectations.parse_tagged_list('\n'.join(header + lines),
+                                           'test.txt', reloadable=True)
+            for _ in range(30):
+                i = rand.randint(0, len(lines))
+                j = min(len(lines), i + rand.randint(0, 3))
+                lines[i:j] = [random_line()
+                              for _ in range(rand.randint(0, 3))]
+                self.assertReloadMatchesParse(expectations,
+                                              '\n'.join(header + lines))
+
+    def testReloadTaggedListKeepsGlobOrderWithFullWildcardSupport(self):
+        header = ('# tags: [ linux win ]\n'
+                  '# results: [ Failure Skip ]\n'
+                  '# conflicts_allowed: true\n'
+                  '# full_wildcard_support: true\n')
+        lines = ['a/*c [ Failure ]',
+                 'a/b* [ Skip ]',
+                 'a/bc* [ Skip ]']
+        expectations = expectations_parser.TestExpectations(tags=['linux'])
+        expectations.parse_tagged_list(header + '\n'.join(lines), 'test.txt',
+                                       reloadable=True)
+        # A glob of the same length as others goes in line order.
+        lines.insert(0, 'b/*c [ Skip ]')
+        self.assertReloadMatchesParse(expectations,
+                                      header + '\n'.join(lines))
+        self.assertEqual(list(expectations.glob_exps),
+                         ['a/bc*', 'b/*c', 'a/*c', 'a/b*'])
+        # Adding an earlier line for a glob moves it ahead of the others of
+        # its length, and removing that line moves it back.
+        lines[1:1] = ['a/b* [ Failure ]']
+        self.assertReloadMatchesParse(expectations,
+                                      header + '\n'.join(lines))
+        self.assertEqual(list(expectations.glob_exps),
+                         ['a/bc*', 'b/*c', 'a/b*', 'a/*c'])
+        del lines[1]
+        self.assertReloadMatchesParse(expectations,
+                                      header + '\n'.join(lines))
+        lines[3:3] = ['[ win ] a/*c [ Skip ]']
+        del lines[2]
+        self.assertReloadMatchesParse(expectations,
+                                      header + '\n'.join(lines))
+        self.assertEqual(expectations.expectations_for('a/bc').results,
+                         {ResultType.Skip})
+
+    def testReloadTaggedListKeepsGlobWithEscapedWildcardTest(self):
+        header = ('# tags: [ linux win ]\n'
+                  '# results: [ Failure Skip ]\n'
+                  '# full_wildcard_support: true\n')
+        lines = ['a/\\*b [ Failure ]',
+                 'a/*b [ Skip ]']
+        expectations = expectations_parser.TestExpectations(tags=['linux'])
+        expectations.parse_tagged_list(header + '\n'.join(lines), 'test.txt',
+                                       reloadable=True)
+        # Dropping the escaped test leaves the glob for the same pattern.
+        del lines[0]
+        self.assertReloadMatchesParse(expectations,
+                                      header + '\n'.join(lines))
+        self.assertEqual(expectations.expectations_for('a/xxb').results,
+                         {ResultType.Skip})
+
+    def testReloadTaggedListRequiresReloadable(self):
+        raw_data = ('# tags: [ linux ]\n'
+                    '# results: [ Failure ]\n'
+                    'a/b [ Failure ]\n')
+        expectations = expectations_parser.TestExpectations()
+        expectations.parse_tagged_list(raw_data, 'test.txt')
+        self.assertIsNone(expectations._tagged_lists['test.txt'])
+        with self.assertRaises(ValueError):
+            expectations.reload_tagged_list(raw_data, 'test.txt')
+        # A list that was not parsed before is parsed to be reloadable.
+        expectations.reload_tagged_list(raw_data, 'other.txt')
+        self.assertIsNotNone(expectations._tagged_lists['other.txt'])
+
+    def testCompactIsPicklable(self):
+        raw_data = (
+            '# tags: [ linux win ]\n'
+            '# results: [ Failure Skip ]\n'
+            'crbug.com/1 [ linux ] a/b [ Failure ]\n'
+            '[ win ] a/c [ Skip ]\n'
+            'a/* [ Skip ]\n')
+        expectations = expectations_parser.TestExpectations(tags=['linux'])
+        expectations.parse_tagged_list(raw_data)
+        compact = pickle.loads(pickle.dumps(expectations.compact()))
+        for test in ('a/b', 'a/c', 'b/c'):
+            self.assertEqual(compact.expectations_for(test),
+                             expectations.expectations_for(test))
+        self.assertLess(len(pickle.dumps(compact)),
+                        len(pickle.dumps(expectations)))
+
     def testIsTestRetryOnFailure(self):
         raw_data = (
             '# tags: [ linux ]\n'
@@ -1161,6 +1545,61 @@ crbug.com/12345 [ tag3 tag4 ] b1/s1 [ Skip ]
             test_expectations, 'test.txt')
         self.assertFalse(msg)
 
+    def testConflictsReportedInLineOrder(self):
+        test_expectations = '''# tags: [ mac win linux ]
+        # tags: [ intel amd nvidia ]
+        # results: [ Failure ]
+        [ nvidia ] a/b/c/d [ Failure ]
+        [ win amd ] a/b/c/d [ Failure ]
+        [ mac ] a/b/c/d [ Failure ]
+        [ win ] a/b/c/d [ Failure ]
+        [ linux nvidia ] a/b/c/d [ Failure ]
+        '''
+        expectations = expectations_parser.TestExpectations()
+        _, errors = expectations.parse_tagged_list(
+            test_expectations, 'test.txt')
+        self.assertEqual(
+            errors,
+            '\nFound conflicts for pattern a/b/c/d in test.txt:\n'
+            '  line 4 conflicts with line 6\n'
+            '  line 4 conflicts with line 7\n'
+            '  line 4 conflicts with line 8\n'
+            '  line 5 conflicts with line 7\n')
+
+    def testIndexedConflictsMatchPairwiseComparison(self):
+        rand = random.Random(1234)
+        tag_sets = [['mac', 'win', 'linux'],
+                    ['intel', 'amd', 'nvidia'],
+                    ['debug', 'release']]
+        header = ''.join('# tags: [ %s ]\n' % ' '.join(ts) for ts in tag_sets)
+        header += '# results: [ Failure ]\n'
+        header += '# conflicts_allowed: true\n'
+        tags_conflict_fns = [
+            expectations_parser._default_tags_conflict,
+            lambda t1, t2: t1 != t2 and {t1, t2} != {'intel', 'amd'},
+        ]
+        for _ in range(20):
+            lines = []
+            for _ in range(rand.randint(2, 30)):
+                tags = [rand.choice(ts) for ts in tag_sets
+                        if rand.random() < 0.5]
+                lines.append('%sa/b [ Failure ]\n' %
+                             ('[ %s ] ' % ' '.join(tags) if tags else ''))
+            expectations = expectations_parser.TestExpectations()
+            ret, errors = expectations.parse_tagged_list(header + ''.join(lines))
+            self.assertFalse(ret, errors)
+            exps = expectations.individual_exps['a/b']
+            for fn in tags_conflict_fns:
+                expected = [
+                    (i, j) for i, j in itertools.combinations(
+                        range(len(exps)), 2)
+                    if expectations.tag_sets_conflict(exps[i].tags,
+                                                      exps[j].tags, fn)]
+                self.assertEqual(
+                    expectations_parser._find_conflicting_pairs(
+                        exps, expectations.tag_sets, fn),
+                    expected)
+
     def testExpectationPatternIsBroken(self):
         test_expectations = '# results: [ Failure ]\na/\\* [ Failure ]'
         expectations = expectations_parser.TestExpectations()
@@ -1378,3 +1817,42 @@ crbug.com/12345 [ tag3 tag4 ] b1/s1 [ Skip ]
             expectations_parser.TaggedTestListParser(raw_data)
         self.assertIn('1: duplicate tag(s): Win',
                       str(context.exception))
+
+    def testCanonicalLineSplitMatchesMatcher(self):
+        parser = expectations_parser.TaggedTestListParser('')
+        lines = [
+            'b1/s1 [ Failure ]',
+            'b1/s1 [ Failure Slow ]',
+            '[ Mac ] b1/s1 [ Failure ]',
+            '[ Mac Debug ] b1/s1* [ Failure Skip ]',
+            'crbug.com/1 b1/s1 [ Failure ]',
+            'crbug.com/1 [ Mac ] b1/s1 [ Failure ]',
+            'skbug.com/v8/3 b.1/s_1 [ RetryOnFailure ]',
+            'crbug.com/1 crbug.com/2 [ Mac ] b1/s1 [ Failure ]',
+            'crbug.com/1 crbug.com/2 crbug.com/1 [ Mac ] b1/s1 [ Failure ]',
+            'b:5 [ Win ] b1/s1 [ Pass ]',
+            'crbug.com/1 [ Mac ] b1/s1 [ Failure ] # trailing',
+            'crbug.com/1  [ Mac ] b1/s1 [ Failure ]',
+            'crbug.com/1\t[ Mac ] b1/s1 [ Failure ]',
+            'foo [ Mac ] b1/s1 [ Failure ]',
+            '[ Mac ]b1/s1 [ Failure ]',
+            'crbug.com/1[ Mac ] b1/s1 [ Failure ]',
+            '[ Mac ] b1/s1 [ Failure',
+            '[ Mac ] b1/s1 [ ]',
+            '[ ] b1/s1 [ Failure ]',
+            'b1/s1 [ Fail.ure ]',
+            'b1/s[1] [ Failure ]',
+        ]
+        for line in lines:
+            components = expectations_parser._split_canonical_expectation_line(
+                line)
+            if components is None:
+                continue
+            self.assertEqual(
+                components,
+                parser._parse_expectation_line_into_components(1, line), line)
+        # The common forms must not fall back to MATCHER.
+        for line in lines[:7]:
+            self.assertIsNotNone(
+                expectations_parser._split_canonical_expectation_line(line),
+                line)
@@ -0,0 +1,205 @@
+# Copyright 2025 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import json
+import unittest
+
+from typ import expectations_parser
+from typ import expectations_updater
+from typ.fakes.host_fake import FakeHost
+
+
+EXPECTATIONS = """\
+# tags: [ linux win ]
+# tags: [ debug release ]
+# results: [ Failure Skip RetryOnFailure ]
+
+# A comment that must be kept.
+crbug.com/1 [ linux ] a/b/fails [ Failure ]
+[ win ] a/b/flaky [ RetryOnFailure ] # trailing comment
+crbug.com/2 a/stale [ Skip ]
+a/stale_glob/* [ Skip ]
+a/b/* [ Skip ]
+"""
+
+
+def _full_results(tests, tags=None):
+    trie = {}
+    for name, (actual, expected) in tests.items():
+        node = trie
+        parts = name.split('/')
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = {'actual': actual, 'expected': expected,
+                           'times': [0.1]}
+    full_results = {'path_delimiter': '/', 'tests': trie}
+    if tags is not None:
+        full_results['metadata'] = {'tags': tags}
+    return full_results
+
+
+class ExpectationsUpdaterTest(unittest.TestCase):
+
+    def parse(self, raw_data):
+        expectations = expectations_parser.TestExpectations()
+        self.assertEqual(expectations.parse_tagged_list(raw_data), (0, ''))
+        return expectations
+
+    def testComputeUpdate(self):
+        expectations = self.parse(EXPECTATIONS)
+        results = [
+            _full_results({
+                'a/b/fails': ('FAIL', 'FAIL'),
+                'a/b/new_failure': ('FAIL FAIL', 'PASS'),
+                'a/b/new_flake': ('FAIL PASS', 'PASS'),
+                'a/b/passes': ('PASS', 'PASS'),
+                'a/c': ('TIMEOUT', 'PASS'),
+            }, tags=['Linux', 'Debug', 'UnknownTag']),
+            _full_results({
+                'a/b/flaky': ('FAIL', 'PASS'),
+                'a/b/fails': ('PASS', 'PASS'),
+            }, tags=['win']),
+        ]
+        update = expectations_updater.compute_update(
+            expectations, results, reason='crbug.com/3')
+        self.assertEqual(
+            [exp.to_string() for exp in update.added],
+            ['crbug.com/3 [ debug linux ] a/b/new_failure [ Failure ]',
+             'crbug.com/3 [ debug linux ] a/b/new_flake [ RetryOnFailure ]',
+             'crbug.com/3 [ debug linux ] a/c [ Failure ]'])
+        self.assertEqual(
+            {lineno: exp.to_string()
+             for lineno, exp in update.replaced.items()},
+            {7: '[ win ] a/b/flaky [ Failure RetryOnFailure ]'
+                ' # trailing comment'})
+        self.assertEqual([exp.test for exp in update.removed],
+                         ['a/stale', 'a/stale_glob/*'])
+
+    def testApplyUpdateKeepsUntouchedLines(self):
+        expectations = self.parse(EXPECTATIONS)
+        update = expectations_updater.compute_update(
+            expectations,
+            [_full_results({'a/b/flaky': ('FAIL', 'PASS'),
+                            'a/b/fails': ('PASS', 'PASS')}, tags=['win']),
+             _full_results({'a/b/other': ('FAIL', 'PASS')})])
+        contents = expectations_updater.apply_update(EXPECTATIONS, update)
+        self.assertEqual(contents, """\
+# tags: [ linux win ]
+# tags: [ debug release ]
+# results: [ Failure Skip RetryOnFailure ]
+
+# A comment that must be kept.
+crbug.com/1 [ linux ] a/b/fails [ Failure ]
+[ win ] a/b/flaky [ Failure RetryOnFailure ] # trailing comment
+a/b/* [ Skip ]
+a/b/other [ Failure ]
+""")
+        # The updated contents are parseable and cover the failures.
+        updated = self.parse(contents)
+        self.assertEqual(
+            expectations_updater.compute_update(
+                updated,
+                [_full_results({'a/b/other': ('FAIL', 'FAIL')})],
+                remove_stale=False).added,
+            [])
+
+    def testApplyEmptyUpdate(self):
+        self.assertEqual(
+            expectations_updater.apply_update(
+                EXPECTATIONS, expectations_updater.ExpectationsUpdate()),
+            EXPECTATIONS)
+
+    def testUpdateExpectationsFile(self):
+        host = FakeHost()
+        host.write_text_file('expectations.txt', EXPECTATIONS)
+        host.write_text_file('full_results.json', json.dumps(_full_results({
+            'a/b/fails': ('FAIL', 'FAIL'),
+            'a/b/flaky': ('PASS', 'PASS'),
+            'a/stale': ('PASS', 'PASS'),
+            'a/stale_glob/x': ('PASS', 'PASS'),
+            'a/new': ('CRASH', 'PASS'),
+        }, tags=['linux'])))
+        ret, errors, update = expectations_updater.update_expectations_file(
+            host, 'expectations.txt', ['full_results.json'])
+        self.assertEqual((ret, errors), (0, ''))
+        self.assertEqual([exp.test for exp in update.added], ['a/new'])
+        self.assertEqual(
+            host.read_text_file('expectations.txt'),
+            EXPECTATIONS + '[ linux ] a/new [ Failure ]\n')
+
+    def testUpdateExpectationsFileWithParseError(self):
+        host = FakeHost()
+        host.write_text_file('expectations.txt', 'a/b [ Bogus ]\n')
+        host.write_text_file('full_results.json',
+                             json.dumps(_full_results({})))
+        ret, errors, update = expectations_updater.update_expectations_file(
+            host, 'expectations.txt', ['full_results.json'])
+        self.assertEqual(ret, 1)
+        self.assertIn('Unknown result type', errors)
+        self.assertIsNone(update)
+        self.assertEqual(host.read_text_file('expectations.txt'),
+                         'a/b [ Bogus ]\n')
+
+    def testNewLinesUseHeaderTagSpelling(self):
+        raw_data = ('# tags: [ Linux Win ]\n'
+                    '# tags: [ Debug Release ]\n'
+                    '# results: [ Failure ]\n')
+        update = expectations_updater.compute_update(
+            self.parse(raw_data),
+            [_full_results({'a/b': ('FAIL', 'PASS')},
+                           tags=['linux', 'RELEASE'])],
+            raw_data=raw_data)
+        self.assertEqual([exp.to_string() for exp in update.added],
+                         ['[ Linux Release ] a/b [ Failure ]'])
+
+    def testApplyUpdateDeclaresResults(self):
+        raw_data = ('# tags: [ linux win ]\n'
+                    '# results: [ Skip\n'
+                    '#   Slow ]\n'
+                    'a/b [ Skip ]\n')
+        update = expectations_updater.compute_update(
+            self.parse(raw_data),
+            [_full_results({'a/b': ('FAIL PASS', 'SKIP'),
+                            'a/c': ('FAIL', 'PASS')})])
+        contents = expectations_updater.apply_update(raw_data, update)
+        self.assertEqual(contents, """\
+# tags: [ linux win ]
+# results: [ Skip
+#   Slow Failure RetryOnFailure ]
+a/b [ RetryOnFailure Skip ]
+a/c [ Failure ]
+""")
+        self.parse(contents)
+
+    def testApplyUpdateAddsResultsHeader(self):
+        raw_data = '# tags: [ linux win ]\n\n# No expectations yet.\n'
+        update = expectations_updater.compute_update(
+            self.parse(raw_data),
+            [_full_results({'a/b': ('FAIL', 'PASS')})])
+        contents = expectations_updater.apply_update(raw_data, update)
+        self.assertEqual(contents, """\
+# tags: [ linux win ]
+
+# No expectations yet.
+# results: [ Failure ]
+a/b [ Failure ]
+""")
+        self.parse(contents)
+
+    def testUpdateExpectationsFileWithConflictingUpdate(self):
+        host = FakeHost()
+        raw_data = ('# tags: [ linux win ]\n'
+                    '# tags: [ debug release ]\n'
+                    '# results: [ Failure Skip ]\n'
+                    '[ linux ] a/b [ Skip ]\n')
+        host.write_text_file('expectations.txt', raw_data)
+        host.write_text_file('full_results.json', json.dumps(_full_results(
+            {'a/b': ('FAIL', 'PASS')}, tags=['linux', 'debug'])))
+        ret, errors, update = expectations_updater.update_expectations_file(
+            host, 'expectations.txt', ['full_results.json'],
+            remove_stale=False)
+        self.assertEqual(ret, 1)
+        self.assertIn('Found conflicts for pattern a/b', errors)
+        self.assertIsNone(update)
+        self.assertEqual(host.read_text_file('expectations.txt'), raw_data)
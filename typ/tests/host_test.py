@@ -13,11 +13,14 @@
 # limitations under the License.
 
 import logging
+import os
 import pickle
 import sys
+import tempfile
 import unittest
 
-from typ.host import Host
+from typ.host import Host, OutputLimit
+from typ.spilled_text import SpilledText
 
 
 class TestHost(unittest.TestCase):
@@ -41,6 +44,92 @@ class TestHost(unittest.TestCase):
 
         # TODO: Add tests for divert=False or eliminate the flag?
 
+    def test_capture_output_with_limit(self):
+        h = self.host()
+        h.capture_output(limit=OutputLimit(head=4, tail=6))
+        h.print_('0123')
+        h.print_('456789')
+        h.print_('tail')
+        out, _ = h.restore_output()
+        self.assertEqual(out, '0123\n[... 7 bytes of output omitted ...]\n'
+                              '\ntail\n')
+        self.assertEqual(h.full_output, (None, None))
+
+        h.capture_output(limit=OutputLimit(head=4, tail=6))
+        h.print_('short')
+        out, _ = h.restore_output()
+        self.assertEqual(out, 'short\n')
+
+    def test_capture_output_with_limit_keeps_full_output(self):
+        h = self.host()
+        # Without a UTF-8 stream, print_() would escape the text.
+        h.stdout = self._utf8_file()
+        h.capture_output(limit=OutputLimit(head=2, tail=2, keep_full=True))
+        h.print_('\u00e9' * 3, end='')
+        h.print_('12345')
+        out, err = h.restore_output()
+        # Multi-byte characters that are cut in two are replaced.
+        self.assertEqual(out, '\u00e9\n[... 8 bytes of output omitted ...]'
+                              '\n5\n')
+        self.assertEqual(err, '')
+        full_out, full_err = h.full_output
+        self.assertIsNone(full_err)
+        self.assertEqual(full_out.read(), '\u00e9' * 3 + '12345\n')
+
+    def _utf8_file(self):
+        f = tempfile.TemporaryFile('w+', encoding='utf-8')
+        self.addCleanup(f.close)
+        return f
+
+    def _fd_host(self):
+        # The test runner's own streams may not have file descriptors, so
+        # point the host at real files instead.
+        h = self.host()
+        h.stdout = self._utf8_file()
+        h.stderr = self._utf8_file()
+        return h
+
+    def test_capture_output_fds(self):
+        h = self._fd_host()
+        h.capture_output(fds=True)
+        h.print_('on stdout')
+        os.write(h.stdout.fileno(), b'native stdout\n')
+        os.write(h.stderr.fileno(), b'native stderr \xff\n')
+        out, err = h.restore_output()
+        self.assertEqual(out, 'on stdout\nnative stdout\n')
+        self.assertEqual(err, 'native stderr \ufffd\n')
+
+        # The original file descriptors are restored.
+        h.print_('after')
+        h.stdout.seek(0)
+        self.assertEqual(h.stdout.read(), 'after\n')
+
+    def test_capture_output_fds_with_limit(self):
+        h = self._fd_host()
+        h.capture_output(fds=True, limit=OutputLimit(head=3, tail=3,
+                                                     keep_full=True))
+        os.write(h.stdout.fileno(), b'native stdout\n')
+        os.write(h.stderr.fileno(), b'err')
+        out, err = h.restore_output()
+        self.assertEqual(out, 'nat\n[... 8 bytes of output omitted ...]\n'
+                              'ut\n')
+        self.assertEqual(err, 'err')
+        full_out, full_err = h.full_output
+        self.assertIsNone(full_err)
+        self.assertEqual(full_out.read(), 'native stdout\n')
+
+    def test_capture_output_fds_spills_large_output(self):
+        h = self._fd_host()
+        h.capture_output(fds=True)
+        os.write(h.stdout.fileno(), b'x' * 11)
+        os.write(h.stderr.fileno(), b'small')
+        out, err = h.restore_output(max_inline=10)
+        self.assertIsInstance(out, SpilledText)
+        self.assertTrue(os.path.exists(out.path))
+        self.assertEqual(out.read(), 'x' * 11)
+        self.assertFalse(os.path.exists(out.path))
+        self.assertEqual(err, 'small')
+
     def test_abspath_and_realpath(self):
         h = self.host()
         self.assertNotEqual(h.abspath(h.getcwd()), None)
@@ -83,10 +172,19 @@ class TestHost(unittest.TestCase):
             self.assertTrue(h.isfile(dirpath, 'bar', 'foo.txt'))
             self.assertFalse(h.isdir(dirpath, 'bar', 'foo.txt'))
 
+            h.append_text_file('bar/foo.txt', 'bar\nbaz\n')
+            self.assertEqual(h.read_text_file('bar/foo.txt'), 'foobar\nbaz\n')
+
             h.write_binary_file('binfile', b'bin contents')
             self.assertEqual(h.read_binary_file('binfile'),
                              b'bin contents')
 
+            with h.open('binfile', 'wb') as f:
+                f.write(b'bin ')
+                f.write(b'stream')
+            with h.open('binfile', 'rb') as f:
+                self.assertEqual(f.read(), b'bin stream')
+
             self.assertEqual(sorted(h.files_under(dirpath)),
                              ['bar' + h.sep + 'foo.txt', 'binfile'])
 
@@ -96,6 +194,12 @@ class TestHost(unittest.TestCase):
             self.assertFalse(h.exists(dirpath, 'bar', 'foo.txt'))
             self.assertFalse(h.isfile(dirpath, 'bar', 'foo.txt'))
 
+            h.replace(h.join(dirpath, 'binfile'),
+                      h.join(dirpath, 'bar', 'bin'))
+            self.assertFalse(h.exists(dirpath, 'binfile'))
+            self.assertEqual(h.read_binary_file(dirpath, 'bar', 'bin'),
+                             b'bin stream')
+
             h.chdir(orig_cwd)
             h.rmtree(dirpath)
             self.assertFalse(h.exists(dirpath))
@@ -12,10 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import gzip
+import json
+import os
+import pickle
 import re
 import unittest
 
 from typ import json_results
+from typ.fakes.host_fake import FakeHost
 
 
 class FakeArtifacts(object):
@@ -68,6 +73,67 @@ class TestMakeUploadRequest(unittest.TestCase):
              '---J-S-O-N-R-E-S-U-L-T-S---B-O-U-N-D-A-R-Y---\r\n'))
 
 
+    def test_compressed_upload(self):
+        full_results = json_results.make_full_results(
+            {}, 0, [], json_results.ResultSet())
+        _, content_type, data = json_results.make_upload_request(
+            'localhost', 'fake_builder_name', 'fake_master', 'fake_test_type',
+            full_results)
+        _, compressed_content_type, compressed_data = (
+            json_results.make_upload_request(
+                'localhost', 'fake_builder_name', 'fake_master',
+                'fake_test_type', full_results, compression='gzip'))
+        self.assertEqual(compressed_content_type, content_type)
+        body = gzip.decompress(compressed_data).decode('utf-8')
+        self.assertIn('"version":3', body)
+        self.assertEqual(body.replace(', ', ',').replace(': ', ':'),
+                         data.replace(', ', ',').replace(': ', ':'))
+
+
+class TestCompression(unittest.TestCase):
+
+    def test_gzip_round_trip(self):
+        data = b'{"a": 1}'
+        compressed = json_results.compress(data, 'gzip')
+        self.assertNotEqual(compressed, data)
+        self.assertEqual(json_results.decompress(compressed), data)
+        # Uncompressed data is returned as is.
+        self.assertEqual(json_results.decompress(data), data)
+
+    def test_compression_extension(self):
+        self.assertEqual(json_results.compression_extension('gzip'), '.gz')
+        self.assertEqual(json_results.compression_extension('zstd'), '.zst')
+
+    def test_resolve_compression(self):
+        self.assertIsNone(json_results.resolve_compression(None))
+        self.assertEqual(json_results.resolve_compression('gzip'), 'gzip')
+        # pylint: disable=protected-access
+        expected = 'zstd' if json_results._zstd_module() else 'gzip'
+        self.assertEqual(json_results.resolve_compression('zstd'), expected)
+
+    # pylint: disable=protected-access
+    @unittest.skipIf(json_results._zstd_module() is None,
+                     'zstd is not available')
+    def test_zstd_round_trip(self):
+        data = b'{"a": 1}'
+        compressed = json_results.compress(data, 'zstd')
+        self.assertNotEqual(compressed, data)
+        self.assertEqual(json_results.decompress(compressed), data)
+
+    def test_write_and_read_json_file(self):
+        host = FakeHost()
+        obj = {'version': 3, 'tests': {'a': {'actual': 'PASS'}}}
+        json_results.write_json_file(host, 'plain.json', obj)
+        self.assertEqual(host.read_text_file('plain.json'),
+                         json.dumps(obj, indent=2) + '\n')
+        json_results.write_json_file(host, 'compressed.json.gz', obj, 'gzip')
+        self.assertEqual(
+            gzip.decompress(host.read_binary_file('compressed.json.gz')),
+            b'{"version":3,"tests":{"a":{"actual":"PASS"}}}')
+        for path in ('plain.json', 'compressed.json.gz'):
+            self.assertEqual(json_results.read_json_file(host, path), obj)
+
+
 class TestMakeFullResults(unittest.TestCase):
     maxDiff = 2048
 
@@ -240,3 +306,121 @@ class TestMakeFullResults(unittest.TestCase):
             if iso_format_regex.match(artifact_name):
                 self.assertEqual(artifact_content, 'content2')
                 break
+
+
+class TestResultsSidecar(unittest.TestCase):
+
+    def make_results(self, host, path):
+        sidecar = json_results.ResultsSidecar(host, path)
+        sidecar.start({'foo': 'bar'}, 10,
+                      ['foo_test.FooTest.test_fail',
+                       'foo_test.FooTest.test_pass',
+                       'foo_test.FooTest.test_not_run'])
+        results = json_results.ResultSet(sidecar)
+        results.add(json_results.Result(
+            'foo_test.FooTest.test_fail', json_results.ResultType.Failure,
+            0, 0.1, 0, unexpected=True, out='out',
+            in_memory_text_artifacts={'log': 'failed'}))
+        results.add(json_results.Result(
+            'foo_test.FooTest.test_pass', json_results.ResultType.Pass, 0,
+            0.2, 0, artifacts={'screenshot': ['a/b.png']}))
+        return results
+
+    def test_full_results_match(self):
+        host = FakeHost()
+        results = self.make_results(host, 'results.jsonl')
+        all_test_names = ['foo_test.FooTest.test_fail',
+                          'foo_test.FooTest.test_pass',
+                          'foo_test.FooTest.test_not_run']
+        self.assertEqual(
+            json_results.make_full_results_from_sidecar(
+                host, 'results.jsonl', seconds_since_epoch=20),
+            json_results.make_full_results(
+                {'foo': 'bar'}, 20, all_test_names, results))
+
+    def test_interrupted(self):
+        host = FakeHost()
+        self.make_results(host, 'results.jsonl')
+        # Cut the last result short, as if the process had been killed while
+        # writing it.
+        host.files[host.abspath('results.jsonl')] = (
+            host.read_text_file('results.jsonl')[:-20])
+        full_results = json_results.make_full_results_from_sidecar(
+            host, 'results.jsonl', interrupted=True)
+        self.assertTrue(full_results['interrupted'])
+        self.assertEqual(full_results['seconds_since_epoch'], 10)
+        self.assertEqual(full_results['metadata'], {'foo': 'bar'})
+        self.assertEqual(list(full_results['tests']['foo_test']['FooTest']),
+                         ['test_fail'])
+        self.assertEqual(full_results['num_regressions'], 1)
+        self.assertEqual(
+            full_results['tests']['foo_test']['FooTest']['test_fail'][
+                'in_memory_text_artifacts'],
+            {'log': 'failed'})
+
+    def test_read_sidecar_keeps_result_fields(self):
+        host = FakeHost()
+        sidecar = json_results.ResultsSidecar(host, 'results.jsonl')
+        sidecar.start({}, 10, ['foo_test.FooTest.test_flaky'])
+        sidecar.add(json_results.Result(
+            'foo_test.FooTest.test_flaky', json_results.ResultType.Failure,
+            5, 0.1, 2, unexpected=True, flaky=True, code=1, pid=123,
+            file_path='foo_test.py', line_number=12,
+            failure_reason=json_results.FailureReason('boom'),
+            associated_bugs='crbug.com/1'))
+        _, results = json_results.read_sidecar(host, 'results.jsonl')
+        result = results.results[0]
+        self.assertEqual(
+            (result.started, result.worker, result.flaky, result.code,
+             result.pid, result.file_path, result.line_number,
+             result.associated_bugs),
+            (5, 2, True, 1, 123, 'foo_test.py', 12, 'crbug.com/1'))
+        self.assertEqual(result.failure_reason.primary_error_message, 'boom')
+
+    def test_invalid_line_before_the_last_one(self):
+        host = FakeHost()
+        host.write_text_file('results.jsonl', '{}\n{"name"\n{}\n')
+        with self.assertRaises(ValueError) as e:
+            json_results.read_sidecar(host, 'results.jsonl')
+        self.assertIn('results.jsonl:2', str(e.exception))
+
+    def test_no_header(self):
+        host = FakeHost()
+        host.write_text_file('results.jsonl', '')
+        with self.assertRaises(ValueError):
+            json_results.read_sidecar(host, 'results.jsonl')
+
+
+class TestResultSpillLargeText(unittest.TestCase):
+
+    def test_spill_large_text(self):
+        out = 'x' * 100 + '\r\n\u2603'
+        result = json_results.Result(
+            'foo_test.FooTest.foobar', json_results.ResultType.Pass, 0, 0.2,
+            0, out=out, err='small',
+            in_memory_text_artifacts={'big': 'y' * 100, 'small': 'z'})
+        result.spill_large_text(50)
+        # pylint: disable=protected-access
+        paths = [result._out.path,
+                 result._in_memory_text_artifacts['big'].path]
+        self.assertEqual(result._err, 'small')
+        self.assertEqual(result._in_memory_text_artifacts['small'], 'z')
+        self.assertLess(len(pickle.dumps(result)), 1000)
+
+        result = pickle.loads(pickle.dumps(result))
+        self.assertEqual(result.out, out)
+        self.assertEqual(result.err, 'small')
+        self.assertEqual(result.in_memory_text_artifacts,
+                         {'big': 'y' * 100, 'small': 'z'})
+        # The files are removed once read, and the text is kept in memory.
+        self.assertFalse(any(os.path.exists(p) for p in paths))
+        self.assertEqual(result.out, out)
+
+    def test_spill_nothing_below_threshold(self):
+        result = json_results.Result(
+            'foo_test.FooTest.foobar', json_results.ResultType.Pass, 0, 0.2,
+            0, out='out', err='err')
+        result.spill_large_text(50)
+        # pylint: disable=protected-access
+        self.assertEqual((result._out, result._err), ('out', 'err'))
+        self.assertIsNone(result.in_memory_text_artifacts)
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import io
 import json
 import os
@@ -41,6 +42,24 @@ class ArtifactTest(test_case.TestCase):
         self.fail()
 """
 
+BINARY_ARTIFACTS_TEST_PY = """
+from typ import test_case
+
+class ArtifactTest(test_case.TestCase):
+    def test_produce_artifact_for_retries(self):
+        self.artifacts.CreateArtifact('artifact_name', 'test.txt', b'content')
+        self.fail()
+"""
+
+OVERWRITTEN_ARTIFACT_TEST_PY = """
+from typ import test_case
+
+class ArtifactTest(test_case.TestCase):
+    def test_overwrite_artifact(self):
+        self.artifacts.CreateArtifact('artifact_name', 'test.txt', b'one')
+        self.artifacts.CreateArtifact('artifact_name', 'test.txt', b'two')
+"""
+
 FLAKY_TEST_PY = """
 import unittest
 
@@ -137,6 +156,17 @@ class FailTest(unittest.TestCase):
 OUTPUT_TEST_FILES = {'output_test.py': OUTPUT_TEST_PY}
 
 
+LARGE_OUTPUT_TEST_PY = """
+import sys
+import unittest
+
+class LargeOutputTest(unittest.TestCase):
+  def test_large_output(self):
+    sys.stdout.write('start' + 'x' * 4096 + 'end\\n')
+    self.fail()
+"""
+
+
 START_TEST_PY = """
 import unittest
 
@@ -919,6 +949,32 @@ class TestCli(test_case.MainTestCase):
                          r'\d+.\d+s \(worker 1\)\n'
                          r'1 test passed in \d+.\d+s, 0 skipped, 0 failures.'))
 
+    def test_test_times_file(self):
+        files = dict(PASS_TEST_FILES)
+        files.update(FAIL_TEST_FILES)
+        files['times.json'] = json.dumps({
+            'path_delimiter': '.',
+            'tests': {
+                'fail_test': {'FailingTest': {'test_fail': {
+                    'actual': 'FAIL', 'expected': 'PASS', 'times': [5.0]}}},
+                'pass_test': {'PassingTest': {'test_pass': {
+                    'actual': 'PASS', 'expected': 'PASS',
+                    'times': [1.0, 3.0]}}},
+            },
+        })
+        _, out, _, _ = self.check(
+            ['-j', '1', '-s', '[%W] ', '--test-times-file', 'times.json'],
+            files=files, ret=1, err='')
+        self.assertIn('[2.0] fail_test.FailingTest.test_fail failed', out)
+        self.assertIn('[0.0] pass_test.PassingTest.test_pass passed', out)
+
+    def test_bad_test_times_file(self):
+        files = dict(PASS_TEST_FILES)
+        files['times.json'] = '{}'
+        self.check(['--test-times-file', 'times.json'], files=files, ret=1,
+                   out='', rerr='Error: could not read test times from '
+                               '"times.json"')
+
     def test_test_results_server(self):
         # TODO(crbug.com/1217853) Figure out why this isn't working under
         # py3 (and/or possibly running in parallel on mac).
@@ -1327,6 +1383,61 @@ class TestCli(test_case.MainTestCase):
             os.path.join('artifacts', 'test_produce_artifact_for_retries',
                          'retry_1', 'test.txt'), files)
 
+    def test_artifacts_deduped_for_retries(self):
+        files = {'artifacts_test.py': BINARY_ARTIFACTS_TEST_PY}
+        _, out, err, files = self.check(
+            ['--test-name-prefix', 'artifacts_test.ArtifactTest.',
+             '--write-full-results-to', 'full_results.json', '--retry-limit=1',
+             '--dedupe-artifacts'],
+            files=files, ret=1, err='')
+        results = json.loads(files['full_results.json'])
+        artifacts = results['tests']['test_produce_artifact_for_retries']['artifacts']
+        digest = hashlib.sha256(b'content').hexdigest()
+        path = os.path.join('blobs', digest[:2], digest + '.txt')
+        # Both runs of the test refer to the one copy of the content.
+        self.assertEqual(artifacts['artifact_name'], [path, path])
+        self.assertEqual(files[os.path.join('artifacts', path)], 'content')
+        self.assertNotIn(
+            os.path.join('artifacts', 'test_produce_artifact_for_retries',
+                         'test.txt'), files)
+
+    def test_async_artifact_write_failure_fails_test(self):
+        files = {'artifacts_test.py': OVERWRITTEN_ARTIFACT_TEST_PY}
+        _, out, _, files = self.check(
+            ['--test-name-prefix', 'artifacts_test.ArtifactTest.',
+             '--write-full-results-to', 'full_results.json',
+             '--artifact-writer-threads', '2'],
+            files=files, ret=1, err='')
+        self.assertIn('Failed to write an artifact:', out)
+        self.assertIn('test.txt already exists.', out)
+        self.assertEqual(
+            files[os.path.join('artifacts', 'test_overwrite_artifact',
+                               'test.txt')],
+            'one')
+
+    def test_large_output_is_truncated(self):
+        files = {'large_output_test.py': LARGE_OUTPUT_TEST_PY}
+        _, out, _, files = self.check(
+            ['--max-output-head-kb', '1', '--max-output-tail-kb', '1',
+             '--save-full-output', '--write-full-results-to',
+             'full_results.json', '--write-trace-to', 'trace.json',
+             '-j', '1'],
+            files=files, ret=1, err='')
+        self.assertIn('  start' + 'x' * 1019 + '\n'
+                      '  [... 2057 bytes of output omitted ...]\n'
+                      '  ' + 'x' * 1020 + 'end\n', out)
+        trace = json.loads(files['trace.json'])
+        self.assertIn('[... 2057 bytes of output omitted ...]',
+                      trace['traceEvents'][0]['args']['out'])
+        results = json.loads(files['full_results.json'])
+        artifacts = results['tests']['large_output_test']['LargeOutputTest'][
+            'test_large_output']['artifacts']
+        path = os.path.join('large_output_test.LargeOutputTest.'
+                            'test_large_output', 'typ_full_stdout.txt')
+        self.assertEqual(artifacts, {'typ_full_stdout': [path]})
+        self.assertEqual(files[os.path.join('artifacts', path)],
+                         'start' + 'x' * 4096 + 'end\n')
+
     def test_matches_partial_filter(self):
         # test that a bare string matches anywhere in the test name.
         _, out, _, _ = self.check(
@@ -1519,6 +1630,31 @@ class TestCli(test_case.MainTestCase):
         self.assertEqual(event['tid'], 1)
         self.assertEqual(event['args']['expected'], ['PASS'])
         self.assertEqual(event['args']['actual'], 'PASS')
+        event = trace_obj['traceEvents'][1]
+        self.assertEqual(event['name'], 'run')
+        self.assertEqual(sorted(event['args']),
+                         ['coalesced_updates', 'printing_time',
+                          'test_phases'])
+        self.assertIn('test', event['args']['test_phases'])
+
+    def test_trace_test_phases(self):
+        _, _, _, files = self.check(['--write-trace-to', 'trace.json',
+                                     '--trace-test-phases', '-j', '1'],
+                                    files=PASS_TEST_FILES)
+        trace_obj = json.loads(files['trace.json'])
+        test_event = trace_obj['traceEvents'][0]
+        self.assertEqual(test_event['name'], 'pass_test.PassingTest.test_pass')
+        phases = [event for event in trace_obj['traceEvents']
+                  if event.get('cat') == 'phase']
+        self.assertEqual(
+            [event['name'] for event in phases],
+            ['capture_output', 'expectations', 'load', 'prepare', 'test',
+             'restore_output', 'expectations', 'inspect', 'make_result',
+             'result_sink'])
+        for event in phases:
+            self.assertEqual(event['tid'], test_event['tid'])
+            self.assertEqual(event['pid'], test_event['pid'])
+            self.assertGreaterEqual(event['ts'], test_event['ts'])
 
     def test_expected_failure_does_not_get_retried(self):
         files = {'fail_test.py': FAIL_TEST_PY,
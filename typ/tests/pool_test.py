@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import queue
 import sys
 import unittest
 
@@ -90,6 +91,18 @@ class TestPool(test_case.TestCase):
     def test_basic_two_jobs(self):
         self.run_basic_test(2)
 
+    def test_get_with_timeout(self):
+        host = Host()
+        context = {'pre': False, 'post': False}
+        pool = make_pool(host, 2, False, _echo, context, _pre, _post)
+        try:
+            self.assertRaises(queue.Empty, pool.get, timeout=0.01)
+            pool.send('hello')
+            self.assertEqual(pool.get(timeout=60), 'True/False/hello')
+            pool.close()
+        finally:
+            pool.join()
+
     def test_join_discards_messages(self):
         host = Host()
         context = {'pre': False, 'post': False}
@@ -59,3 +59,41 @@ class TestPrinter(unittest.TestCase):
                           '\n',
                           'baz',
                           '\n'])
+
+    def test_rate_limited_overwrite(self):
+        now = [0]
+        pr = Printer(self.print_, True, 80, lambda: now[0], 0.05)
+        pr.update('one')
+        pr.update('two')
+        pr.update('three')
+        self.assertEqual(self.out, ['one'])
+        self.assertTrue(pr.has_pending_update())
+
+        # Only the latest update is printed once enough time has passed.
+        now[0] = 0.1
+        pr.update('four')
+        self.assertEqual(self.out, ['one', '\r   \r', 'four'])
+        self.assertFalse(pr.has_pending_update())
+
+        pr.update('five')
+        pr.flush()
+        self.assertEqual(self.out, ['one', '\r   \r', 'four',
+                                    '\r    \r', 'five', '\n'])
+        self.assertEqual(pr.coalesced_updates, 2)
+
+    def test_rate_limited_non_elided_updates_print_immediately(self):
+        pr = Printer(self.print_, True, 80, lambda: 0, 0.05)
+        pr.update('one')
+        pr.update('two')
+        pr.update('regression\n', elide=False)
+        pr.update('three')
+        pr.write_pending()
+        self.assertEqual(self.out, ['one', '\r   \r', 'regression\n',
+                                    'three'])
+
+    def test_rate_limit_ignored_when_not_overwriting(self):
+        pr = Printer(self.print_, False, 80, lambda: 0, 0.05)
+        pr.update('one')
+        pr.update('two')
+        pr.flush()
+        self.assertEqual(self.out, ['one', '\n', 'two', '\n'])
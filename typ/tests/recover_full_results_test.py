@@ -0,0 +1,53 @@
+# Copyright 2025 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import json
+import unittest
+
+from typ import json_results
+from typ import recover_full_results
+from typ.fakes.host_fake import FakeHost
+
+
+class RecoverFullResultsTest(unittest.TestCase):
+
+    def test_recover(self):
+        host = FakeHost()
+        sidecar = json_results.ResultsSidecar(host, 'results.jsonl')
+        sidecar.start({}, 10, ['a.b.test_pass', 'a.b.test_not_run'])
+        sidecar.add(json_results.Result(
+            'a.b.test_pass', json_results.ResultType.Pass, 0, 0.1, 0))
+        ret = recover_full_results.main(
+            ['results.jsonl', 'full_results.json'], host)
+        self.assertEqual(ret, 0)
+        self.assertEqual(
+            host.stdout.getvalue(),
+            'Wrote the results of 1 tests to "full_results.json".\n')
+        full_results = json.loads(host.read_text_file('full_results.json'))
+        self.assertTrue(full_results['interrupted'])
+        self.assertEqual(full_results['tests'], {
+            'a': {'b': {'test_pass': {'expected': 'PASS', 'actual': 'PASS',
+                                      'times': [0.1]}}}})
+
+    def test_recover_compressed(self):
+        host = FakeHost()
+        json_results.ResultsSidecar(host, 'results.jsonl').start(
+            {}, 10, ['a.b.test_not_run'])
+        ret = recover_full_results.main(
+            ['results.jsonl', 'full_results.json.gz',
+             '--compress-outputs', 'gzip'], host)
+        self.assertEqual(ret, 0)
+        full_results = json_results.read_json_file(
+            host, 'full_results.json.gz')
+        self.assertEqual(full_results['tests'], {})
+
+    def test_invalid_sidecar(self):
+        host = FakeHost()
+        host.write_text_file('results.jsonl', '{}\n')
+        ret = recover_full_results.main(
+            ['results.jsonl', 'full_results.json'], host)
+        self.assertEqual(ret, 1)
+        self.assertIn('Error: could not read "results.jsonl"',
+                      host.stderr.getvalue())
+        self.assertFalse(host.exists('full_results.json'))
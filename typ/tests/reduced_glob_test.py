@@ -2,11 +2,21 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import pickle
+import random
+import re
 import unittest
 
 from typ import reduced_glob
 
 
+def _reference_matchcase(glob, name):
+    """Matches |name| with a regular expression built from |glob|."""
+    # pylint: disable=protected-access
+    regex = '.*'.join(re.escape(s) for s in glob._substrings)
+    return re.fullmatch(regex, name, re.DOTALL) is not None
+
+
 class GlobUnittest(unittest.TestCase):
 
     def testMatchcaseGlob(self):
@@ -59,3 +69,74 @@ class GlobUnittest(unittest.TestCase):
         glob = reduced_glob.ReducedGlob('t[!a]st')
         self.assertFalse(glob.matchcase('test'))
         self.assertTrue(glob.matchcase('t[!a]st'))
+
+    def testPatternProperty(self):
+        self.assertEqual(reduced_glob.ReducedGlob('a/*/c').pattern, 'a/*/c')
+
+    def testGlobsMatchingAny(self):
+        globs = [reduced_glob.ReducedGlob(p) for p in (
+            'a/*', '*/c', 'a/*/c', '*b*', 'a/b', 'x/*', '*/z', 'x*y',
+            'a/\\*', '*')]
+        names = ['a/b/c', 'a/b', 'd/e/c', 'a/*']
+        matched = reduced_glob.globs_matching_any(globs, names)
+        self.assertEqual(
+            sorted(g.pattern for g in matched),
+            sorted(['a/*', '*/c', 'a/*/c', '*b*', 'a/b', 'a/\\*', '*']))
+        self.assertEqual(reduced_glob.globs_matching_any(globs, []), set())
+
+    def testGlobsMatchingAnyMatchesMatchcase(self):
+        rand = random.Random(1234)
+        alphabet = 'ab/*'
+        names = set()
+        for _ in range(200):
+            names.add(''.join(rand.choice('ab/')
+                              for _ in range(rand.randint(0, 6))))
+        patterns = set()
+        for _ in range(200):
+            patterns.add(''.join(rand.choice(alphabet)
+                                 for _ in range(rand.randint(0, 6))))
+        globs = [reduced_glob.ReducedGlob(p) for p in patterns]
+        expected = {g for g in globs if any(g.matchcase(n) for n in names)}
+        self.assertEqual(reduced_glob.globs_matching_any(globs, names),
+                         expected)
+
+    def testMatchcaseMatchesReference(self):
+        rand = random.Random(4321)
+        names = {''.join(rand.choice('ab/*')
+                         for _ in range(rand.randint(0, 8)))
+                 for _ in range(300)}
+        patterns = {''.join(rand.choice(['a', 'b', '/', '*', '\\*'])
+                            for _ in range(rand.randint(0, 6)))
+                    for _ in range(300)}
+        for pattern in patterns:
+            glob = reduced_glob.ReducedGlob(pattern)
+            for name in names:
+                self.assertEqual(glob.matchcase(name),
+                                 _reference_matchcase(glob, name),
+                                 (pattern, name))
+
+    def testMatchcaseLiteralRequiresWholeName(self):
+        glob = reduced_glob.ReducedGlob('ab')
+        self.assertTrue(glob.matchcase('ab'))
+        self.assertFalse(glob.matchcase('abab'))
+
+    def testMatchcasePrefixAndSuffixDoNotOverlap(self):
+        glob = reduced_glob.ReducedGlob('ab*ba')
+        self.assertFalse(glob.matchcase('aba'))
+        self.assertTrue(glob.matchcase('abba'))
+        glob = reduced_glob.ReducedGlob('a*b*a')
+        self.assertFalse(glob.matchcase('ab'))
+        self.assertTrue(glob.matchcase('aba'))
+
+    def testMatchMany(self):
+        glob = reduced_glob.ReducedGlob('a/*/c')
+        names = ['a/b/c', 'a/c', 'b/a/c', 'a//c', 'a/b/c/d', 'a/x/c']
+        self.assertEqual(glob.match_many(names), ['a/b/c', 'a//c', 'a/x/c'])
+        self.assertEqual(glob.match_many(iter(names)),
+                         [n for n in names if glob.matchcase(n)])
+        self.assertEqual(glob.match_many([]), [])
+
+    def testPicklable(self):
+        glob = pickle.loads(pickle.dumps(reduced_glob.ReducedGlob('a*b*c')))
+        self.assertTrue(glob.matchcase('a_b_c'))
+        self.assertFalse(glob.matchcase('a_c_b'))
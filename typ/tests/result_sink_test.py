@@ -13,15 +13,22 @@
 # limitations under the License.
 
 import base64
+import gzip
 import hashlib
 import json
 import os
+import pickle
+import shutil
+import tempfile
+import threading
 import unittest
 
+from typ import artifacts
 from typ import expectations_parser
 from typ import json_results
 from typ import result_sink
 from typ.fakes import host_fake
+from typ.host import Host
 
 
 DEFAULT_LUCI_CONTEXT = {
@@ -298,6 +305,31 @@ class ResultSinkReporterTest(unittest.TestCase):
             CreateExpectedTestResult(status='FAIL', expected=False),
         ])
 
+    def testBatchResultsOutputFile(self):
+        output_filepath = '/tmp/output.json'
+        rsr = ResultSinkReporterWithFakeSrc(
+            self._host, output_file=output_filepath)
+        appends = []
+        append_text_file = self._host.append_text_file
+
+        def append(path, contents):
+            appends.append(contents)
+            append_text_file(path, contents)
+
+        self._host.append_text_file = append
+        with rsr.batch_results():
+            self._reportResults(rsr, [json_results.ResultType.Timeout,
+                                      json_results.ResultType.Pass])
+            self.assertEqual(appends, [])
+        # The whole batch is appended at once.
+        self.assertEqual(len(appends), 1)
+        got_results = [json.loads(x) for x in
+                       self._host.files[output_filepath].splitlines()]
+        self.assertEqual(got_results, [
+            CreateExpectedTestResult(status='ABORT', expected=False),
+            CreateExpectedTestResult(),
+        ])
+
     def testBatchResultsFailure(self):
         self.setLuciContextWithContent(DEFAULT_LUCI_CONTEXT)
         rsr = ResultSinkReporterWithFakeSrc(self._host)
@@ -350,6 +382,219 @@ class ResultSinkReporterTest(unittest.TestCase):
                 with rsr.batch_results():
                     pass
 
+    def _reportResults(self, rsr, actuals):
+        for actual in actuals:
+            result = CreateResult({'name': 'test_name', 'actual': actual})
+            status = rsr.report_individual_test_result(
+                result, ARTIFACT_DIR, CreateTestExpectations(),
+                FAKE_TEST_PATH, FAKE_TEST_LINE, 'test_name_prefix.')
+            self.assertEqual(status, 0)
+
+    def testBackgroundUpload(self):
+        self.setLuciContextWithContent(DEFAULT_LUCI_CONTEXT)
+        rsr = ResultSinkReporterWithFakeSrc(self._host)
+        posts = []
+
+        def post(url, content):
+            posts.append(content)
+            return 0
+
+        rsr._post = post
+        rsr.start_background_upload(2, flush_interval=60)
+        self._reportResults(rsr, [json_results.ResultType.Timeout,
+                                  json_results.ResultType.Failure,
+                                  json_results.ResultType.Pass])
+        self.assertEqual(rsr.stop_background_upload(), 0)
+        self.assertEqual(
+            [json.loads(p)['testResults'] for p in posts],
+            [[CreateExpectedTestResult(status='ABORT', expected=False),
+              CreateExpectedTestResult(status='FAIL', expected=False)],
+             [CreateExpectedTestResult(status='PASS')]])
+
+    def testBackgroundUploadFlushInterval(self):
+        self.setLuciContextWithContent(DEFAULT_LUCI_CONTEXT)
+        rsr = ResultSinkReporterWithFakeSrc(self._host)
+        posted = threading.Event()
+
+        def post(url, content):
+            posted.set()
+            return 0
+
+        rsr._post = post
+        rsr.start_background_upload(100, flush_interval=0.01)
+        self._reportResults(rsr, [json_results.ResultType.Pass])
+        # The partial batch is uploaded without waiting for the stop.
+        self.assertTrue(posted.wait(10))
+        self.assertEqual(rsr.stop_background_upload(), 0)
+
+    def testBackgroundUploadFailure(self):
+        self.setLuciContextWithContent(DEFAULT_LUCI_CONTEXT)
+        rsr = ResultSinkReporterWithFakeSrc(self._host)
+
+        def post(url, content):
+            raise IOError('connection refused')
+
+        rsr._post = post
+        rsr.start_background_upload(1, flush_timeout=0)
+        self._reportResults(rsr, [json_results.ResultType.Pass] * 3)
+        self.assertEqual(rsr.stop_background_upload(), 1)
+
+    def testBackgroundUploadRetries(self):
+        self.setLuciContextWithContent(DEFAULT_LUCI_CONTEXT)
+        rsr = ResultSinkReporterWithFakeSrc(self._host)
+        statuses = [1, 1, 0, 0]
+        uploaded = []
+
+        def post(url, content):
+            status = statuses.pop(0)
+            if not status:
+                uploaded.extend(json.loads(content)['testResults'])
+            return status
+
+        rsr._post = post
+        rsr.start_background_upload(1)
+        rsr._uploader._retry_delay = 0
+        self._reportResults(rsr, [json_results.ResultType.Timeout,
+                                  json_results.ResultType.Pass])
+        self.assertEqual(rsr.stop_background_upload(), 0)
+        self.assertEqual(statuses, [])
+        self.assertEqual(
+            sorted(r['status'] for r in uploaded), ['ABORT', 'PASS'])
+
+    def testBackgroundUploadSpool(self):
+        self.setLuciContextWithContent(DEFAULT_LUCI_CONTEXT)
+        rsr = ResultSinkReporterWithFakeSrc(self._host)
+        rsr._post = StubWithRetval(1)
+        rsr.start_background_upload(2, flush_timeout=0,
+                                    spool_dir='/tmp/spool')
+        self._reportResults(rsr, [json_results.ResultType.Pass] * 3)
+        self.assertEqual(rsr.stop_background_upload(), 1)
+        spooled = sorted(self._host.files_under('/tmp/spool'))
+        self.assertEqual(len(spooled), 2)
+        self.assertEqual(
+            json.loads(gzip.decompress(self._host.read_binary_file(
+                '/tmp/spool', spooled[0]))),
+            [CreateExpectedTestResult()] * 2)
+
+        # A later run uploads what was left in the spool.
+        rsr = ResultSinkReporterWithFakeSrc(self._host)
+        uploaded = []
+
+        def post(url, content):
+            uploaded.extend(json.loads(content)['testResults'])
+            return 0
+
+        rsr._post = post
+        rsr.start_background_upload(2, spool_dir='/tmp/spool',
+                                    recover_spool=True)
+        self.assertEqual(rsr.stop_background_upload(), 0)
+        self.assertEqual(uploaded, [CreateExpectedTestResult()] * 3)
+        self.assertEqual(self._host.files_under('/tmp/spool'), [])
+
+    def testBackgroundUploadOutputFile(self):
+        output_filepath = '/tmp/output.json'
+        rsr = ResultSinkReporterWithFakeSrc(
+            self._host, output_file=output_filepath)
+        rsr.start_background_upload(10)
+        self._reportResults(rsr, [json_results.ResultType.Pass] * 2)
+        self.assertEqual(rsr.stop_background_upload(), 0)
+        got_results = [json.loads(x) for x in
+                       self._host.files[output_filepath].splitlines()]
+        self.assertEqual(got_results, [CreateExpectedTestResult()] * 2)
+
+    def testBackgroundUploadNotSupported(self):
+        rsr = ResultSinkReporterWithFakeSrc(self._host)
+        rsr.start_background_upload(10)
+        self.assertEqual(rsr.stop_background_upload(), 0)
+
+    def testBackgroundUploadCannotNest(self):
+        self.setLuciContextWithContent(DEFAULT_LUCI_CONTEXT)
+        rsr = ResultSinkReporterWithFakeSrc(self._host)
+        rsr.start_background_upload(10)
+        with self.assertRaisesRegex(result_sink.ResultSinkError,
+                                    'already running'):
+            rsr.start_background_upload(10)
+        self.assertEqual(rsr.stop_background_upload(), 0)
+
+    def testPrepareAndReportPreparedResult(self):
+        self.setLuciContextWithContent(DEFAULT_LUCI_CONTEXT)
+        rsr = ResultSinkReporterWithFakeSrc(self._host)
+        rsr._post = StubWithRetval(0)
+        result = CreateResult({
+            'name': 'test_name',
+            'actual': json_results.ResultType.Failure,
+        })
+        test_result = rsr.prepare_individual_test_result(
+            result, ARTIFACT_DIR, CreateTestExpectations(), FAKE_TEST_PATH,
+            FAKE_TEST_LINE, 'test_name_prefix.')
+        expected_result = CreateExpectedTestResult(status='FAIL',
+                                                   expected=False)
+        self.assertEqual(test_result, expected_result)
+        self.assertIsNone(rsr._post.args)
+
+        self.assertEqual(rsr.report_prepared_result(test_result), 0)
+        self.assertEqual(GetTestResultFromPostedJson(rsr._post.args[1]),
+                         expected_result)
+
+    def testPrepareSpilledResultReadsTextWhenReported(self):
+        self.setLuciContextWithContent(DEFAULT_LUCI_CONTEXT)
+        rsr = ResultSinkReporterWithFakeSrc(self._host)
+        rsr._post = StubWithRetval(0)
+        out = 'x' * 100
+        result = CreateResult({
+            'name': 'test_name',
+            'actual': json_results.ResultType.Failure,
+            'out': out,
+            'in_memory_text_artifacts': {'log': 'y' * 100},
+        })
+        result.spill_large_text(50)
+        test_result = rsr.prepare_individual_test_result(
+            result, ARTIFACT_DIR, CreateTestExpectations(), FAKE_TEST_PATH,
+            FAKE_TEST_LINE, 'test_name_prefix.')
+        # The payload refers to the spilled files rather than copying them.
+        self.assertLess(len(pickle.dumps(test_result)), 2000)
+        self.assertEqual(rsr.report_prepared_result(test_result), 0)
+        posted = GetTestResultFromPostedJson(rsr._post.args[1])
+        self.assertEqual(
+            base64.b64decode(posted['artifacts']['typ_stdout']['contents']),
+            out.encode('utf-8'))
+        self.assertEqual(
+            base64.b64decode(posted['artifacts']['log']['contents']),
+            b'y' * 100)
+        # The result can still read its own output.
+        self.assertEqual(result.out, out)
+        self.assertEqual(result.in_memory_text_artifacts, {'log': 'y' * 100})
+
+    def testPrepareIndividualTestResultNotSupported(self):
+        rsr = ResultSinkReporterWithFakeSrc(self._host)
+        result = CreateResult({
+            'name': 'test_name',
+            'actual': json_results.ResultType.Pass,
+        })
+        self.assertIsNone(rsr.prepare_individual_test_result(
+            result, ARTIFACT_DIR, CreateTestExpectations(), FAKE_TEST_PATH,
+            FAKE_TEST_LINE, 'test_name_prefix.'))
+        self.assertEqual(rsr.report_prepared_result({}), 0)
+
+    def testBackgroundUploadConcurrent(self):
+        self.setLuciContextWithContent(DEFAULT_LUCI_CONTEXT)
+        rsr = ResultSinkReporterWithFakeSrc(self._host)
+        lock = threading.Lock()
+        posted = []
+
+        def post(url, content):
+            with lock:
+                posted.extend(json.loads(content)['testResults'])
+                return 1 if len(posted) == 5 else 0
+
+        rsr._post = post
+        rsr.start_background_upload(1, max_concurrent_uploads=3)
+        rsr._uploader._retry_delay = 0
+        self._reportResults(rsr, [json_results.ResultType.Pass] * 10)
+        self.assertEqual(rsr.stop_background_upload(), 0)
+        # The failed upload was retried.
+        self.assertEqual(posted, [CreateExpectedTestResult()] * 11)
+
     def testReportIndividualTestResultFailureReason(self):
         self.setLuciContextWithContent(DEFAULT_LUCI_CONTEXT)
         rsr = ResultSinkReporterWithFakeSrc(self._host)
@@ -536,6 +781,39 @@ class ResultSinkReporterTest(unittest.TestCase):
                 artifacts=expected_artifacts)
         self.assertEqual(test_result, expected_result)
 
+    def testReportIndividualTestResultArchivedArtifact(self):
+        output_dir = tempfile.mkdtemp()
+        try:
+            archive = artifacts.ArtifactArchive(output_dir, Host(), 1)
+            path = archive.Add('log.txt', b'archived')
+            archive.Close()
+            self.setLuciContextWithContent(DEFAULT_LUCI_CONTEXT)
+            rsr = ResultSinkReporterWithFakeSrc(self._host)
+            rsr._post = StubWithRetval(0)
+            results = CreateResult({
+                'name': 'test_name',
+                'actual': json_results.ResultType.Pass,
+                'artifacts': {
+                    'artifact_name': [path],
+                }
+            })
+            retval = rsr.report_individual_test_result(
+                    results, output_dir, CreateTestExpectations(),
+                    FAKE_TEST_PATH, FAKE_TEST_LINE, 'test_name_prefix.')
+            self.assertEqual(retval, 0)
+        finally:
+            shutil.rmtree(output_dir)
+
+        test_result = GetTestResultFromPostedJson(rsr._post.args[1])
+        expected_artifacts = {
+            'artifact_name': {
+                'contents': base64.b64encode(b'archived').decode('utf-8'),
+            },
+        }
+        expected_artifacts.update(STDOUT_STDERR_ARTIFACTS)
+        self.assertEqual(test_result, CreateExpectedTestResult(
+                artifacts=expected_artifacts))
+
     def testReportIndividualTestResultSingleInMemoryTextArtifact(self):
         self.setLuciContextWithContent(DEFAULT_LUCI_CONTEXT)
         rsr = ResultSinkReporterWithFakeSrc(self._host)
@@ -861,6 +1139,17 @@ class ResultSinkReporterTest(unittest.TestCase):
         finally:
             result_sink._create_json_test_result = original_function
 
+    def testBase64CacheEvictsLeastRecentlyUsed(self):
+        cache = result_sink._Base64Cache(max_length=6)
+        self.assertEqual(cache.encode('abc'),
+                         base64.b64encode(b'abc').decode('utf-8'))
+        cache.encode('def')
+        cache.encode('abc')
+        cache.encode('ghi')
+        self.assertEqual(list(cache._encodings), ['abc', 'ghi'])
+        cache.encode('too long to cache')
+        self.assertEqual(list(cache._encodings), ['abc', 'ghi'])
+
     def testCreateJsonTestResultInvalidStatus(self):
         with self.assertRaises(ValueError):
             result_sink._create_json_test_result(
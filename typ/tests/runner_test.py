@@ -12,11 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import gzip
 import inspect
 import json
+import shutil
 import os
 import sys
 import tempfile
+import time
 import unittest
 
 from textwrap import dedent as d
@@ -24,6 +27,8 @@ from textwrap import dedent as d
 
 from typ import Host, Runner, Stats, TestCase, TestSet, TestInput
 from typ import WinMultiprocessing
+from typ import expectations_parser
+from typ import json_results
 from typ import runner as runner_module
 from typ.fakes import host_fake
 from typ.tests.stub_test_func import stub_test_func
@@ -45,6 +50,12 @@ class MockTestCase(unittest.TestCase):
         pass
 
 
+class _UncompactableExpectations(expectations_parser.TestExpectations):
+
+    def compact(self):
+        raise ValueError('cannot compact')
+
+
 class MockArgs(object):
 
     def __init__(
@@ -118,6 +129,17 @@ class RunnerTests(TestCase):
             test_filter='test_pass')
         self._PrefixDoesNotMatch(runner)
 
+    def test_child_falls_back_to_uncompacted_expectations(self):
+        host = host_fake.FakeHost()
+        r = Runner(host=host)
+        r.has_expectations = True
+        r.expectations = _UncompactableExpectations()
+        child = runner_module._Child(r)
+        self.assertIs(child.expectations, r.expectations)
+        stderr = host.stderr.getvalue()
+        self.assertIn('could not compact the expectations', stderr)
+        self.assertIn('cannot compact', stderr)
+
     def test_context(self):
         if not self.is_under_typ:
             self.skipTest('Must be run under typ')
@@ -233,6 +255,123 @@ class RunnerTests(TestCase):
       finally:
         os.remove(trace_filepath)
 
+    @unittest.skipIf(sys.platform == 'win32',
+                     'WinMultiprocessing.ignore is not allowed on win32')
+    def test_result_sink_in_parent(self):
+
+        fd, output_filepath = tempfile.mkstemp(prefix='rdb', suffix='.jsonl')
+        os.close(fd)
+        try:
+            r = Runner()
+            r.args.tests = ['typ.tests.runner_test.ContextTests',
+                            'typ.tests.runner_test.FailureTests',
+                            'typ.tests.runner_test.SkipTests']
+            r.args.jobs = 2
+            r.args.rdb_content_output_file = output_filepath
+            r.args.result_sink_in_parent = True
+            r.win_multiprocessing = WinMultiprocessing.ignore
+            ret, _, _ = r.run()
+            self.assertEqual(ret, 0)
+
+            with open(output_filepath) as f:
+                test_results = [json.loads(line) for line in f]
+            self.assertEqual(
+                sorted((t['testId'], t['status']) for t in test_results),
+                [('typ.tests.runner_test.ContextTests.test_context', 'PASS'),
+                 ('typ.tests.runner_test.FailureTests.test_failure', 'PASS'),
+                 ('typ.tests.runner_test.SkipTests.test_skip', 'SKIP')])
+        finally:
+            os.remove(output_filepath)
+
+    def test_compressed_outputs(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            r = Runner()
+            r.args.tests = ['typ.tests.runner_test.SkipTests']
+            r.args.jobs = 1
+            r.args.write_full_results_to = os.path.join(
+                tmpdir, 'full_results.json.gz')
+            r.args.write_trace_to = os.path.join(tmpdir, 'trace.json.gz')
+            r.args.compress_outputs = 'gzip'
+            ret, full_results, trace = r.run()
+            self.assertEqual(ret, 0)
+
+            h = Host()
+            with open(r.args.write_full_results_to, 'rb') as f:
+                contents = gzip.decompress(f.read()).decode('utf-8')
+            self.assertNotIn(' ', contents.split('"tests"')[0])
+            self.assertEqual(json_results.read_json_file(
+                h, r.args.write_full_results_to), full_results)
+            self.assertEqual(json_results.read_json_file(
+                h, r.args.write_trace_to), trace)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_results_sidecar(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            r = Runner()
+            r.args.tests = ['typ.tests.runner_test.FailureTests',
+                            'typ.tests.runner_test.SkipTests']
+            r.args.jobs = 1
+            r.args.write_results_sidecar_to = os.path.join(
+                tmpdir, 'results.jsonl')
+            ret, full_results, _ = r.run()
+            self.assertEqual(ret, 0)
+
+            self.assertEqual(
+                json_results.make_full_results_from_sidecar(
+                    Host(), r.args.write_results_sidecar_to,
+                    seconds_since_epoch=full_results['seconds_since_epoch']),
+                full_results)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_trace_only_built_when_written(self):
+        r = Runner()
+        r.args.tests = ['typ.tests.runner_test.SkipTests']
+        r.args.jobs = 1
+        ret, _, trace = r.run()
+        self.assertEqual(ret, 0)
+        self.assertIsNone(trace)
+
+    def test_trace_leaves_out_spilled_output(self):
+        r = Runner()
+        r.stats = Stats('', time.time, 1)
+        result = json_results.Result(
+            'test_large_output', json_results.ResultType.Pass,
+            r.stats.started_time, 0.1, 0, out='x' * 100, err='err')
+        result.spill_large_text(10)
+        out, _, _ = result.stored_text()
+        try:
+            result_set = json_results.ResultSet()
+            result_set.add(result)
+            args = r._trace_from_results(result_set)['traceEvents'][0]['args']
+            self.assertEqual(
+                args['out'],
+                '[... 100 bytes of output not included in the trace ...]')
+            self.assertEqual(args['err'], 'err')
+            self.assertTrue(os.path.exists(out.path))
+        finally:
+            out.remove()
+
+    def test_upload_compressed(self):
+        host = host_fake.FakeHost()
+        r = Runner(host=host)
+        r.args.test_results_server = 'localhost'
+        r.args.builder_name = 'fake_builder'
+        r.args.master_name = 'fake_master'
+        r.args.test_type = 'fake_test_type'
+        r.args.compress_outputs = 'gzip'
+        full_results = json_results.make_full_results(
+            {}, 0, [], json_results.ResultSet())
+        self.assertEqual(r._upload(full_results), 0)
+
+        url, data, headers, _ = host.fetches[0]
+        self.assertEqual(url, 'https://localhost/testfile/upload')
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertIn(b'"version":3', gzip.decompress(data))
+
 
 class FailureReasonExtractionTests(TestCase):
     def test_basecase(self):
@@ -330,6 +469,7 @@ class TestSetTests(TestCase):
             test_set.parallel_tests = [TestInput('load_test.BaseTest.test_x')]
             r = Runner()
             r.args.jobs = 1
+            r.args.write_trace_to = 'trace.json'
             ret, _, trace = r.run(test_set)
             self.assertEqual(ret, 1)
             self.assertIn('BaseTest',
@@ -0,0 +1,45 @@
+# Copyright 2025 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import io
+import os
+import pickle
+import unittest
+
+from typ import spilled_text
+
+
+class TestSpilledText(unittest.TestCase):
+
+    def test_copy_spilled_text(self):
+        text = 'x' * 100 + '\r\n\u2603'
+        spilled = spilled_text.SpilledText.write(text)
+        f = io.BytesIO()
+        # pylint: disable=protected-access
+        orig_chunk_size = spilled_text._SPILLED_COPY_CHUNK_SIZE
+        spilled_text._SPILLED_COPY_CHUNK_SIZE = 7
+        try:
+            spilled.copy_to(f)
+        finally:
+            spilled_text._SPILLED_COPY_CHUNK_SIZE = orig_chunk_size
+        self.assertEqual(f.getvalue(), text.encode('utf-8'))
+        self.assertFalse(os.path.exists(spilled.path))
+
+    def test_unread_spilled_text_is_removed_at_exit(self):
+        # pylint: disable=protected-access
+        # Keep the files spilled by the rest of this process out of the way.
+        spilled_paths = spilled_text._spilled_paths
+        spilled_text._spilled_paths = set()
+        try:
+            spilled = spilled_text.SpilledText.write('text')
+            self.assertEqual(spilled_text._spilled_paths, {spilled.path})
+            # Whoever unpickles it takes over removing the file, which here
+            # is the same process.
+            pickle.loads(pickle.dumps(spilled))
+            self.assertEqual(spilled_text._spilled_paths, {spilled.path})
+            spilled_text._remove_spilled_files()
+            self.assertFalse(os.path.exists(spilled.path))
+            self.assertEqual(spilled_text._spilled_paths, set())
+        finally:
+            spilled_text._spilled_paths = spilled_paths
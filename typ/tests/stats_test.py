@@ -72,3 +72,54 @@ class TestStats(unittest.TestCase):
         s = Stats('%u', lambda: 0, 32)
         s.total = 2
         self.assertEqual(s.format(), '2')
+
+    def test_trailing_percent(self):
+        s = Stats('[%f]%', lambda: 0, 32)
+        self.assertEqual(s.format(), '[0]%')
+
+    def test_changing_format(self):
+        s = Stats('[%f]', lambda: 0, 32)
+        s.fmt = '%t tests'
+        s.total = 3
+        self.assertEqual(s.format(), '3 tests')
+
+    def test_current_rate_uses_last_size_times(self):
+        times = list(range(1001))
+        s = Stats('[%c]', lambda: times.pop(0), 256)
+        for _ in range(1000):
+            s.add_time()
+        self.assertEqual(s.format(), '[  1.0]')
+        self.assertEqual(len(s._times), 257)  # pylint: disable=W0212
+
+    def test_remaining_time_from_expected_times(self):
+        s = Stats('[%W %E]', lambda: 0, 2,
+                  expected_times={'a': 30.0, 'b': 60.0, 'c': 3600.0})
+        self.assertEqual(s.format(), '[0.0 0:00]')
+        s.add_tests(['a', 'b', 'c'])
+        self.assertEqual(s.format(), '[3690.0 30:45]')
+        s.add_time('c', 3000.0)
+        self.assertEqual(s.format(), '[90.0 0:45]')
+        s.add_time('b', 1.0)
+        self.assertEqual(s.format(), '[30.0 0:30]')
+        s.add_time('a', 1.0)
+        self.assertEqual(s.format(), '[0.0 0:00]')
+
+    def test_remaining_time_from_running_average(self):
+        s = Stats('[%W %E]', lambda: 0, 4)
+        s.add_tests(['a', 'b', 'c'] * 2)
+        self.assertEqual(s.format(), '[- -]')
+        s.add_time('a', 1.0)
+        s.add_time('b', 3.0)
+        # Four runs left at 2s each, spread over the four jobs.
+        self.assertEqual(s.format(), '[8.0 0:02]')
+        # Tests that were not added do not change the estimate.
+        s.add_time('unknown', 2.0)
+        self.assertEqual(s.format(), '[8.0 0:02]')
+
+    def test_remaining_time_mixes_expected_and_average_times(self):
+        s = Stats('[%W %E]', lambda: 0, 1, expected_times={'a': 7200.0})
+        s.add_tests(['a', 'b'])
+        # Without finished tests, the mean expected time is used.
+        self.assertEqual(s.format(), '[14400.0 4:00:00]')
+        s.add_time('c', 10.0)
+        self.assertEqual(s.format(), '[7210.0 2:00:10]')